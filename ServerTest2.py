@@ -7,21 +7,19 @@ import socket
 import threading
 import socketserver
 import time
-import json
 import traceback
 import os
 
-# for RPI especially:
-from examine_platen_page import examine_platen_page
-from examine_outfeed_page import examine_outfeed_page
-from check_platen_punch import check_platen_punch
+import net_codec
+import net_protocol
+import camera_client
+from camera_api import parse_net_cmd      # >>>all business logic is reached through here<<<
 
 
 # This is base version sending simple strings; next step is convert dict to string
 
-BUFFER_SIZE = 2048      # For the moment, assume all messages will fit in one buffer length
-DELTA = 100             # allow for overhead in socket buffer when comparing if message is too large
-ENCODING = 'ascii'      # use 'ascii' or 'utf-8'
+MAX_FRAME_SIZE = net_protocol.MAX_FRAME_SIZE     # largest request/response payload; see net_protocol.py for framing
+IDLE_TIMEOUT = 10       # seconds a kept-alive connection may sit idle before the server closes it
 SERVER_ERROR_RETURN = b"ERROR SERVER RECEIVED MESSAGE THAT WAS NOT A DICTIONARY"   # This flags an error to caller
 
 keep_running = True
@@ -35,21 +33,36 @@ This is "version 2" network design.
 * The "server" is the Raspberry Pi with a camera attached.
 
 * all action driven from client; if the server needs to send something to the client, the client must poll for it
+  (the one exception: a client that sends NET_REQUEST_SUBSCRIBE for an action has the results pushed to it on that
+  connection as soon as the action finishes, see below)
 * every message from the client will result in a response from the server.
-* the socket connection is opened fresh each time the client wants to send a message to the server; it is kept open
-  until the server sends a response message, and then the socket is closed.
-* the client is effectively blocked until the server sends a response, or a timeout occurs
+* the client opens a socket connection to the server the first time it sends a message to a camera RPi, and keeps it
+  open (keep-alive) in a pool so later requests reuse it; the server closes it after IDLE_TIMEOUT seconds with
+  no requests, and the client transparently reconnects the next time it sends a message (see camera_client.py).
+* the client is effectively blocked until the server sends a response, or a timeout occurs (separate connect and
+  read timeouts); IMMEDIATE and POLL requests are retried by the client if the connection fails.
+* a request that goes to every camera RPi (Platen, Outfeed, Stacker) can be sent to all of them at once
+  (camera_client.fan_out()); a slow or unreachable camera only delays its own response.
 * if the server will take a long time to respond to a client request, the server should immediately ACK the
   request in order to close the socket connection, and then independently work on the request. The client can
   send polling query requests to the server to see if it is done yet; the server will respond with either "not
   done yet", or "done, here are the results".  The client polling request will have the option to tell the server
   to abort the current activity if desired.
+* poll_scheduler.py runs an ACTION and its POLLs for the client, polling when the action is expected to be done
+  (learned from earlier completed_duration values) and returning a Future for the results.
 * "ACTION" requests can only be handled one at a time on one server. The previous action must be completed (or aborted) 
   before the next action request can be sent. This does not apply to "IMMEDIATE" messages; those can be sent and 
   replied to while waiting for some action to complete.
-* we are going to limit the size of messages across the network to 2048; multi-part messages not supported. The size
-  limit is applied to the JSON-encoded dictionary object when sent from either client or server. This will preclude
-  sending image files across the network this way (they can be handled at the file level with Samba).
+  Optionally the server can be configured with a small per-camera action queue (see action_jobs.py); then an action
+  sent while the camera is busy is ACKed with 'Queued': True and 'QueuePosition' instead of being NAKed. The ACK
+  also carries a 'job_id', which can be included in POLL/ABORT requests to pick out one queued action.
+* every message is sent as one length-prefixed frame (see net_protocol.py), so the receiver keeps reading until the
+  whole message has arrived even if TCP splits it up. The size limit (MAX_FRAME_SIZE, 1 MB by default) is applied to
+  the encoded dictionary object when sent from either client or server. Image files are still not meant to go
+  across the network this way (they can be handled at the file level with Samba).
+* the frame header also says how the dictionary is encoded: JSON, or msgpack if installed (see net_codec.py). The
+  server answers in the codec of the request; if it doesn't have that codec it answers with a JSON
+  NET_RESPONSE_PROBLEM with 'CodecError': True, and the client falls back to JSON.
 
 
 Messages/Requests that originate from the Client(PC):
@@ -58,6 +71,8 @@ Messages/Requests that originate from the Client(PC):
     NET_REQUEST_ACTION    ex. taking a photo and analyzing it. Something that cannot be completed immediately by the server
     NET_REQUEST_POLL      sent after sending a "ACTION_POLLED" request, to see if it is finished
     NET_REQUEST_ABORT     sent after sending a "ACTION_POLLED" request that is taking too long to complete
+    NET_REQUEST_SUBSCRIBE instead of POLL: the server sends the results on this connection when the action is done
+    NET_REQUEST_BATCH     several of the above in one round trip; the server runs them in order
 
 Messages/Responses returned from the Server(Raspberry Pi):
 ---------------------------------------------------------
@@ -101,6 +116,16 @@ Server:     NET_RESPONSE_ACK (action cancelled) -or-
             NET_RESPONSE_RESULTS (just finished before abort sent; client can use results or ignore) -or-
             NET_RESPONSE_NAK (unable because no longer working on request) -or-
             NET_RESPONSE_PROBLEM (unable to process request for some reason)
+
+Client:     NET_REQUEST_SUBSCRIBE   (ServerTest3.py engines only; the client keeps the connection open)
+Server:     NET_RESPONSE_ACK with 'Subscribed': True, and later, without another request, on the same connection:
+                NET_RESPONSE_RESULTS (finished, here are the results; 'Pushed': True) -or-
+                NET_RESPONSE_NAK (action was aborted, or dropped from the queue)
+            -or- NET_RESPONSE_RESULTS / NET_RESPONSE_NAK / NET_RESPONSE_PROBLEM right away, as for a POLL
+
+Client:     NET_REQUEST_BATCH
+Server:     NET_RESPONSE_BATCH ('Responses': one of the above for each request in the batch) -or-
+            NET_RESPONSE_PROBLEM (batch itself invalid)
             
 ######################
 Client REQUEST fields:
@@ -121,18 +146,24 @@ Client REQUEST fields:
 * NetCmd = "NET_REQUEST_IMMEDIATE"
   API = "API_START_PRINT_JOB"       # send this whenever a print job starts/resumes
   Camera = "Platen" or "Outfeed" or "Stacker"
-  build_id = build ID / traveler number
+  build_id = build ID / traveler number: integer, or a string (images for a string build_id are archived under General)
   archive_rpi_images = True/False       Applies to all Action examine/check until changed
 
 * NetCmd = "NET_REQUEST_IMMEDIATE"
   API = "API_STATUS"
   Camera = "Platen" or "Outfeed" or "Stacker"
   status_detail = bit flag (5 bits) to control desired info (see common.py, build_rpi_info() for details)
-  
+  fields = optional list of status field names to return instead of using status_detail, ex. ["cpu_percent", "top_processes"]
+  structured = optional True to leave out the big text fields (top, processes, release...); numeric fields only
+  top_n = optional number of busiest processes in top_processes (default 5)
+  max_bytes = optional size limit for the status fields (default 32K); lowest priority fields are cut to fit
+
 * NetCmd = "NET_REQUEST_IMMEDIATE"
   API = "API_REAR_CONVEYOR"     # only applies to outfeed camera
   Camera = "Outfeed"
   action = 0:stop, 1:start [verify this]
+  conveyor_empty = True/False (optional)   True if nothing is on the conveyor now: the outfeed analysis takes the next
+                                            frame as its picture of the empty conveyor (see examine_outfeed_page.py)
 
 * NetCmd = "NET_REQUEST_IMMEDIATE"
   API = "API_TAKE_PICTURE"          # take picture immediately, not used for analysis, just to test the camera
@@ -183,6 +214,24 @@ Client REQUEST fields:
   API = most recent command used in NET_REQUEST_ACTION  (must match or problem)
   Camera = "Platen" or "Outfeed" or "Stacker"
 
+---------------------------
+
+  NetCmd = "NET_REQUEST_SUBSCRIBE"
+  API = most recent command used in NET_REQUEST_ACTION  (must match or problem)
+  Camera = "Platen" or "Outfeed" or "Stacker"
+  job_id (optional)     from the ACK of the NET_REQUEST_ACTION
+  The pushed response has the subscribe request's TS1; its TS2 is when the results were ready.
+  (see camera_client.CameraClient.subscribe())
+
+---------------------------
+
+  NetCmd = "NET_REQUEST_BATCH"
+  API = "API_BATCH"
+  Camera = "Platen" or "Outfeed" or "Stacker"
+  Requests = list of 1 to MAX_BATCH (16) request dictionaries as above; Camera and TS1 default to the batch's
+  e.g. API_EXAMINE_PLATEN_PAGE, API_CHECK_PLATEN_PUNCH (with an action queue, see action_jobs.py) and API_STATUS
+  (see camera_client.CameraClient.batch())
+
 
 ######################
 Server RESPONSE fields:
@@ -193,7 +242,7 @@ Server RESPONSE fields:
   ParsingError        True if server unable to parse client request, including client sending something that is not a dictionary
   NetCmdError         True if client sent unsupported NetCmd
   APIError            True if client sent unsupported API Command
-  SizeError           True if SERVER tried to send response back to client that was too large for network buffer
+  SizeError           True if the client request, or the response the SERVER tried to send back, was larger than MAX_FRAME_SIZE
   Status              "Failed/Problem"
   ErrorType           text
   ErrorDetails        text details
@@ -204,8 +253,37 @@ Server RESPONSE fields:
   Status = "Success" or may be other text depending on API command
   if API == API_STATUS, then the response can include some combination of the following fields:
     disk_usage, uptime, watchdog_count, watch_recent, cpu_temp, top, debian, release, kernal, processes
-  if API == API_TAKE_PICTURE, then response includes field:
-    image_filename  This is name of image just captured on the RPi, including full path to it.
+    and the numeric fields disk_total, disk_used, disk_free, disk_percent, uptime_seconds, load_avg, cpu_temp_c,
+    cpu_percent, mem_total_kb, mem_available_kb, process_count (see common.py, build_rpi_info())
+    top_processes   the busiest processes by CPU: list of {pid, name, user, cpu_percent, mem_percent, rss_kb}
+    analysis_pool   (status_detail bit 1) image analysis worker processes: workers, running, queued, completed,
+                    utilization (worker pid -> percent of time busy); see analysis_pool.py
+    image_archive   (status_detail bit 1) background image writer: queued, written, bytes_written, downsampled,
+                    dropped, errors, last_error, write_ms and queue_wait_ms ({p50, p95, max} of recent images)
+    archive_retention   (status_detail bit 2) archived image storage: builds, days, archive_bytes, archive_files,
+                    active_build, evicted_days, evicted_bytes (old builds deleted to keep the SD card from filling)
+    api_metrics     (status_detail bit 2) "NetCmd/API" -> {count, problems, avg_ms, max_ms} for every request type
+                    handled since the server started
+    status_age      seconds since each of the above fields was collected
+    status_truncated    names of text/list fields that were shortened or dropped to fit in max_bytes
+  if API == API_REAR_CONVEYOR, then response includes fields (the conveyor motor itself is not driven yet, so the
+  response still has ErrorType "Command NOT IMPLEMENTED YET"):
+    outfeed_monitor     True if the outfeed analysis is following every frame (conveyor said to be running)
+    outfeed_calibrated  True if the outfeed analysis has a picture of the empty conveyor
+  if API == API_TAKE_PICTURE, then response includes fields:
+    frame_number, frame_time, x_resolution, y_resolution   of the frame taken from the camera stream
+    image_filename  This is name of image just captured on the RPi, including full path to it (if archive_rpi_images)
+    image_archived  "queued", or "downsampled"/"dropped" if the RPi is behind writing images (if archive_rpi_images)
+  Kept images are written in the background (see image_archive.py), so the file appears shortly after the response.
+  API_TAKE_PICTURE needs the camera stream started by API_START_HARDWARE (see camera_capture.py); otherwise, or if the
+  camera fails, the response is NET_RESPONSE_PROBLEM with Status "Camera problem".
+
+  NetCmd = "NET_RESPONSE_BATCH"
+  API = "API_BATCH"
+  Camera = incoming Camera
+  Responses = list of the responses to the batch's Requests, in order, each with its own TS2/TS3 (when the server
+              started/finished that request); a request that could not be run has a NET_RESPONSE_PROBLEM
+  Status = "Success"
 
   NetCmd = "NET_RESPONSE_ACK"
   API = incoming API    (Commands allowed:   API_EXAMINE_PLATEN_PAGE,  API_CHECK_PLATEN_PUNCH,  API_EXAMINE_OUTFEED_PAGE, API_REBOOT)
@@ -232,6 +310,29 @@ Server RESPONSE fields:
   duration = how many seconds since action started
   completed_duration = how many seconds from action request until it actually completed
   Status = "Completion"
+  API_EXAMINE_PLATEN_PAGE and API_CHECK_PLATEN_PUNCH are analysed in worker processes (see analysis_pool.py);
+  analysis_ms is the analysis itself, not the wait for a frame or a free worker.
+  With archive_rpi_images on (API_START_PRINT_JOB) their results also include image_filename and image_archived as for
+  API_TAKE_PICTURE.
+  if API == API_EXAMINE_PLATEN_PAGE, then response also includes (see examine_platen_page.py):
+    page_num, frame_number, analysis_ms
+    page_found      True if the region between config_pt_1 and config_pt_2 contains a page
+    coverage        fraction of that region covered by the page (0-1)
+    page_box        [left, top, right, bottom] of the page, pixels    (only if page_found)
+    page_center     [x, y] of the page, pixels                         (only if page_found)
+    skew_deg        rotation of the page from square, degrees          (only if page_found)
+  if API == API_CHECK_PLATEN_PUNCH, then response also includes (see check_platen_punch.py):
+    page_num, frame_number, analysis_ms
+    punch_ok        True if every registration hole for the page_size was found
+    punches_found   number of holes found
+    punches         list of {x, y, found, contrast} per hole, pixels
+  if API == API_EXAMINE_OUTFEED_PAGE, then response also includes (see examine_outfeed_page.py):
+    page_num, frame_number, analysis_ms, frames_analyzed, changed_fraction
+    calibrated      True if the analysis has a picture of the empty conveyor (API_REAR_CONVEYOR conveyor_empty)
+    page_present    True if there is a page on the conveyor
+    page_box, page_center   where the page is, pixels                  (only if page_present)
+    page_motion     [x, y] speed of the page, pixels/second            (only if page_present, after 2 frames)
+    defect_count, defects   dark spots on the page, list of [left, top, right, bottom]   (only if page_present)
 
 #
 """
@@ -242,26 +343,58 @@ class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
     # Reminder: the main server loop calls server.handle_request(), and that in turn will call handle() here.
 
     def handle(self):
+        # The connection stays open for as many requests as the client wants to send (keep-alive); it ends when
+        # the client closes its side, or when no request arrives for IDLE_TIMEOUT seconds.
+        self.request.settimeout(IDLE_TIMEOUT)
+        reader = net_protocol.FrameReader(self.request, MAX_FRAME_SIZE)
+        while True:
+            # ########################################
+            # Receive one length-prefixed frame, which we
+            # assume is an encoded dictionary, from the network
+            # ########################################
+            try:
+                data_bytes = reader.read_frame()
+            except socket.timeout:
+                return      # idle connection; client will reconnect when it needs to
+            except net_protocol.FrameTooLarge as e:
+                # We can't read (or skip over) a request this large, so answer with a problem and drop the connection
+                print("{S}: ERROR Server received a request that is too large:", e)
+                self.send_response({
+                    'NetCmd': "NET_RESPONSE_PROBLEM",
+                    'API': 'N/A',
+                    'Camera': 'N/A',
+                    'ParsingError': False,
+                    'NetCmdError': False,
+                    'APIError': False,
+                    'SizeError': True,
+                    'ErrorType': "Client request too large",
+                    'ErrorDetails': str(e)}, 0, round(time.time(),3))
+                return
+            except (net_protocol.ConnectionClosedMidFrame, ConnectionError) as e:
+                print("{S}: ERROR", e)
+                return
+            if data_bytes is None:
+                return      # client closed the connection
+            self.handle_message(data_bytes, round(time.time(),3), reader.codec_id)
+
+    def handle_message(self, data_bytes, received, codec_id):
         originated = 0
-        received = round(time.time(),3)
+        # print("{S}: Server working with:", data_bytes)
 
-        # ########################################
-        # Receive the bytes, which we assume are
-        # JSON-encoded string, from the network
-        # ########################################
-        data_bytes = self.request.recv(BUFFER_SIZE)
-        data_str = str(data_bytes, ENCODING)
-        # print("{S}: Server working with:", data_str)
+        # answer in the codec the client used, or in JSON (which every client understands) if we don't have it
+        codec = net_codec.get_codec(codec_id) or net_codec.JSON_CODEC
 
         # ########################################
-        # Convert the JSON-encoded string into an
-        # object, which should be a dictionary
+        # Decode the payload (JSON or msgpack) directly
+        # into an object, which should be a dictionary
         # ########################################
         try:
-            input_data_dict = json.loads(data_str)
-        except ValueError:
-            # Server received something from client that is not valid json
-            print("{S}: ERROR Server received a string that is not valid JSON")
+            if codec.codec_id != codec_id:
+                raise net_codec.DecodeError("Unsupported codec id %d" % codec_id)
+            input_data_dict = codec.decode(data_bytes)
+        except ValueError as e:
+            # Server received something from client that is not valid json (or msgpack), or in a codec we don't have
+            print("{S}: ERROR Server received a string that could not be decoded:", e)
             output_data_dict = {
                 'NetCmd': "NET_RESPONSE_PROBLEM",
                 'API': 'N/A',
@@ -270,8 +403,9 @@ class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
                 'NetCmdError': False,
                 'APIError': False,
                 'SizeError': False,
-                'ErrorType': "String was not valid JSON",
-                'ErrorDetails': "Server received string which is not valid JSON"}
+                'CodecError': codec.codec_id != codec_id,
+                'ErrorType': "String was not valid %s" % codec.name.upper(),
+                'ErrorDetails': "Server received string which is not valid %s: %s" % (codec.name.upper(), e)}
         else:
             # ########################################
             # Make sure the object we received is a
@@ -316,61 +450,59 @@ class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
                     # debugging: show dictionary we are returning
                     # print("{S}: Server returning response:", output_data_dict)
 
-        finally:    # send out server response (unless size too large for network buffer)
-            # misc info
-            output_data_dict["TS1"] = originated    # when client sent out request (IF we could read this from msg); PC clock
-            output_data_dict["TS2"] = received      # when server received msg from network; RPi clock
-            output_data_dict["TS3"] = round(time.time(),3)   # when server sent out response; RPi clock
-            if 'Status' not in output_data_dict:
-                output_data_dict['Status'] = "[Not Implemented]"
-            output_data_dict['Response'] = True
+        finally:    # send out server response (unless size too large for max frame size)
+            self.send_response(output_data_dict, originated, received, codec)
 
-            # ########################################
-            # turn dictionary into JSON-encoded string
-            # ########################################
-            out_string = json.dumps(output_data_dict)       # TODO: could this throw an exception?
+    def send_response(self, output_data_dict, originated, received, codec=net_codec.JSON_CODEC):
+        # misc info
+        output_data_dict["TS1"] = originated    # when client sent out request (IF we could read this from msg); PC clock
+        output_data_dict["TS2"] = received      # when server received msg from network; RPi clock
+        output_data_dict["TS3"] = round(time.time(),3)   # when server sent out response; RPi clock
+        if 'Status' not in output_data_dict:
+            output_data_dict['Status'] = "[Not Implemented]"
+        output_data_dict['Response'] = True
 
-            # ########################################
-            # convert string to bytes so it can be sent to socket
-            # ########################################
-            out_bytes = bytes(out_string, ENCODING)
+        # ########################################
+        # turn dictionary into bytes (JSON or msgpack)
+        # that can be sent to socket
+        # ########################################
+        out_bytes = codec.encode(output_data_dict)       # TODO: could this throw an exception?
 
-            # make sure we aren't exceeding our expected buffer size limit
-            if len(out_bytes) >= (BUFFER_SIZE-DELTA):
-                print("{S}: SERVER ERROR: outgoing message too large for network buffer!!!")
-                output_data_dict = {
-                    'NetCmd': "NET_RESPONSE_PROBLEM",
-                    'API': output_data_dict['API'],
-                    'Camera': output_data_dict['Camera'],
-                    'ParsingError': False,
-                    'NetCmdError': False,
-                    'APIError': False,
-                    'SizeError': True,
-                    'ErrorType': "Server response too large",
-                    'ErrorDetails': "Return message from server would exceed buffer size of 2K; server generated message = %d bytes" % len(out_bytes),
-                }
+        # make sure we aren't exceeding the largest frame the client will accept
+        if len(out_bytes) > MAX_FRAME_SIZE:
+            print("{S}: SERVER ERROR: outgoing message too large for max frame size!!!")
+            output_data_dict = {
+                'NetCmd': "NET_RESPONSE_PROBLEM",
+                'API': output_data_dict['API'],
+                'Camera': output_data_dict['Camera'],
+                'ParsingError': False,
+                'NetCmdError': False,
+                'APIError': False,
+                'SizeError': True,
+                'ErrorType': "Server response too large",
+                'ErrorDetails': "Return message from server would exceed max frame size of %d bytes; server generated message = %d bytes" % (MAX_FRAME_SIZE, len(out_bytes)),
+            }
 
-                out_string = json.dumps(output_data_dict)
-                out_bytes = bytes(out_string, ENCODING)
-                # Note: truncating buffer makes it invalid JSON, so we just can't truncate
-                # our buffer. Instead we return a different message to describe problem
+            out_bytes = codec.encode(output_data_dict)
+            # Note: truncating buffer makes it invalid JSON, so we just can't truncate
+            # our buffer. Instead we return a different message to describe problem
 
 
 
-            # print("{S}: --server delay here--")
-            # time.sleep(10)     # pretend to do work here...
-            # print("{S}: --server continues now--:", out_string)
+        # print("{S}: --server delay here--")
+        # time.sleep(10)     # pretend to do work here...
+        # print("{S}: --server continues now--:", out_bytes)
 
-            # ########################################
-            # Send out the server's response to the client request
-            # ########################################
-            self.request.sendall(out_bytes)
+        # ########################################
+        # Send out the server's response to the client request
+        # ########################################
+        net_protocol.send_frame(self.request, out_bytes, codec.codec_id)
 
-            # Special handling if client requested API_REBOOT
-            if 'Reboot' in output_data_dict and output_data_dict['Reboot']:
-                print("{S}: Rebooting RPi now!")
-                time.sleep(2)   # give network response a chance to reach client
-                os.system('sudo shutdown -r now')
+        # Special handling if client requested API_REBOOT
+        if 'Reboot' in output_data_dict and output_data_dict['Reboot']:
+            print("{S}: Rebooting RPi now!")
+            time.sleep(2)   # give network response a chance to reach client
+            os.system('sudo shutdown -r now')
 
 
 # -----------------------------------------------------------------------------------------------------------
@@ -378,316 +510,18 @@ class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     pass
 
 
-# -----------------------------------------------------------------------------------------------------------
-def parse_net_cmd(input_data_dict):
-    # TODO: remember to check for additional required input dict fields, and return error if missing
-    net_cmd = input_data_dict["NetCmd"]
-    if net_cmd == "NET_REQUEST_IMMEDIATE":
-        output_data_dict = net_request_immediate(input_data_dict)
-    elif net_cmd == "NET_REQUEST_ACTION":
-        output_data_dict = net_request_action(input_data_dict)
-    elif net_cmd == "NET_REQUEST_POLL":
-        output_data_dict = net_request_poll(input_data_dict)
-    elif net_cmd == "NET_REQUEST_ABORT":
-        output_data_dict = net_request_abort(input_data_dict)
-    else:
-        output_data_dict = {
-            'NetCmd': "NET_RESPONSE_PROBLEM",
-            'API': input_data_dict['API'],
-            'Camera': input_data_dict['Camera'],
-            'ParsingError': False,
-            'NetCmdError': True,
-            'APIError': False,
-            'SizeError': False,
-            'ErrorType': "Invalid NetCmd",
-            'ErrorDetails': "Client sent message with invalid NetCmd: %s" % net_cmd}
-    return output_data_dict
-
-
-# -----------------------------------------------------------------------------------------------------------
-def net_request_immediate(input_data_dict):
-    # This handles:  NET_REQUEST_IMMEDIATE
-    # Commands allowed: API_PING, API_START_HARDWARE?, API_STATUS, API_REAR_CONVEYOR?, API_TAKE_PICTURE
-    # returns dictionary: output_data_dict
-    api_cmd = input_data_dict["API"]
-
-    if api_cmd == "API_PING":
-        # just send back response!
-        output_data_dict = {
-            'NetCmd': "NET_RESPONSE_IMMEDIATE",
-            'API': api_cmd,     # == "API_PING"
-            'Camera': input_data_dict['Camera'],
-            'Status': "OK"
-        }
-        return output_data_dict
-
-    elif api_cmd == "API_START_HARDWARE":
-        # stuff to do here
-        output_data_dict = {
-            'NetCmd': "NET_RESPONSE_IMMEDIATE",
-            'API': api_cmd,  # == "API_START_HARDWARE"
-            'Camera': input_data_dict['Camera'],
-            'ErrorType': "Command NOT IMPLEMENTED YET",     # FIX THIS!
-        }
-        return output_data_dict
-
-    elif api_cmd == "API_START_PRINT_JOB":
-        # stuff to do here
-        output_data_dict = {
-            'NetCmd': "NET_RESPONSE_IMMEDIATE",
-            'API': api_cmd,  # == "API_START_PRINT_JOB"
-            'Camera': input_data_dict['Camera'],
-            'ErrorType': "Command NOT IMPLEMENTED YET",     # FIX THIS!
-        }
-        return output_data_dict
-
-    elif api_cmd == "API_STATUS":
-        # stuff to do here
-        output_data_dict = {
-            'NetCmd': "NET_RESPONSE_IMMEDIATE",
-            'API': api_cmd,  # == "API_STATUS"
-            'Camera': input_data_dict['Camera'],
-            'ErrorType': "Command NOT IMPLEMENTED YET",     # FIX THIS!
-        }
-        return output_data_dict
-
-    elif api_cmd == "API_REAR_CONVEYOR":
-        # stuff to do here
-        output_data_dict = {
-            'NetCmd': "NET_RESPONSE_IMMEDIATE",
-            'API': api_cmd,  # == "API_REAR_CONVEYOR"
-            'Camera': input_data_dict['Camera'],
-            'ErrorType': "Command NOT IMPLEMENTED YET",     # FIX THIS!
-        }
-        return output_data_dict
-
-    elif api_cmd == "API_TAKE_PICTURE":   #this may take as long as a second to respond, maybe.
-        # stuff to do here
-        output_data_dict = {
-            'NetCmd': "NET_RESPONSE_IMMEDIATE",
-            'API': api_cmd,  # == "API_REAR_CONVEYOR"
-            'Camera': input_data_dict['Camera'],
-            'ErrorType': "Command NOT IMPLEMENTED YET",     # FIX THIS!
-        }
-        return output_data_dict
-
-    else:
-        output_data_dict = {
-            'NetCmd': "NET_RESPONSE_PROBLEM",
-            'API': api_cmd,
-            'Camera': input_data_dict['Camera'],
-            'ParsingError': False,
-            'NetCmdError': False,
-            'APIError': True,
-            'SizeError': False,
-            'Status': "Invalid API Command",
-            'ErrorDetails': "Client sent invalid API Command"}
-        return output_data_dict
-
-
-# -----------------------------------------------------------------------------------------------------------
-def net_request_action(input_data_dict):
-    # This handles:  NET_REQUEST_ACTION
-    # Commands allowed: API_EXAMINE_PLATEN_PAGE,  API_CHECK_PLATEN_PUNCH,  API_EXAMINE_OUTFEED_PAGE, API_REBOOT
-    # returns dictionary: output_data_dict
-    api_cmd = input_data_dict["API"]
-
-    if api_cmd == "API_EXAMINE_PLATEN_PAGE":
-        return examine_platen_page(input_data_dict)
-
-    elif api_cmd == "API_CHECK_PLATEN_PUNCH":
-        return check_platen_punch(input_data_dict)
-
-    elif api_cmd == "API_EXAMINE_OUTFEED_PAGE":
-        return examine_outfeed_page(input_data_dict)
-
-    elif api_cmd == "API_REBOOT":
-        output_data_dict = {
-            'NetCmd': "NET_RESPONSE_ACK",
-            'API': api_cmd,  # == "API_REBOOT"
-            'Camera': input_data_dict['Camera'],
-            'Reboot': True      # special flag that tells caller to reboot RPi after server ACK response sent over network
-        }
-        return output_data_dict     # Send back ack before we actually do the reboot.
-
-    else:   # unsupported API cmd
-        output_data_dict = {
-            'NetCmd': "NET_RESPONSE_PROBLEM",
-            'API': api_cmd,
-            'Camera': input_data_dict['Camera'],
-            'ParsingError': False,
-            'NetCmdError': False,
-            'APIError': True,
-            'SizeError': False,
-            'ErrorType': "Invalid API Command",
-            'ErrorDetails': "Client sent NET_REQUEST_ACTION message with invalid API Command: %s" % api_cmd}
-        return output_data_dict
-
-
-# -----------------------------------------------------------------------------------------------------------
-def net_request_poll(data_dict):
-    # This handles:  NET_REQUEST_POLL
-    # Command allowed: command used in most recent NET_REQUEST_ACTION
-    # returns dictionary: output_data_dict
-    return 0   # TBD
-
-
-# -----------------------------------------------------------------------------------------------------------
-def net_request_abort(data_dict):
-    # This handles:  NET_REQUEST_ABORT
-    # Command allowed: command used in most recent NET_REQUEST_ACTION
-    # returns dictionary: output_data_dict
-    return 0   # TBD
-
-
 # -----------------------------------------------------------------------------------------------------------
 # This is code for testing the server logic; this is sample CLIENT code; it uses the network even though both parts are running on the same computer/program
-def client(ip, port, message_dict):
-    # client_error = {"Status": "Nothing sent out; problem sending message"}
-    # print("[C]: Client sending:", message_dict)
-    if type(message_dict) is not dict:
-        # print("[C]: Client tried to send a message that is not a dictionary; nothing done")
-        return {
-            "NetCmd": "NET_RESPONSE_PROBLEM",
-            "Status": "Request was not a dictionary",
-            "Response": False
-        }
-
-    message_dict['TS1'] = round(time.time(), 3)       # when request sent out by client (PC clock)
-
-    # turn dictionary into json string
-    message_string = json.dumps(message_dict)
-    if len(message_string) >= (BUFFER_SIZE-DELTA):
-        # print("[C]: message is too large to fit in socket buffer; nothing was done.")
-        return {
-            "NetCmd": "NET_RESPONSE_PROBLEM",
-            "Status": "Request too large to send",
-            "Response": False
-        }
-
-    t1 = time.time()
-
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-        # Note: this timeout setting will affect both how long the client
-        # waits to initially connect to the Server, and also how long it
-        # waits for the Server to return a Response to its request.
-        # We may want to set this even smaller, since the client will block waiting.
-        sock.settimeout(3)
-        try:
-            sock.connect((ip, port))
-        except ConnectionRefusedError:
-            print("[C]: Connection refused!")
-            # TODO: future: automatic retry?
-            return {
-                "NetCmd": "NET_RESPONSE_PROBLEM",
-                "Response": False,
-                "ErrorDetails": "Socket connection refused: %s / %s" % (ip, port),
-                "Status": "Socket connection refused"
-            }
-        except socket.timeout:
-            print("[C]: Socket timed out!")
-            # TODO: future: automatic retry?
-            return {
-                "NetCmd": "NET_RESPONSE_PROBLEM",
-                "Response": False,
-                "ErrorDetails": "Socket connection timed out: %s / %s" % (ip, port),
-                "Status": "Socket connection timed out"
-            }
+# The client itself is in camera_client.py (connection pool, timeouts, retries); these wrappers keep the old names.
+def client(ip, port, message_dict, keep_alive=True, codec=None):
+    # keep_alive=True reuses pooled connections to (ip, port) across calls; False closes the connection afterwards
+    # codec: net_codec codec used for the request; default is msgpack if installed, else JSON (see net_codec.py)
+    return camera_client.default_client.request(ip, port, message_dict, keep_alive=keep_alive, codec=codec)
 
-        # convert string to bytes so it can be sent to socket
-        out_bytes = bytes(message_string, ENCODING)      # maybe use utf-8
-
-        # #################################
-        # send client request out socket
-        # #################################
-        sock.sendall(out_bytes)
-
-        # #################################
-        # Wait for server's response (this is blocking)
-        # #################################
-        try:
-            resp_bytes = sock.recv(BUFFER_SIZE)
-        except socket.timeout:
-            print("[C]: THREW a timeout EXCEPTION waiting for a server response!!!")
-            t2 = time.time()
-            print("[C]: Time Difference:",round(t2-t1,2))
-            # #################################
-            # This is where the CLIENT would deal with a timeout when the server didn't respond quickly enough
-            # #################################
-            return {
-                "NetCmd": "NET_RESPONSE_PROBLEM",
-                "Response": False,
-                "Status": "Timeout occurred waiting for Response from server"
-            }
-
-
-        # turn bytes into string
-        resp_str = str(resp_bytes, ENCODING)
-        # print("[C]: Client working with input:", resp_str)
-
-        try:
-            resp_dict = json.loads(resp_str)
-        except SyntaxError:
-            # Server returned something that was not valid json; this should not happen
-            print("[C]: Error: client received something that is not a valid message (not valid json)")
-            print("[C]: Client received from server:", resp_str)
-            return {"Status": "Error: Server response was not a valid message (not valid json)"}
-
-        if type(resp_dict) is not dict:
-            print("[C]: **Client received a message from the server that did not evaluate to a dictionary")  # should not happen
-            print("[C]: ", type(resp_dict))
-            print("[C]: ", resp_dict)
-            return {
-                "Status": "Error: Server response did not evaluate to a dictionary"}
-
-        if 'NetCmd' not in resp_dict:   # this shouldn't happen either
-            print("[C]: **Client received a dictionary response from the server that did not include a 'NetCmd' field; cannot parse")
-            print(resp_dict)
-            return {"Status": "Error: Server response did not contain 'NetCmd' field so unable to understand it"}
-
-        resp_dict['TS4'] = round(time.time(),3)      # when response received by client (PC clock)
-        resp_dict['Delta1'] = round(round(time.time(),3) - message_dict['TS1'],3)     # time from client sent request to receive response
-        resp_dict['Delta2'] = round(resp_dict['TS3'] - resp_dict['TS2'],3)   # time server spend processing the request
-
-        # #################################
-        # At this point, we have a valid dictionary that was returned
-        # to us by the server and we should be able to understand it;
-        # see if the server accepted the request
-        # #################################
-        """    
-        if resp_dict['NetCmd'] == "NET_RESPONSE_PROBLEM":
-            # print("[C]: **Client received response from server that the server had a problem with our request and could not process it")
-            if resp_dict['ParsingError']:
-                print("[C]: -> Server reported Parsing Error")
-            if resp_dict['NetCmdError']:
-                print("[C]: -> Server reported that our request did not have valid NetCmd")
-            if resp_dict['APIError']:
-                print("[C]: -> Server reported that our request did not have a valid API command")
-            if resp_dict['SizeError']:
-                print("[C]: -> Server reported that the response it wanted to send was too large to fit in network buffer")
-            # print("[C]: Status:",resp_dict['Status'])
-            # print("[C]: ErrorDetails:",resp_dict['ErrorDetails'])
-        elif resp_dict['NetCmd'] == "NET_RESPONSE_IMMEDIATE":
-            print("[C]: **Client received NET_RESPONSE_IMMEDIATE")
-            print("[C]: ", resp_dict)
-        elif resp_dict['NetCmd'] == "NET_RESPONSE_ACK":
-            print("[C]: **Client received NET_RESPONSE_ACK")
-            print("[C]: ", resp_dict)
-        elif resp_dict['NetCmd'] == "NET_RESPONSE_NAK":
-            print("[C]: **Client received NET_RESPONSE_NAK")
-            print("[C]: ", resp_dict)
-        elif resp_dict['NetCmd'] == "NET_RESPONSE_WAIT":
-            print("[C]: **Client received NET_RESPONSE_WAIT")
-            print("[C]: ", resp_dict)
-        elif resp_dict['NetCmd'] == "NET_RESPONSE_RESULTS":
-            print("[C]: **Client received NET_RESPONSE_RESULTS")
-            print("[C]: ", resp_dict)
-        else:
-            print("[C]: **Client received unsupported NetCmd (should not be able to happen)")
-            print("[C]: ", resp_dict)
-        """
 
-        return resp_dict
+def close_client_connections():
+    # Close all kept-alive client connections, e.g. when the printer software shuts down
+    camera_client.default_client.close()
 
 
 def server_loop(server):    # NOT SURE IF THIS IS NEEDED OR NOT
@@ -8,7 +8,7 @@
 #
 # This file, ServerTest3.py is run on the RPi:
 #       cd ~/PyCharmRemote/ServerTest
-#       python3 ServerTest3.py
+#       python3 ServerTest3.py              (or: python3 ServerTest3.py --asyncio)
 #
 # It currently uses hard-coded IP address (see end of this file); this needs to be changed
 # to read the server's assigned IP address.
@@ -21,25 +21,30 @@
 # As functionality is added here to ServerTest3.py, tests for that functionality should be added
 # to test_ServerTest3.py
 
+import asyncio
+import selectors
 import socket
 import socketserver
+import sys
+import threading
 import time
-import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 
-# for RPI especially:
-from examine_platen_page import examine_platen_page
-from examine_outfeed_page import examine_outfeed_page
-from check_platen_punch import check_platen_punch
+import net_codec
+import net_protocol
+from camera_api import parse_net_cmd      # >>>all business logic is reached through here<<<
 
 
 # This is base version sending simple strings; next step is convert dict to string
 
-BUFFER_SIZE = 2048      # For the moment, assume all messages will fit in one buffer length
-DELTA = 100             # allow for overhead in socket buffer when comparing if message is too large
-ENCODING = 'ascii'      # use 'ascii' or 'utf-8'
+MAX_FRAME_SIZE = net_protocol.MAX_FRAME_SIZE     # largest request/response payload; see net_protocol.py for framing
+IDLE_TIMEOUT = 10       # seconds a kept-alive connection may sit idle before the server closes it
+MAX_WORKERS = 8         # most requests handled at the same time (see PooledTCPServer)
+MAX_CONNECTIONS = 64    # most open client connections (idle ones included) before new ones are refused
+LISTEN_BACKLOG = 16     # listen() backlog for connections the server has not accepted yet
 
-#server = None
+server = None
 server_thread = None
 
 
@@ -52,38 +57,225 @@ class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
     camera functionality in the call: parse_net_cmd().
     When that call returns (which it must do very quickly because the client is blocked until we respond to its
     request), this class then encodes the response dictionary back into a byte string that can be sent in a reply
-    back to the client.  After this is done, and the handle() method ends, this means the socket connection that
-    was established between the client and server is closed. The socket is only open for the duration of the
-    handle() method.
+    back to the client.
+    One handler serves one connection for as long as it stays open (keep-alive), so a client can send an examine,
+    several polls and the results request without reconnecting. handle() only sets up the connection's state;
+    PooledTCPServer calls handle_ready() on a worker thread each time a request arrives, and between requests the
+    connection waits in the server's selector without holding a worker. The server closes the connection when the
+    client closes its side, or when it has been idle for IDLE_TIMEOUT seconds (and no results are waiting to be
+    pushed on it, see Session).
     See documentation for the Python library socketserver for more details.
     """
     def server_bind(self):
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.bind(self.server_address)
 
-    # Reminder: the main server loop calls server.handle_request(), and that in turn will call handle() here.
+    # Reminder: PooledTCPServer creates one handler per accepted connection, and that in turn calls handle() here.
     def handle(self):
-        originated = 0
-        received = round(time.time(),3)
+        # a request that has started to arrive must be complete within IDLE_TIMEOUT
+        self.request.settimeout(IDLE_TIMEOUT)
+        self.reader = net_protocol.FrameReader(self.request, MAX_FRAME_SIZE)
+        self._send_lock = threading.Lock()      # pushed results are sent from the action threads
+        self.session = Session(self.send_frame)
+
+    def handle_ready(self):
+        # Called when the socket is readable: answer the one request waiting on it.
+        # returns False if the connection is finished (closed by the client, or broken)
+        # ########################################
+        # Receive one length-prefixed frame, which we
+        # assume is an encoded dictionary, from the network
+        # ########################################
+        try:
+            data_bytes = self.reader.read_frame()
+        except socket.timeout:
+            print("{S}: ERROR Client stopped part way through sending a request")
+            return False
+        except net_protocol.FrameTooLarge as e:
+            # We can't read (or skip over) a request this large, so answer with a problem and drop the connection
+            print("{S}: ERROR Server received a request that is too large:", e)
+            self.send_response(request_too_large_problem(e), 0, round(time.time(),3))
+            return False
+        except (net_protocol.ConnectionClosedMidFrame, ConnectionError) as e:
+            print("{S}: ERROR", e)
+            return False
+        if data_bytes is None:
+            return False    # client closed the connection
+        self.handle_message(data_bytes, round(time.time(),3), self.reader.codec_id)
+        return True
+
+    def handle_message(self, data_bytes, received, codec_id):
+        self.session.begin_request()
+        output_data_dict, out_bytes, codec_id = process_message(data_bytes, received, codec_id, self.session)
+
+        # print("{S}: --server delay here--")
+        # time.sleep(10)     # pretend to do work here...
+        # print("{S}: --server continues now--:", out_bytes)
 
         # ########################################
-        # Receive the bytes, which we assume are
-        # JSON-encoded string, from the network
+        # Send out the server's response to the client request
         # ########################################
-        data_bytes = self.request.recv(BUFFER_SIZE)
-        data_str = str(data_bytes, ENCODING)
-        if "API_NOP" not in data_str:
-            print("{S}: Server working with:", data_str)    # The NOP message is used to write a line on the screen, to help see where unit tests start and end
+        self.send_frame(net_protocol.encode_frame(out_bytes, codec_id))
+        self.session.end_request()
+        reboot_if_requested(output_data_dict)
+
+    def send_response(self, output_data_dict, originated, received):
+        output_data_dict, out_bytes = encode_response(output_data_dict, originated, received)
+        self.send_frame(net_protocol.encode_frame(out_bytes))
+
+    def send_frame(self, frame_bytes):
+        # returns False if the connection is gone
+        with self._send_lock:
+            try:
+                self.request.sendall(frame_bytes)
+            except OSError:
+                return False
+        return True
+
+
+# -----------------------------------------------------------------------------------------------------------
+class Session:
+    """
+    One client connection, as seen by the business logic (parse_net_cmd() passes it to the handlers that ask for
+    it). It lets NET_REQUEST_SUBSCRIBE send a response on the connection later, when the action finishes, without a
+    request from the client (server push). Each server engine gives it send(frame_bytes) -> bool, which must be
+    safe to call from any thread and returns False if the connection is gone.
+    A push that comes while a request on the connection is being handled is held back until that request's response
+    has been sent, so the client always gets the ACK of a NET_REQUEST_SUBSCRIBE before the results it subscribed to.
+    While a subscription is waiting, the connection is not closed for being idle.
+    """
+    def __init__(self, send):
+        self._send = send
+        self._lock = threading.Lock()
+        self._handling = False
+        self._held = []             # frames pushed while a request was being handled
+        self.codec = net_codec.JSON_CODEC   # codec of the request being handled
+        self.waiting = 0            # subscriptions whose results have not been pushed yet
+        self.closed = False
+
+    def subscription(self, originated):
+        # for the request being handled; originated is its TS1
+        with self._lock:
+            self.waiting += 1
+        return Subscription(self, originated, self.codec)
+
+    def begin_request(self):
+        with self._lock:
+            self._handling = True
+
+    def end_request(self):
+        with self._lock:
+            held, self._held = self._held, []
+            self._handling = False
+        for frame_bytes in held:
+            self._send(frame_bytes)
+
+    def send(self, frame_bytes):
+        with self._lock:
+            if self.closed:
+                return False
+            if self._handling:
+                self._held.append(frame_bytes)
+                return True
+        return self._send(frame_bytes)
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            self._held = []
+
+
+class Subscription:
+    # One NET_REQUEST_SUBSCRIBE: push() is called once with the response to send (see action_jobs.py)
+    def __init__(self, session, originated, codec):
+        self.session = session
+        self.originated = originated
+        self.codec = codec
+        self._done = False
+
+    def _finish(self):
+        with self.session._lock:
+            if self._done:
+                return False
+            self._done = True
+            self.session.waiting -= 1
+            return True
+
+    def cancel(self):
+        self._finish()
+
+    def push(self, output_data_dict):
+        # returns False if it could not be sent
+        if not self._finish():
+            return False
+        output_data_dict['Pushed'] = True
+        # TS1 is the NET_REQUEST_SUBSCRIBE's; TS2 is when the results were ready
+        output_data_dict, out_bytes = encode_response(output_data_dict, self.originated, round(time.time(),3),
+                                                      self.codec)
+        return self.session.send(net_protocol.encode_frame(out_bytes, self.codec.codec_id))
 
+
+# -----------------------------------------------------------------------------------------------------------
+def process_message(data_bytes, received, codec_id=net_codec.CODEC_JSON, session=None):
+    """
+    Decode and validate one request received from the client, run it through parse_net_cmd(), and encode the
+    response. This is shared by ThreadedTCPRequestHandler and the asyncio engine (launch_async_server), so both
+    server engines give exactly the same response for the same request.
+    :param data_bytes: payload of one frame received from the client
+    :param received: time the frame arrived (RPi clock); returned to the client as TS2
+    :param codec_id: codec id from the frame header; the response is encoded with the same codec
+    :param session: Session of the connection the request came on, for the handlers that push responses later
+    :return: (output_data_dict, out_bytes, codec_id) where out_bytes is the encoded response payload and codec_id
+             is the codec it was encoded with (JSON if the client asked for a codec we don't have)
+    """
+    originated = 0
+    if b"API_NOP" not in data_bytes:
+        print("{S}: Server working with:", data_bytes)    # The NOP message is used to write a line on the screen, to help see where unit tests start and end
+
+    # ########################################
+    # Decode the payload (JSON or msgpack, see
+    # net_codec.py) directly from the received
+    # bytes into an object, which should be a dictionary
+    # ########################################
+    codec = net_codec.get_codec(codec_id)
+    if codec is None:
+        # Client asked for a codec this server doesn't have; answer in JSON, which every client understands
+        print("{S}: ERROR Server received a request encoded with unsupported codec id %d" % codec_id)
+        codec = net_codec.JSON_CODEC
+        output_data_dict = {
+            'NetCmd': "NET_RESPONSE_PROBLEM",
+            'API': 'N/A',
+            'Camera': 'N/A',
+            'ParsingError': True,
+            'NetCmdError': False,
+            'APIError': False,
+            'SizeError': False,
+            'CodecError': True,
+            'ErrorType': "Unsupported codec",
+            'ErrorDetails': "Server does not support codec id %d; supported: %s" %
+                            (codec_id, ", ".join(sorted(net_codec.CODECS_BY_NAME)))}
+        return encode_response(output_data_dict, originated, received, codec) + (codec.codec_id,)
+
+    try:
+        input_data_dict = codec.decode(data_bytes)
+    except ValueError:
+        # Server received something from client that is not valid json (or msgpack)
+        print("{S}: ERROR Server received a string that is not valid %s" % codec.name.upper())
+        output_data_dict = {
+            'NetCmd': "NET_RESPONSE_PROBLEM",
+            'API': 'N/A',
+            'Camera': 'N/A',
+            'ParsingError': True,
+            'NetCmdError': False,
+            'APIError': False,
+            'SizeError': False,
+            'ErrorType': "String was not valid %s" % codec.name.upper(),
+            'ErrorDetails': "Server received string which is not valid %s" % codec.name.upper()}
+    else:
         # ########################################
-        # Convert the JSON-encoded string into an
-        # object, which should be a dictionary
+        # Make sure the object we received is a
+        # dictionary object as expected
         # ########################################
-        try:
-            input_data_dict = json.loads(data_str)
-        except ValueError:
-            # Server received something from client that is not valid json
-            print("{S}: ERROR Server received a string that is not valid JSON")
+        if type(input_data_dict) is not dict:
             output_data_dict = {
                 'NetCmd': "NET_RESPONSE_PROBLEM",
                 'API': 'N/A',
@@ -92,14 +284,15 @@ class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
                 'NetCmdError': False,
                 'APIError': False,
                 'SizeError': False,
-                'ErrorType': "String was not valid JSON",
-                'ErrorDetails': "Server received string which is not valid JSON"}
+                'ErrorType': "Client did not send dictionary",
+                'ErrorDetails': "Server received object which is not a dictionary"}
         else:
-            # ########################################
-            # Make sure the object we received is a
-            # dictionary object as expected
-            # ########################################
-            if type(input_data_dict) is not dict:
+            # Make sure the client request contains the minimum expected fields
+            problems = ""
+            for field in ["NetCmd", "API", "Camera", "TS1"]:
+                if field not in input_data_dict:
+                    problems += "Client request missing field: %s\n" % field
+            if len(problems) > 0:
                 output_data_dict = {
                     'NetCmd': "NET_RESPONSE_PROBLEM",
                     'API': 'N/A',
@@ -108,290 +301,366 @@ class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
                     'NetCmdError': False,
                     'APIError': False,
                     'SizeError': False,
-                    'ErrorType': "Client did not send dictionary",
-                    'ErrorDetails': "Server received object which is not a dictionary"}
+                    'Status': "Missing Request field(s)",
+                    'ErrorType':"Missing Client field(s)",
+                    'ErrorDetails': problems}
             else:
-                # Make sure the client request contains the minimum expected fields
-                problems = ""
-                for field in ["NetCmd", "API", "Camera", "TS1"]:
-                    if field not in input_data_dict:
-                        problems += "Client request missing field: %s\n" % field
-                if len(problems) > 0:
-                    output_data_dict = {
-                        'NetCmd': "NET_RESPONSE_PROBLEM",
-                        'API': 'N/A',
-                        'Camera': 'N/A',
-                        'ParsingError': True,
-                        'NetCmdError': False,
-                        'APIError': False,
-                        'SizeError': False,
-                        'Status': "Missing Request field(s)",
-                        'ErrorType':"Missing Client field(s)",
-                        'ErrorDetails': problems}
-                else:
-                    originated = input_data_dict["TS1"]
-                    # ########################################
-                    # Parsing content of the Client request
-                    # ########################################
-                    output_data_dict = parse_net_cmd(input_data_dict)   # >>>all business logic occurs inside here<<<
-
-                    # debugging: show dictionary we are returning
-                    # print("{S}: Server returning response:", output_data_dict)
-
-        finally:    # send out server response (unless size too large for network buffer)
-            # misc info
-            output_data_dict["TS1"] = originated    # when client sent out request (IF we could read this from msg); PC clock
-            output_data_dict["TS2"] = received      # when server received msg from network; RPi clock
-            output_data_dict["TS3"] = round(time.time(),3)   # when server sent out response; RPi clock
-            if 'Status' not in output_data_dict:
-                output_data_dict['Status'] = "[Not Implemented]"
-            output_data_dict['Response'] = True
+                originated = input_data_dict["TS1"]
+                if session is not None:
+                    session.codec = codec
+                # ########################################
+                # Parsing content of the Client request
+                # ########################################
+                output_data_dict = parse_net_cmd(input_data_dict, session)   # >>>all business logic occurs inside here<<<
 
-            # ########################################
-            # turn dictionary into JSON-encoded string
-            # ########################################
-            out_string = json.dumps(output_data_dict)       # TODO: could this throw an exception?
+                # debugging: show dictionary we are returning
+                # print("{S}: Server returning response:", output_data_dict)
 
-            # ########################################
-            # convert string to bytes so it can be sent to socket
-            # ########################################
-            out_bytes = bytes(out_string, ENCODING)
-
-            # make sure we aren't exceeding our expected buffer size limit
-            if len(out_bytes) >= (BUFFER_SIZE-DELTA):
-                print("{S}: SERVER ERROR: outgoing message too large for network buffer!!!")
-                output_data_dict = {
-                    'NetCmd': "NET_RESPONSE_PROBLEM",
-                    'API': output_data_dict['API'],
-                    'Camera': output_data_dict['Camera'],
-                    'ParsingError': False,
-                    'NetCmdError': False,
-                    'APIError': False,
-                    'SizeError': True,
-                    'ErrorType': "Server response too large",
-                    'ErrorDetails': "Return message from server would exceed buffer size of 2K; server generated message = %d bytes" % len(out_bytes),
-                }
-
-                out_string = json.dumps(output_data_dict)
-                out_bytes = bytes(out_string, ENCODING)
-                # Note: truncating buffer makes it invalid JSON, so we just can't truncate
-                # our buffer. Instead we return a different message to describe problem
-
-
-
-            # print("{S}: --server delay here--")
-            # time.sleep(10)     # pretend to do work here...
-            # print("{S}: --server continues now--:", out_string)
-
-            # ########################################
-            # Send out the server's response to the client request
-            # ########################################
-            self.request.sendall(out_bytes)
-
-            # Special handling if client requested API_REBOOT
-            if 'Reboot' in output_data_dict and output_data_dict['Reboot']:
-                print("{S}: Rebooting RPi now!")
-                time.sleep(2)   # give network response a chance to reach client
-                os.system('sudo shutdown -r now')
+    # send out server response (unless size too large for max frame size)
+    return encode_response(output_data_dict, originated, received, codec) + (codec.codec_id,)
 
 
 # -----------------------------------------------------------------------------------------------------------
-class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
-    pass
-
-
-# -----------------------------------------------------------------------------------------------------------
-def parse_net_cmd(input_data_dict):
-    # TODO: remember to check for additional required input dict fields, and return error if missing
-    net_cmd = input_data_dict["NetCmd"]
-    if net_cmd == "NET_REQUEST_IMMEDIATE":
-        output_data_dict = net_request_immediate(input_data_dict)
-    elif net_cmd == "NET_REQUEST_ACTION":
-        output_data_dict = net_request_action(input_data_dict)
-    elif net_cmd == "NET_REQUEST_POLL":
-        output_data_dict = net_request_poll(input_data_dict)
-    elif net_cmd == "NET_REQUEST_ABORT":
-        output_data_dict = net_request_abort(input_data_dict)
-    else:
+def encode_response(output_data_dict, originated, received, codec=net_codec.JSON_CODEC):
+    # Adds the timestamp fields and turns the response dictionary into the bytes to send to the client.
+    # returns (output_data_dict, out_bytes); the dictionary is replaced by a SizeError problem if it won't fit
+    # misc info
+    output_data_dict["TS1"] = originated    # when client sent out request (IF we could read this from msg); PC clock
+    output_data_dict["TS2"] = received      # when server received msg from network; RPi clock
+    output_data_dict["TS3"] = round(time.time(),3)   # when server sent out response; RPi clock
+    if 'Status' not in output_data_dict:
+        output_data_dict['Status'] = "[Not Implemented]"
+    output_data_dict['Response'] = True
+
+    # ########################################
+    # turn dictionary into bytes (JSON or msgpack)
+    # that can be sent to socket
+    # ########################################
+    out_bytes = codec.encode(output_data_dict)       # TODO: could this throw an exception?
+
+    # make sure we aren't exceeding the largest frame the client will accept
+    if len(out_bytes) > MAX_FRAME_SIZE:
+        print("{S}: SERVER ERROR: outgoing message too large for max frame size!!!")
         output_data_dict = {
             'NetCmd': "NET_RESPONSE_PROBLEM",
-            'API': input_data_dict['API'],
-            'Camera': input_data_dict['Camera'],
+            'API': output_data_dict['API'],
+            'Camera': output_data_dict['Camera'],
             'ParsingError': False,
-            'NetCmdError': True,
+            'NetCmdError': False,
             'APIError': False,
-            'SizeError': False,
-            'ErrorType': "Invalid NetCmd",
-            'ErrorDetails': "Client sent message with invalid NetCmd: %s" % net_cmd}
-    return output_data_dict
-
-
-# -----------------------------------------------------------------------------------------------------------
-def net_request_immediate(input_data_dict):
-    # This handles:  NET_REQUEST_IMMEDIATE
-    # Commands allowed: API_PING, API_START_HARDWARE?, API_STATUS, API_REAR_CONVEYOR?, API_TAKE_PICTURE
-    # returns dictionary: output_data_dict
-    api_cmd = input_data_dict["API"]
-
-    if api_cmd == "API_PING":
-        # just send back response!
-        output_data_dict = {
-            'NetCmd': "NET_RESPONSE_IMMEDIATE",
-            'API': api_cmd,     # == "API_PING"
-            'Camera': input_data_dict['Camera'],
-            'Status': "OK"
-        }
-        return output_data_dict
-
-    elif api_cmd == "API_NOP":
-        # this is just formatting to help keep track of test start/end
-        print("--------------------------------------------------------")
-        output_data_dict = {
-            'NetCmd': "NET_RESPONSE_IMMEDIATE",
-            'API': api_cmd,     # == "API_PING"
-            'Camera': input_data_dict['Camera'],
-            'Status': "OK"
+            'SizeError': True,
+            'ErrorType': "Server response too large",
+            'ErrorDetails': "Return message from server would exceed max frame size of %d bytes; server generated message = %d bytes" % (MAX_FRAME_SIZE, len(out_bytes)),
         }
-        return output_data_dict
 
-    elif api_cmd == "API_START_HARDWARE":
-        # stuff to do here
-        output_data_dict = {
-            'NetCmd': "NET_RESPONSE_IMMEDIATE",
-            'API': api_cmd,  # == "API_START_HARDWARE"
-            'Camera': input_data_dict['Camera'],
-            'ErrorType': "Command NOT IMPLEMENTED YET",     # FIX THIS!
-        }
-        return output_data_dict
+        out_bytes = codec.encode(output_data_dict)
+        # Note: truncating buffer makes it invalid JSON, so we just can't truncate
+        # our buffer. Instead we return a different message to describe problem
 
-    elif api_cmd == "API_START_PRINT_JOB":
-        # stuff to do here
-        output_data_dict = {
-            'NetCmd': "NET_RESPONSE_IMMEDIATE",
-            'API': api_cmd,  # == "API_START_PRINT_JOB"
-            'Camera': input_data_dict['Camera'],
-            'ErrorType': "Command NOT IMPLEMENTED YET",     # FIX THIS!
-        }
-        return output_data_dict
+    return output_data_dict, out_bytes
 
-    elif api_cmd == "API_STATUS":
-        # stuff to do here
-        output_data_dict = {
-            'NetCmd': "NET_RESPONSE_IMMEDIATE",
-            'API': api_cmd,  # == "API_STATUS"
-            'Camera': input_data_dict['Camera'],
-            'ErrorType': "Command NOT IMPLEMENTED YET",     # FIX THIS!
-        }
-        return output_data_dict
 
-    elif api_cmd == "API_REAR_CONVEYOR":
-        # stuff to do here
-        output_data_dict = {
-            'NetCmd': "NET_RESPONSE_IMMEDIATE",
-            'API': api_cmd,  # == "API_REAR_CONVEYOR"
-            'Camera': input_data_dict['Camera'],
-            'ErrorType': "Command NOT IMPLEMENTED YET",     # FIX THIS!
-        }
-        return output_data_dict
+def request_too_large_problem(frame_error):
+    # Response for a request whose frame header announced more than MAX_FRAME_SIZE bytes
+    return {
+        'NetCmd': "NET_RESPONSE_PROBLEM",
+        'API': 'N/A',
+        'Camera': 'N/A',
+        'ParsingError': False,
+        'NetCmdError': False,
+        'APIError': False,
+        'SizeError': True,
+        'ErrorType': "Client request too large",
+        'ErrorDetails': str(frame_error)}
 
-    elif api_cmd == "API_TAKE_PICTURE":   #this may take as long as a second to respond, maybe.
-        # stuff to do here
-        output_data_dict = {
-            'NetCmd': "NET_RESPONSE_IMMEDIATE",
-            'API': api_cmd,  # == "API_REAR_CONVEYOR"
-            'Camera': input_data_dict['Camera'],
-            'ErrorType': "Command NOT IMPLEMENTED YET",     # FIX THIS!
-        }
-        return output_data_dict
 
-    else:
-        output_data_dict = {
-            'NetCmd': "NET_RESPONSE_PROBLEM",
-            'API': api_cmd,
-            'Camera': input_data_dict['Camera'],
-            'ParsingError': False,
-            'NetCmdError': False,
-            'APIError': True,
-            'SizeError': False,
-            'Status': "Invalid API Command",
-            'ErrorDetails': "Client sent invalid API Command"}
-        return output_data_dict
+def reboot_if_requested(output_data_dict):
+    # Special handling if client requested API_REBOOT; called after the response has been sent
+    if 'Reboot' in output_data_dict and output_data_dict['Reboot']:
+        print("{S}: Rebooting RPi now!")
+        time.sleep(2)   # give network response a chance to reach client
+        os.system('sudo shutdown -r now')
 
 
 # -----------------------------------------------------------------------------------------------------------
-def net_request_action(input_data_dict):
-    # This handles:  NET_REQUEST_ACTION
-    # Commands allowed: API_EXAMINE_PLATEN_PAGE,  API_CHECK_PLATEN_PUNCH,  API_EXAMINE_OUTFEED_PAGE, API_REBOOT
-    # returns dictionary: output_data_dict
-    api_cmd = input_data_dict["API"]
+class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    pass
 
-    if api_cmd == "API_EXAMINE_PLATEN_PAGE":
-        return examine_platen_page(input_data_dict)
 
-    elif api_cmd == "API_CHECK_PLATEN_PUNCH":
-        return check_platen_punch(input_data_dict)
+# This allows the socket to be reused immediately.
+# Reference: https://stackoverflow.com/questions/6380057/python-binding-socket-address-already-in-use/18858817#18858817
+class MyTCPServer(socketserver.TCPServer):
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(self.server_address)
+        self.server_address = self.socket.getsockname()     # fill in the real port if port 0 was requested
 
-    elif api_cmd == "API_EXAMINE_OUTFEED_PAGE":
-        return examine_outfeed_page(input_data_dict)
 
-    elif api_cmd == "API_REBOOT":
-        output_data_dict = {
-            'NetCmd': "NET_RESPONSE_ACK",
-            'API': api_cmd,  # == "API_REBOOT"
-            'Camera': input_data_dict['Camera'],
-            'Reboot': True      # special flag that tells caller to reboot RPi after server ACK response sent over network
-        }
-        return output_data_dict     # Send back ack before we actually do the reboot.
+# -----------------------------------------------------------------------------------------------------------
+class PooledTCPServer(MyTCPServer):
+    """
+    Concurrent version of MyTCPServer: requests are handled by a fixed number of worker threads, so a slow
+    API_STATUS from one client no longer holds up API_PING or polls from another.
+    Unlike socketserver.ThreadingMixIn (one new thread per connection, no limit), the number of threads is
+    bounded by max_workers, and a worker is only taken by a connection that has a request ready: between
+    requests a kept-alive connection (including one waiting for pushed results) is parked in a selector watched
+    by a single thread, so idle connections from PCs and dashboards never starve the workers. A request that
+    arrives while all workers are busy waits its turn. Up to max_connections connections may be open at once;
+    past that a new connection is closed immediately rather than piling up.
+    backlog is the listen() queue length used by the operating system for connections not yet accepted.
+    """
+    def __init__(self, server_address, RequestHandlerClass, max_workers=MAX_WORKERS,
+                 max_connections=MAX_CONNECTIONS, backlog=LISTEN_BACKLOG):
+        self.request_queue_size = backlog       # used by TCPServer.server_activate() for listen()
+        self.max_workers = max_workers
+        self.max_connections = max_connections
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="CameraConn")
+        self._lock = threading.Lock()
+        self._connections = set()      # sockets accepted and not yet closed (parked or being handled)
+        self._to_park = []              # handlers to hand to the parker thread
+        self._selector = selectors.DefaultSelector()
+        self._wakeup, self._wakeup_send = socket.socketpair()
+        self._selector.register(self._wakeup, selectors.EVENT_READ)
+        self._closing = False
+        self._parker = threading.Thread(target=self._park_loop, name="CameraParker", daemon=True)
+        self._parker.start()
+        super().__init__(server_address, RequestHandlerClass)
+
+    def process_request(self, request, client_address):
+        with self._lock:
+            if len(self._connections) >= self.max_connections:
+                print("{S}: Server busy; refusing connection from", client_address)
+                self.shutdown_request(request)
+                return
+            self._connections.add(request)
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)    # sets up the connection
+        except Exception:
+            self.handle_error(request, client_address)
+            self._close_connection(request)
+            return
+        self._park(handler)
+
+    def _park(self, handler):
+        # Hand the connection to the parker thread until its next request arrives
+        with self._lock:
+            if not self._closing:
+                self._to_park.append(handler)
+                handler.parked_since = time.monotonic()
+                handler = None
+        if handler is not None:
+            self._close_connection(handler.request)
+            return
+        try:
+            self._wakeup_send.send(b"\0")
+        except OSError:
+            pass
+
+    def _park_loop(self):
+        # The parker thread: waits for any parked connection to become readable and gives it to a worker
+        while True:
+            with self._lock:
+                if self._closing:
+                    return
+                to_park, self._to_park = self._to_park, []
+            for handler in to_park:
+                self._selector.register(handler.request, selectors.EVENT_READ, handler)
+            for key, _ in self._selector.select(timeout=min(1.0, IDLE_TIMEOUT)):
+                if key.data is None:
+                    try:
+                        self._wakeup.recv(4096)
+                    except OSError:
+                        pass
+                    continue
+                self._selector.unregister(key.fileobj)
+                self._pool.submit(self._serve_ready, key.data)
+            self._expire_idle()
+
+    def _expire_idle(self):
+        # Close connections idle for IDLE_TIMEOUT, unless results are waiting to be pushed on them
+        now = time.monotonic()
+        for key in list(self._selector.get_map().values()):
+            handler = key.data
+            if handler is None or now - handler.parked_since < IDLE_TIMEOUT:
+                continue
+            if handler.session.waiting:
+                continue    # the client is waiting for results to be pushed on this connection
+            self._selector.unregister(key.fileobj)
+            self._release(handler)      # idle connection; client will reconnect when it needs to
+
+    def _serve_ready(self, handler):
+        # Runs on a pool worker: answer the request waiting on this connection, then park it again
+        try:
+            keep_open = handler.handle_ready()
+        except Exception:
+            self.handle_error(handler.request, handler.client_address)
+            keep_open = False
+        if keep_open:
+            self._park(handler)
+        else:
+            self._release(handler)
 
-    else:   # unsupported API cmd
-        output_data_dict = {
-            'NetCmd': "NET_RESPONSE_PROBLEM",
-            'API': api_cmd,
-            'Camera': input_data_dict['Camera'],
-            'ParsingError': False,
-            'NetCmdError': False,
-            'APIError': True,
-            'SizeError': False,
-            'ErrorType': "Invalid API Command",
-            'ErrorDetails': "Client sent NET_REQUEST_ACTION message with invalid API Command: %s" % api_cmd}
-        return output_data_dict
+    def _release(self, handler):
+        try:
+            handler.session.close()
+            handler.finish()
+        finally:
+            self._close_connection(handler.request)
+
+    def _close_connection(self, request):
+        with self._lock:
+            self._connections.discard(request)
+        self.shutdown_request(request)
+
+    def server_close(self):
+        # Stop accepting, stop the parker, then close every connection: parked ones are simply closed, and
+        # shutting down the ones being handled makes their workers finish promptly.
+        super().server_close()
+        with self._lock:
+            self._closing = True
+            to_park, self._to_park = self._to_park, []
+        try:
+            self._wakeup_send.send(b"\0")
+        except OSError:
+            pass
+        self._parker.join()
+        parked = [key.data for key in self._selector.get_map().values() if key.data is not None] + to_park
+        self._selector.close()
+        self._wakeup.close()
+        self._wakeup_send.close()
+        for handler in parked:
+            self._release(handler)
+        with self._lock:
+            connections = list(self._connections)
+        for request in connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._pool.shutdown(wait=True)
 
 
 # -----------------------------------------------------------------------------------------------------------
-def net_request_poll(data_dict):
-    # This handles:  NET_REQUEST_POLL
-    # Command allowed: command used in most recent NET_REQUEST_ACTION
-    # returns dictionary: output_data_dict
-    return 0   # TBD
+def launch_tcp_server(host, port, max_workers=MAX_WORKERS, backlog=LISTEN_BACKLOG):
+    print(">Launching TCPServer: %s / %d" % (host,port))
+    with PooledTCPServer((host, port), ThreadedTCPRequestHandler, max_workers=max_workers, backlog=backlog) as server:
+        print("It is running")
+        server.serve_forever()
 
 
-# -----------------------------------------------------------------------------------------------------------
-def net_request_abort(data_dict):
-    # This handles:  NET_REQUEST_ABORT
-    # Command allowed: command used in most recent NET_REQUEST_ACTION
-    # returns dictionary: output_data_dict
-    return 0   # TBD
+def start_tcp_server(host, port, max_workers=MAX_WORKERS, backlog=LISTEN_BACKLOG):
+    # Same as launch_tcp_server(), but serves from a background thread and returns right away with the
+    # (ip, port) actually bound; call shutdown_tcp_server() to stop it.
+    global server, server_thread
+    server = PooledTCPServer((host, port), ThreadedTCPRequestHandler, max_workers=max_workers, backlog=backlog)
+    server_thread = threading.Thread(target=server.serve_forever, name="CameraServer")
+    server_thread.daemon = True
+    server_thread.start()
+    print(">TCPServer running in thread %s: %s / %d" % ((server_thread.name,) + server.server_address[:2]))
+    return server.server_address[:2]
 
 
-# This allows the socket to be reused immediately.
-# Reference: https://stackoverflow.com/questions/6380057/python-binding-socket-address-already-in-use/18858817#18858817
-class MyTCPServer(socketserver.TCPServer):
-    def server_bind(self):
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.socket.bind(self.server_address)
+def shutdown_tcp_server():
+    print("*** Shutting down server thread")
+    server.shutdown()           # returns once serve_forever() has stopped accepting
+    server.server_close()       # closes the listening socket and waits for in-progress requests
+    server_thread.join()
+    print("*** Shutdown complete")
+
 
 # -----------------------------------------------------------------------------------------------------------
-def launch_tcp_server(host, port):
-    print(">Launching TCPServer: %s / %d" % (host,port))
-    with MyTCPServer((host, port), ThreadedTCPRequestHandler) as server:
-        print("It is running")
-        server.serve_forever()
+# asyncio engine: an alternative to PooledTCPServer. A single event loop owns every client connection, which is much
+# cheaper on the RPi than a thread per connection when several PCs and dashboards keep idle connections open.
+# The request itself still goes through process_message() (same validation, same parse_net_cmd(), same response
+# bytes), but on a thread pool, because the business logic (subprocesses, image analysis) blocks.
+async def handle_async_connection(reader, writer, executor):
+    loop = asyncio.get_running_loop()
+    session = Session(lambda frame_bytes: push_async(loop, writer, frame_bytes))
+    try:
+        while True:
+            # ########################################
+            # Receive one length-prefixed frame
+            # ########################################
+            try:
+                header = await asyncio.wait_for(reader.readexactly(net_protocol.HEADER_SIZE), IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                if session.waiting:
+                    continue    # the client is waiting for results to be pushed on this connection
+                return      # idle connection; client will reconnect when it needs to
+            except asyncio.IncompleteReadError as e:
+                if len(e.partial) > 0:
+                    print("{S}: ERROR Connection closed while reading frame header")
+                return      # otherwise the client closed the connection
+            length, codec_id = net_protocol.HEADER.unpack(header)
+            if length > MAX_FRAME_SIZE:
+                e = net_protocol.FrameTooLarge(length, MAX_FRAME_SIZE)
+                print("{S}: ERROR Server received a request that is too large:", e)
+                output_data_dict, out_bytes = encode_response(request_too_large_problem(e), 0, round(time.time(),3))
+                writer.write(net_protocol.encode_frame(out_bytes))
+                await writer.drain()
+                return
+            try:
+                data_bytes = await asyncio.wait_for(reader.readexactly(length), IDLE_TIMEOUT)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                print("{S}: ERROR Connection closed after frame header announced %d bytes" % length)
+                return
+            received = round(time.time(),3)
+
+            session.begin_request()
+            output_data_dict, out_bytes, codec_id = await loop.run_in_executor(
+                executor, process_message, data_bytes, received, codec_id, session)
+
+            # ########################################
+            # Send out the server's response to the client request
+            # ########################################
+            writer.write(net_protocol.encode_frame(out_bytes, codec_id))
+            session.end_request()
+            await writer.drain()
+            if output_data_dict.get('Reboot'):
+                await loop.run_in_executor(executor, reboot_if_requested, output_data_dict)
+    except ConnectionError as e:
+        print("{S}: ERROR", e)
+    finally:
+        session.close()
+        writer.close()
+
+
+def push_async(loop, writer, frame_bytes):
+    # Session send() for the asyncio engine; called from an action thread, so the write is handed to the event loop
+    if writer.is_closing():
+        return False
+    try:
+        loop.call_soon_threadsafe(writer.write, frame_bytes)
+    except RuntimeError:
+        return False        # event loop has stopped
+    return True
+
+
+async def serve_async(host, port, max_workers=MAX_WORKERS, backlog=LISTEN_BACKLOG):
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="CameraWork")
+    try:
+        async_server = await asyncio.start_server(
+            lambda reader, writer: handle_async_connection(reader, writer, executor),
+            host, port, backlog=backlog, reuse_address=True)
+        async with async_server:
+            print("It is running (asyncio)")
+            await async_server.serve_forever()
+    finally:
+        executor.shutdown(wait=False)
+
+
+def launch_async_server(host, port, max_workers=MAX_WORKERS, backlog=LISTEN_BACKLOG):
+    print(">Launching asyncio server: %s / %d" % (host,port))
+    asyncio.run(serve_async(host, port, max_workers, backlog))
 
 
 # -----------------------------------------------------------------------------------------------------------
 if __name__ == "__main__":
     host, port = "10.1.10.14", 65400  # TODO: CHANGE THIS TO LOOK UP IP ADDR FROM NETWORK
-    launch_tcp_server(host, port)      # this will run forever
+    if "--asyncio" in sys.argv:
+        launch_async_server(host, port)    # this will run forever
+    else:
+        launch_tcp_server(host, port)      # this will run forever
 
     print(">tcp_server stopping")
 
@@ -0,0 +1,416 @@
+# action_jobs.py
+#
+# Background job engine for NET_REQUEST_ACTION / NET_REQUEST_POLL / NET_REQUEST_ABORT.
+#
+# An ACTION request (examine platen page, check punch, examine outfeed page) can take seconds, so the server must
+# not make the client wait for it. Instead:
+#   ACTION  -> the work is handed to a worker thread and NET_RESPONSE_ACK is returned immediately
+#              (NET_RESPONSE_NAK if that camera is still busy with a previous action)
+#   POLL    -> NET_RESPONSE_WAIT with 'duration' while the work is running, then NET_RESPONSE_RESULTS with the
+#              results plus 'duration' and 'completed_duration' once it has finished
+#   ABORT   -> asks the work to stop (cooperatively, through abort_event) and returns NET_RESPONSE_ACK; if the work
+#              had already finished, NET_RESPONSE_RESULTS is returned instead
+# See the protocol description at the top of ServerTest2.py.
+#
+# Each camera works on one action at a time; actions for different cameras run in parallel.
+#
+# Action queue (optional): by default (queue_depth=0) an ACTION that arrives while the camera is busy gets
+# NET_RESPONSE_NAK, as described in the protocol. With queue_depth > 0, up to that many ACTIONs per camera wait
+# behind the running one and are started in order; the ACK says 'Queued': True and gives 'QueuePosition'
+# (1 = next to run). At our page rates this lets API_EXAMINE_PLATEN_PAGE and API_CHECK_PLATEN_PUNCH for the same
+# page be sent back to back. When the queue is full, queue_policy decides:
+#   QUEUE_REJECT        the new ACTION gets NET_RESPONSE_NAK (same as no queue)
+#   QUEUE_DROP_OLDEST   the oldest waiting ACTION is dropped (a POLL for it gets NAK) and the new one is queued
+#
+# POLL and ABORT find the action by 'job_id' (returned in the ACK) if the request includes it; otherwise by API,
+# oldest first.
+#
+# Server push (optional): instead of polling, a client can send NET_REQUEST_SUBSCRIBE for the action on a connection
+# it keeps open. It gets NET_RESPONSE_ACK with 'Subscribed': True (or the results right away, as for a POLL, if the
+# action has already finished), and the NET_RESPONSE_RESULTS is sent on that connection as soon as the work finishes
+# (a NET_RESPONSE_NAK if the action is aborted or dropped from the queue instead). The results are sent only once:
+# a POLL afterwards gets NAK. If the push can't be delivered (connection gone) the results wait for a POLL as usual.
+#
+# The work function is called as:   results = work(input_data_dict, abort_event)
+# It returns a dictionary of result fields, which are added to the NET_RESPONSE_RESULTS message. Long running work
+# should check abort_event.is_set() now and then, and return early when it is set.
+
+import itertools
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_ACTION_WORKERS = 3      # one per camera: Platen, Outfeed, Stacker
+
+QUEUE_REJECT = "reject"
+QUEUE_DROP_OLDEST = "drop_oldest"
+
+ACTION_QUEUE_DEPTH = 0              # 0 = no queue; a busy camera NAKs new actions
+ACTION_QUEUE_POLICY = QUEUE_REJECT
+MAX_UNCOLLECTED = 4                 # finished actions per camera kept for a POLL that may never come
+
+# Job states
+PENDING = "pending"         # waiting in the camera's queue
+RUNNING = "running"
+DONE = "done"               # finished (successfully or not); results waiting to be collected by POLL/ABORT
+DROPPED = "dropped"         # pushed out of a full queue by QUEUE_DROP_OLDEST
+
+# Fields of the results dictionary that belong to the protocol, not to the action; never copied from the results
+PROTOCOL_FIELDS = ('NetCmd', 'API', 'Camera', 'Status', 'TS1', 'TS2', 'TS3', 'Response')
+
+_job_ids = itertools.count(1)
+
+
+class ActionJob:
+    """One NET_REQUEST_ACTION request and its progress"""
+    def __init__(self, input_data_dict, work):
+        self.job_id = next(_job_ids)
+        self.input_data_dict = input_data_dict
+        self.api = input_data_dict['API']
+        self.camera = input_data_dict['Camera']
+        self.work = work
+        self.state = PENDING
+        self.requested = time.time()        # when the ACTION request arrived (RPi clock)
+        self.completed = None               # when the work finished, or None while it is still pending/running
+        self.results = None                 # dictionary returned by the work function
+        self.error = None                   # text description if the work function raised an exception
+        self.abort_event = threading.Event()
+        self.subscribers = []               # notify functions from NET_REQUEST_SUBSCRIBE, see subscribe()
+
+    @property
+    def finished(self):
+        return self.state in (DONE, DROPPED)
+
+    @property
+    def aborted(self):
+        return self.abort_event.is_set()
+
+    def duration(self):
+        return round(time.time() - self.requested, 3)
+
+    def completed_duration(self):
+        return round(self.completed - self.requested, 3)
+
+
+# -----------------------------------------------------------------------------------------------------------
+class ActionJobEngine:
+    def __init__(self, max_workers=MAX_ACTION_WORKERS, queue_depth=ACTION_QUEUE_DEPTH,
+                 queue_policy=ACTION_QUEUE_POLICY):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="CameraAction")
+        self._lock = threading.Lock()
+        # Camera -> list of ActionJob in the order the ACTIONs arrived: finished ones whose results have not been
+        # collected yet, the running one, then the queued ones.
+        self._jobs = {}
+        self.configure(queue_depth, queue_policy)
+
+    def configure(self, queue_depth, queue_policy=QUEUE_REJECT):
+        if queue_policy not in (QUEUE_REJECT, QUEUE_DROP_OLDEST):
+            raise ValueError("Unknown action queue policy: %s" % queue_policy)
+        self.queue_depth = max(0, int(queue_depth))
+        self.queue_policy = queue_policy
+
+    # -------------------------------------------------------------------------------------------------------
+    def submit(self, input_data_dict, work):
+        # This handles:  NET_REQUEST_ACTION (for actions that run in the background)
+        # returns dictionary: output_data_dict (NET_RESPONSE_ACK or NET_RESPONSE_NAK)
+        api_cmd = input_data_dict['API']
+        camera = input_data_dict['Camera']
+        with self._lock:
+            jobs = self._jobs.setdefault(camera, [])
+            active = [job for job in jobs if not job.finished]
+            pending = [job for job in active if job.state == PENDING]
+            if active and len(pending) >= self.queue_depth:
+                if self.queue_depth == 0 or self.queue_policy == QUEUE_REJECT:
+                    return {
+                        'NetCmd': "NET_RESPONSE_NAK",
+                        'API': api_cmd,
+                        'Camera': camera,
+                        'Status': "Failure/NET_REQUEST_ACTION/%s; Camera %s still busy with previous action %s" %
+                                  (api_cmd, camera, active[0].api)}
+                dropped = pending.pop(0)
+                dropped.state = DROPPED
+                dropped.completed = time.time()
+                print("{S}: Action queue full for camera %s; dropped queued action %s" % (camera, dropped.api))
+            else:
+                dropped = None
+
+            job = ActionJob(input_data_dict, work)
+            jobs.append(job)
+            self._prune(jobs)
+            if not active:
+                self._start(job)
+                position = 0
+            else:
+                position = len(pending) + 1
+
+        output_data_dict = {
+            'NetCmd': "NET_RESPONSE_ACK",
+            'API': api_cmd,
+            'Camera': camera,
+            'job_id': job.job_id}
+        if position == 0:
+            output_data_dict['Status'] = "Success; Camera %s started action %s" % (camera, api_cmd)
+        else:
+            output_data_dict['Queued'] = True
+            output_data_dict['QueuePosition'] = position
+            output_data_dict['Status'] = "Success; Camera %s queued action %s (position %d)" % \
+                                         (camera, api_cmd, position)
+        if dropped is not None:
+            self._notify_subscribers(dropped)
+        return output_data_dict
+
+    def _prune(self, jobs):
+        # Forget the oldest finished actions nobody polled for. With no queue the protocol only has one action per
+        # camera, so an uncollected result is replaced as soon as the next ACTION arrives.
+        keep = MAX_UNCOLLECTED if self.queue_depth > 0 else 0
+        finished = [job for job in jobs[:-1] if job.finished]
+        for job in finished[:max(0, len(finished) - keep)]:
+            jobs.remove(job)
+
+    def _start(self, job):
+        # called with self._lock held
+        job.state = RUNNING
+        self._executor.submit(self._run, job)
+
+    def _run(self, job):
+        try:
+            if not job.aborted:
+                job.results = job.work(job.input_data_dict, job.abort_event)
+        except Exception:
+            print("{S}: ERROR action %s for camera %s failed" % (job.api, job.camera))
+            traceback.print_exc()
+            job.error = traceback.format_exc(limit=3)
+        finally:
+            with self._lock:
+                job.completed = time.time()
+                job.state = DONE
+                jobs = self._jobs.get(job.camera, [])
+                if job.aborted and job in jobs:
+                    jobs.remove(job)
+                for next_job in jobs:
+                    if next_job.state == PENDING:
+                        self._start(next_job)
+                        break
+            self._notify_subscribers(job)
+
+    def _notify_subscribers(self, job):
+        # push the outcome of a finished, aborted or dropped job to its NET_REQUEST_SUBSCRIBE subscribers
+        with self._lock:
+            subscribers, job.subscribers = job.subscribers, []
+        if not subscribers:
+            return
+        if job.aborted:
+            output_data_dict = {
+                'NetCmd': "NET_RESPONSE_NAK",
+                'API': job.api,
+                'Camera': job.camera,
+                'job_id': job.job_id,
+                'Status': "Failure/NET_REQUEST_SUBSCRIBE/%s; Camera %s action was aborted" % (job.api, job.camera)}
+        elif job.state == DROPPED:
+            output_data_dict = self._dropped_nak("NET_REQUEST_SUBSCRIBE", job)
+        else:
+            output_data_dict = self._results_response(job)
+        with self._lock:
+            self._forget(job)       # results are only sent once; a POLL from now on must not get them too
+        delivered = False
+        for notify in subscribers:
+            delivered = notify(dict(output_data_dict)) or delivered
+        if not delivered and job.state == DONE and not job.aborted:
+            with self._lock:
+                self._jobs.setdefault(job.camera, []).insert(0, job)     # left for a POLL after all
+
+    # -------------------------------------------------------------------------------------------------------
+    def _find(self, input_data_dict):
+        # called with self._lock held; returns (job, current API of the camera or None)
+        jobs = [job for job in self._jobs.get(input_data_dict['Camera'], []) if not job.aborted]
+        if 'job_id' in input_data_dict:
+            for job in jobs:
+                if job.job_id == input_data_dict['job_id']:
+                    return job, job.api
+            return None, None
+        for job in jobs:
+            if job.api == input_data_dict['API']:
+                return job, job.api
+        return None, (jobs[0].api if jobs else None)
+
+    def _forget(self, job):
+        # called with self._lock held
+        jobs = self._jobs.get(job.camera, [])
+        if job in jobs:
+            jobs.remove(job)
+
+    def _queue_position(self, job):
+        pending = [other for other in self._jobs.get(job.camera, []) if other.state == PENDING]
+        return pending.index(job) + 1
+
+    # -------------------------------------------------------------------------------------------------------
+    def poll(self, input_data_dict):
+        # This handles:  NET_REQUEST_POLL
+        # returns dictionary: output_data_dict (NET_RESPONSE_WAIT, _RESULTS, _NAK or _PROBLEM)
+        api_cmd = input_data_dict['API']
+        camera = input_data_dict['Camera']
+        with self._lock:
+            job, current_api = self._find(input_data_dict)
+            if job is None:
+                if current_api is not None:
+                    return self._mismatch_problem("NET_REQUEST_POLL", api_cmd, camera, current_api)
+                return self._idle_nak("NET_REQUEST_POLL", api_cmd, camera)
+            if job.state == DROPPED:
+                self._forget(job)
+                return self._dropped_nak("NET_REQUEST_POLL", job)
+            if not job.finished:
+                output_data_dict = {
+                    'NetCmd': "NET_RESPONSE_WAIT",
+                    'API': api_cmd,
+                    'Camera': camera,
+                    'job_id': job.job_id,
+                    'duration': job.duration(),
+                    'Status': "Waiting"}
+                if job.state == PENDING:
+                    output_data_dict['Queued'] = True
+                    output_data_dict['QueuePosition'] = self._queue_position(job)
+                return output_data_dict
+            self._forget(job)       # results are only sent once
+        return self._results_response(job)
+
+    # -------------------------------------------------------------------------------------------------------
+    def abort(self, input_data_dict):
+        # This handles:  NET_REQUEST_ABORT
+        # returns dictionary: output_data_dict (NET_RESPONSE_ACK, _RESULTS, _NAK or _PROBLEM)
+        api_cmd = input_data_dict['API']
+        camera = input_data_dict['Camera']
+        with self._lock:
+            job, current_api = self._find(input_data_dict)
+            if job is None:
+                if current_api is not None:
+                    return self._mismatch_problem("NET_REQUEST_ABORT", api_cmd, camera, current_api)
+                return self._idle_nak("NET_REQUEST_ABORT", api_cmd, camera)
+            if job.state == DROPPED:
+                self._forget(job)
+                return self._dropped_nak("NET_REQUEST_ABORT", job)
+            if job.finished:
+                self._forget(job)       # just finished before the abort arrived; client can use or ignore these
+                return self._results_response(job)
+            job.abort_event.set()
+            never_started = job.state == PENDING
+            if never_started:
+                self._forget(job)       # never started, so nothing to wait for
+            # A running job stays in self._jobs until the work function notices and returns, so the camera's next
+            # action does not start while the camera is still busy; POLL/ABORT already treat it as gone.
+        if never_started:
+            self._notify_subscribers(job)
+        return {
+            'NetCmd': "NET_RESPONSE_ACK",
+            'API': api_cmd,
+            'Camera': camera,
+            'job_id': job.job_id,
+            'duration': job.duration(),
+            'Status': "Success; Camera %s aborted action %s" % (camera, api_cmd)}
+
+    # -------------------------------------------------------------------------------------------------------
+    def subscribe(self, input_data_dict, notify):
+        # This handles:  NET_REQUEST_SUBSCRIBE
+        # notify(output_data_dict) -> True if delivered; called once, from the action's worker thread, when the
+        # action finishes (or from the thread that aborted/dropped it)
+        # returns dictionary: output_data_dict (NET_RESPONSE_ACK, or _RESULTS, _NAK or _PROBLEM as for a POLL)
+        api_cmd = input_data_dict['API']
+        camera = input_data_dict['Camera']
+        with self._lock:
+            job, current_api = self._find(input_data_dict)
+            if job is None:
+                if current_api is not None:
+                    return self._mismatch_problem("NET_REQUEST_SUBSCRIBE", api_cmd, camera, current_api)
+                return self._idle_nak("NET_REQUEST_SUBSCRIBE", api_cmd, camera)
+            if job.state == DROPPED:
+                self._forget(job)
+                return self._dropped_nak("NET_REQUEST_SUBSCRIBE", job)
+            if not job.finished:
+                job.subscribers.append(notify)
+                return {
+                    'NetCmd': "NET_RESPONSE_ACK",
+                    'API': api_cmd,
+                    'Camera': camera,
+                    'job_id': job.job_id,
+                    'duration': job.duration(),
+                    'Subscribed': True,
+                    'Status': "Success; Camera %s will send the results of %s when done" % (camera, api_cmd)}
+            self._forget(job)       # results are only sent once
+        return self._results_response(job)
+
+    # -------------------------------------------------------------------------------------------------------
+    def _results_response(self, job):
+        if job.error is not None:
+            return {
+                'NetCmd': "NET_RESPONSE_PROBLEM",
+                'API': job.api,
+                'Camera': job.camera,
+                'ParsingError': False,
+                'NetCmdError': False,
+                'APIError': False,
+                'SizeError': False,
+                'Status': "Failed/Problem",
+                'ErrorType': "Action failed",
+                'ErrorDetails': job.error,
+                'job_id': job.job_id,
+                'duration': job.duration(),
+                'completed_duration': job.completed_duration()}
+
+        output_data_dict = {}
+        if isinstance(job.results, dict):
+            for key, value in job.results.items():
+                if key not in PROTOCOL_FIELDS:
+                    output_data_dict[key] = value
+        output_data_dict.update({
+            'NetCmd': "NET_RESPONSE_RESULTS",
+            'API': job.api,
+            'Camera': job.camera,
+            'job_id': job.job_id,
+            'duration': job.duration(),
+            'completed_duration': job.completed_duration(),
+            'Status': "Completion"})
+        return output_data_dict
+
+    @staticmethod
+    def _idle_nak(net_cmd, api_cmd, camera):
+        return {
+            'NetCmd': "NET_RESPONSE_NAK",
+            'API': api_cmd,
+            'Camera': camera,
+            'Status': "Failure/%s/%s; Camera %s is not currently working on any action" % (net_cmd, api_cmd, camera)}
+
+    @staticmethod
+    def _dropped_nak(net_cmd, job):
+        return {
+            'NetCmd': "NET_RESPONSE_NAK",
+            'API': job.api,
+            'Camera': job.camera,
+            'job_id': job.job_id,
+            'Status': "Failure/%s/%s; Camera %s dropped this action because its queue was full" %
+                      (net_cmd, job.api, job.camera)}
+
+    @staticmethod
+    def _mismatch_problem(net_cmd, api_cmd, camera, current_api):
+        return {
+            'NetCmd': "NET_RESPONSE_PROBLEM",
+            'API': api_cmd,
+            'Camera': camera,
+            'ParsingError': False,
+            'NetCmdError': False,
+            'APIError': True,
+            'SizeError': False,
+            'Status': "API does not match current action",
+            'ErrorType': "API does not match current action",
+            'ErrorDetails': "Client sent %s for %s but camera %s is working on %s" %
+                            (net_cmd, api_cmd, camera, current_api)}
+
+    def shutdown(self):
+        with self._lock:
+            for jobs in self._jobs.values():
+                for job in jobs:
+                    job.abort_event.set()
+        self._executor.shutdown(wait=True)
+
+
+# The server has one engine, shared by every connection
+action_engine = ActionJobEngine()
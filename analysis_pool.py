@@ -0,0 +1,184 @@
+# analysis_pool.py
+#
+# Process pool for the CPU-bound image analysis (examine_platen_page, check_platen_punch). In the action job engine's
+# threads the analysis would be serialized by the GIL onto one core; the pool keeps ANALYSIS_WORKERS processes alive
+# (with NumPy/OpenCV and the analysis modules already imported) so every core of the Pi can work on a page.
+#
+# Frames are not pickled: the capture engine's ring buffers are in shared memory, so only the buffer's name and shape
+# go to the worker, which maps the same memory (each ring buffer is mapped once per worker and then reused). The frame
+# stays pinned in the ring until the worker is done with it. An image that isn't in shared memory (e.g. given directly
+# for testing) is copied into a temporary shared memory block.
+#
+# The action job engine thread that runs an ACTION hands the analysis over with run() and waits for it, watching
+# abort_event; camera_api.py registers the offloaded versions (see offloaded()) as the ACTION work functions.
+# API_EXAMINE_OUTFEED_PAGE is not offloaded: its analyzer keeps a background model across frames in this process.
+#
+# stats() gives the queue depth and how busy each worker process has been; it is reported in API_STATUS as
+# 'analysis_pool'.
+
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing import shared_memory
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from camera_capture import capture_engine, CaptureError
+
+ANALYSIS_WORKERS = max(1, (os.cpu_count() or 1) - 1)    # leave a core for the server, camera and status threads
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+WORKER_MODULES = ("examine_platen_page", "check_platen_punch")     # imported when each worker starts
+MAX_ATTACHED = 8            # shared memory blocks a worker keeps mapped (two rings' worth)
+
+
+# -----------------------------------------------------------------------------------------------------------
+# Worker process side
+
+_attached = collections.OrderedDict()      # shared memory name -> SharedMemory, in this worker
+
+
+def _worker_init():
+    for name in WORKER_MODULES:
+        __import__(name)
+
+
+def _attach(name):
+    shm = _attached.pop(name, None)
+    if shm is None:
+        # (the workers share the server's resource tracker, so attaching doesn't make the worker an owner)
+        shm = shared_memory.SharedMemory(name=name)
+        while len(_attached) >= MAX_ATTACHED:
+            _attached.popitem(last=False)[1].close()
+    _attached[name] = shm       # most recently used last
+    return shm
+
+
+def _worker_run(work, input_data_dict, shared_ref, kwargs):
+    started = time.perf_counter()
+    name, shape = shared_ref
+    image = np.ndarray(shape, dtype=np.uint8, buffer=_attach(name).buf)
+    try:
+        results = work(input_data_dict, None, image=image, **kwargs)
+    finally:
+        del image
+    return results, os.getpid(), time.perf_counter() - started
+
+
+# -----------------------------------------------------------------------------------------------------------
+class AnalysisPool:
+    def __init__(self, workers=ANALYSIS_WORKERS):
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._completed = 0
+        self._busy = {}             # worker pid -> seconds spent on analysis
+        self._started = None
+
+    def start(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context(START_METHOD),
+                    initializer=_worker_init)
+                self._started = time.monotonic()
+            return self._executor
+
+    def run(self, work, input_data_dict, abort_event=None, image=None, keep_frame=None, **kwargs):
+        """
+        Run work(input_data_dict, None, image=frame, **kwargs) in a worker process, on image or else on a fresh
+        camera frame, and return its results dictionary. Returns {'aborted': True} if abort_event is set first.
+        :param keep_frame: function(input_data_dict, frame) -> dictionary of extra result fields, called with the
+                           camera frame before it is analysed (e.g. to archive it)
+        """
+        if np is None:
+            raise CaptureError("numpy is not installed")
+        if image is not None:
+            return self._run_copy(work, input_data_dict, abort_event, image, kwargs)
+        with capture_engine.fresh_frame() as frame:
+            extra = keep_frame(input_data_dict, frame) if keep_frame is not None else {}
+            if frame.shared_ref is None:
+                results = self._run_copy(work, input_data_dict, abort_event, frame.image, kwargs)
+            else:
+                results = self._run_shared(work, input_data_dict, abort_event, frame.shared_ref, kwargs)
+            results['frame_number'] = frame.frame_number
+        results.update(extra)
+        return results
+
+    def _run_copy(self, work, input_data_dict, abort_event, image, kwargs):
+        shm = shared_memory.SharedMemory(create=True, size=max(1, image.nbytes))
+        try:
+            np.copyto(np.ndarray(image.shape, dtype=np.uint8, buffer=shm.buf), image)
+            return self._run_shared(work, input_data_dict, abort_event, (shm.name, image.shape), kwargs)
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def _run_shared(self, work, input_data_dict, abort_event, shared_ref, kwargs):
+        executor = self.start()
+        future = executor.submit(_worker_run, work, input_data_dict, shared_ref, kwargs)
+        with self._lock:
+            self._submitted += 1
+        try:
+            while True:
+                if abort_event is not None and abort_event.is_set():
+                    if future.cancel():
+                        return {'aborted': True}
+                    # already running; the worker can't be interrupted, but the frame must stay pinned until it's done
+                try:
+                    results, pid, busy = future.result(timeout=0.05)
+                    break
+                except concurrent.futures.TimeoutError:
+                    continue
+        except concurrent.futures.CancelledError:
+            return {'aborted': True}
+        finally:
+            with self._lock:
+                self._completed += 1
+        with self._lock:
+            self._busy[pid] = self._busy.get(pid, 0.0) + busy
+        return results
+
+    def stats(self):
+        with self._lock:
+            in_flight = self._submitted - self._completed
+            elapsed = time.monotonic() - self._started if self._started is not None else 0.0
+            return {
+                'workers': self.workers,
+                'running': min(in_flight, self.workers),
+                'queued': max(0, in_flight - self.workers),
+                'completed': self._completed,
+                'utilization': {str(pid): round(100.0 * busy / elapsed, 1) if elapsed > 0 else 0.0
+                                for pid, busy in self._busy.items()}}     # percent of time busy, per worker
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+analysis_pool = AnalysisPool()
+
+
+def offloaded(work, keep_frame=None, **kwargs_from_settings):
+    """
+    :param work: analysis function work(input_data_dict, abort_event, image=..., **kwargs)
+    :param keep_frame: see AnalysisPool.run()
+    :param kwargs_from_settings: keyword argument name -> API_START_HARDWARE setting to pass, e.g. page_size='page_size',
+                                 or function(settings) -> value worked out in this process, e.g. something cached here
+    :return: action job engine work function that runs work in the pool on a fresh camera frame
+    """
+    def run_in_pool(input_data_dict, abort_event=None):
+        settings = capture_engine.settings or {}
+        kwargs = {name: settings.get(setting) if isinstance(setting, str) else setting(settings)
+                  for name, setting in kwargs_from_settings.items()}
+        return analysis_pool.run(work, input_data_dict, abort_event, keep_frame=keep_frame, **kwargs)
+    run_in_pool.__name__ = work.__name__
+    return run_in_pool
@@ -0,0 +1,245 @@
+# archive_retention.py
+#
+# Keeps the archived images (see image_archive.py, common.ImageFilenameBuilder) from filling the RPi's SD card:
+#       <archive root>/Build_<build_id>/<YYYY-MM-DD>/<camera>/<images>      (and General/... for images without a build)
+#
+# A background thread keeps an index of how much is stored per build and day, saved as INDEX_FILE in the archive root
+# so a restart doesn't have to measure everything again. The index is brought up to date incrementally: each pass
+# only re-measures the day directories whose camera directories changed (mtime) since they were last measured, at
+# most SCAN_PER_PASS of them, so the whole tree is never walked at once and never on a request thread.
+#
+# When the file system is more than HIGH_WATERMARK percent full, whole days are deleted, oldest build first (builds in
+# order of the last day they have images for) and oldest day first within a build, until it is below LOW_WATERMARK.
+# The active build (API_START_PRINT_JOB build_id; General when the build_id is not a number, or before the first print
+# job) is never touched, nor is today's directory of any build, which may still be written to. Neither is anything in
+# the archive root that isn't a Build_<n> or General directory holding YYYY-MM-DD day directories.
+#
+# stats() is reported in API_STATUS as 'archive_retention'.
+
+import json
+import os
+import re
+import shutil
+import threading
+import time
+
+INDEX_FILE = ".retention_index.json"
+HIGH_WATERMARK = 85.0       # percent of the file system used that starts eviction
+LOW_WATERMARK = 75.0        # eviction stops below this
+PASS_INTERVAL = 60          # seconds between passes
+SCAN_PER_PASS = 20          # most day directories re-measured in one pass
+
+BUILD_DIR = re.compile(r"Build_\d+|General")      # see common.ImageFilenameBuilder
+GENERAL_DIR = "General"                             # images of a build_id that is not a number
+DAY_DIR = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+
+def _dir_size(path):
+    # (bytes, files) below path
+    total = files = 0
+    for directory, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.stat(os.path.join(directory, name)).st_size
+                files += 1
+            except OSError:
+                pass    # deleted while we looked
+    return total, files
+
+
+def _subdirs(path):
+    try:
+        with os.scandir(path) as entries:
+            return {entry.name: entry.stat().st_mtime for entry in entries if entry.is_dir(follow_symlinks=False)}
+    except OSError:
+        return {}
+
+
+def _archive_subdirs(path, pattern):
+    # _subdirs(), but only the directories whose names the archive uses at that level
+    return {name: mtime for name, mtime in _subdirs(path).items() if pattern.fullmatch(name)}
+
+
+class ArchiveRetention:
+    def __init__(self, high_watermark=HIGH_WATERMARK, low_watermark=LOW_WATERMARK, interval=PASS_INTERVAL):
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.interval = interval
+        self.root = None
+        self.active_build = None        # directory name of the active build, e.g. "Build_1234" (None: General)
+        self._index = {}                # build -> day -> {'bytes', 'files', 'mtimes': {camera: mtime}}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._wakeup = threading.Event()
+        self._stopping = False
+        # stats
+        self.evicted_days = 0
+        self.evicted_bytes = 0
+        self.last_pass = None
+        self.last_error = None
+
+    def start(self, root, active_build_id=None):
+        """
+        Start looking after the archive under root (or just change the active build if already started)
+        """
+        with self._lock:
+            self.active_build = self._build_dir(active_build_id)
+            if self._thread is not None and root == self.root:
+                return
+        self.stop()
+        with self._lock:
+            self.root = root
+            self._index = self._load_index()
+            self._stopping = False
+            self._wakeup.clear()
+            self._thread = threading.Thread(target=self._run, name="ArchiveRetention", daemon=True)
+            self._thread.start()
+
+    def set_active_build(self, build_id):
+        with self._lock:
+            self.active_build = self._build_dir(build_id)
+
+    @staticmethod
+    def _build_dir(build_id):
+        return "Build_%d" % build_id if isinstance(build_id, int) else GENERAL_DIR
+
+    def _is_protected(self, build, day):
+        # call with _lock held: the active build, and today's images of every build, are being written to
+        return build == (self.active_build or GENERAL_DIR) or day == time.strftime("%Y-%m-%d")
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is not None:
+                self._stopping = True
+                self._wakeup.set()
+        if thread is not None:
+            thread.join()       # not under the lock: the thread takes it to finish its pass
+
+    def _run(self):
+        while not self._stopping:
+            try:
+                self.run_pass()
+            except Exception as e:
+                self.last_error = str(e)
+                print("{S}: Archive retention error:", e)
+            self._wakeup.wait(self.interval)
+
+    def run_pass(self):
+        if self.root is None or not os.path.isdir(self.root):
+            return
+        changed = self._update_index()
+        changed = self._evict() or changed
+        if changed:
+            self._save_index()
+        self.last_pass = time.time()
+
+    # -------------------------------------------------------------------------------------------------------
+    def _update_index(self):
+        # re-measure up to SCAN_PER_PASS changed days; forget builds/days that are gone
+        changed = False
+        scanned = 0
+        builds = _archive_subdirs(self.root, BUILD_DIR)
+        with self._lock:
+            for build in list(self._index):
+                if build not in builds:
+                    del self._index[build]
+                    changed = True
+        for build in sorted(builds):
+            build_path = os.path.join(self.root, build)
+            days = _archive_subdirs(build_path, DAY_DIR)
+            with self._lock:
+                indexed = self._index.setdefault(build, {})
+                for day in list(indexed):
+                    if day not in days:
+                        del indexed[day]
+                        changed = True
+            for day in sorted(days):
+                if scanned >= SCAN_PER_PASS:
+                    return changed      # the rest next pass
+                day_path = os.path.join(build_path, day)
+                mtimes = _subdirs(day_path)
+                entry = indexed.get(day)
+                if entry is not None and entry['mtimes'] == mtimes:
+                    continue
+                size, files = _dir_size(day_path)
+                scanned += 1
+                with self._lock:
+                    indexed[day] = {'bytes': size, 'files': files, 'mtimes': mtimes}
+                changed = True
+        return changed
+
+    def _disk_percent(self):
+        fs = os.statvfs(self.root)
+        total = fs.f_blocks * fs.f_frsize
+        return 100.0 * (total - fs.f_bavail * fs.f_frsize) / total if total else 0.0
+
+    def _eviction_order(self):
+        # (build, day) oldest first: builds by the last day they have images for, then days within a build.
+        # Worked out from the directory names (two levels of listing), so days not measured yet are included too.
+        builds = []
+        for build in _archive_subdirs(self.root, BUILD_DIR):
+            days = _archive_subdirs(os.path.join(self.root, build), DAY_DIR)
+            with self._lock:
+                days = sorted(day for day in days if not self._is_protected(build, day))
+            if days:
+                builds.append((days[-1], build, days))
+        return [(build, day) for _, build, days in sorted(builds) for day in days]
+
+    def _evict(self):
+        if self._disk_percent() < self.high_watermark:
+            return False
+        evicted = False
+        for build, day in self._eviction_order():
+            if self._disk_percent() < self.low_watermark or self._stopping:
+                break
+            with self._lock:
+                if self._is_protected(build, day):
+                    continue        # became active (or today) since the order was worked out
+                size = self._index.get(build, {}).pop(day, {}).get('bytes', 0)
+                if not self._index.get(build):
+                    self._index.pop(build, None)
+            shutil.rmtree(os.path.join(self.root, build, day), ignore_errors=True)
+            try:
+                os.rmdir(os.path.join(self.root, build))       # only if that was its last day
+            except OSError:
+                pass
+            self.evicted_days += 1
+            self.evicted_bytes += size
+            evicted = True
+            print("{S}: Archive retention deleted %s/%s (%d bytes)" % (build, day, size))
+        return evicted
+
+    # -------------------------------------------------------------------------------------------------------
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.root, INDEX_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self):
+        path = os.path.join(self.root, INDEX_FILE)
+        with self._lock:
+            text = json.dumps(self._index)
+        with open(path + ".tmp", "w") as f:
+            f.write(text)
+        os.replace(path + ".tmp", path)
+
+    def stats(self):
+        with self._lock:
+            days = [entry for build in self._index.values() for entry in build.values()]
+            return {
+                'root': self.root,
+                'builds': len(self._index),
+                'days': len(days),
+                'archive_bytes': sum(entry['bytes'] for entry in days),
+                'archive_files': sum(entry['files'] for entry in days),
+                'active_build': self.active_build,
+                'evicted_days': self.evicted_days,
+                'evicted_bytes': self.evicted_bytes,
+                'last_pass': self.last_pass,
+                'last_error': self.last_error}
+
+
+archive_retention = ArchiveRetention()
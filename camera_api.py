@@ -0,0 +1,486 @@
+# camera_api.py
+#
+# The camera "business logic" entry point, shared by ServerTest3.py and ServerTest2.py: parse_net_cmd() looks up
+# the (NetCmd, API) of a client request in the registry below and calls the handler registered for it.
+# To add a new API, write its handler and register it here; parse_net_cmd() does not change.
+# See the protocol description at the top of ServerTest2.py for the request and response fields.
+
+import collections
+import os
+import time
+
+from net_registry import NetCmdRegistry, ASYNC, ANY_API
+from net_schema import Schema, FieldType, INT, POSITIVE_INT, BOOL, STR, POINT, one_of, any_of, int_range, list_of, \
+    matches
+from net_protocol import MAX_FRAME_SIZE
+from action_jobs import action_engine
+import camera_capture
+from camera_capture import capture_engine, CaptureError
+import rpi_status
+from rpi_status import status_collector, DEFAULT_DETAIL
+
+# for RPI especially:
+from examine_platen_page import examine_platen_page
+from examine_outfeed_page import examine_outfeed_page, outfeed_analyzer, outfeed_monitor
+from check_platen_punch import check_platen_punch, prepare_templates, current_template
+from analysis_pool import analysis_pool, offloaded
+from image_archive import image_archive
+from archive_retention import archive_retention
+try:
+    from common import ImageFilenameBuilder, image_archive_root     # needs ioutils, only on the RPi
+except ImportError:
+    ImageFilenameBuilder = image_archive_root = None
+
+IMMEDIATE = "NET_REQUEST_IMMEDIATE"
+ACTION = "NET_REQUEST_ACTION"
+POLL = "NET_REQUEST_POLL"
+ABORT = "NET_REQUEST_ABORT"
+SUBSCRIBE = "NET_REQUEST_SUBSCRIBE"
+BATCH = "NET_REQUEST_BATCH"
+REQUEST_FIELDS = ("NetCmd", "API", "Camera", "TS1")     # every request has these (checked before parse_net_cmd())
+MAX_BATCH = 16          # most requests in one NET_REQUEST_BATCH
+
+registry = NetCmdRegistry()
+
+# API_STATUS 'api_metrics': request count, problem responses and handling time of every NetCmd/API handled so far
+rpi_status.register_live_field("api_metrics", rpi_status.DETAIL_SYSTEM, registry.metrics)
+# API_STATUS 'analysis_pool': queue depth and per-worker utilization of the image analysis processes
+rpi_status.register_live_field("analysis_pool", rpi_status.DETAIL_OUTFEED, analysis_pool.stats)
+# API_STATUS 'image_archive': write latency, queue depth and dropped images of the background image writer
+rpi_status.register_live_field("image_archive", rpi_status.DETAIL_OUTFEED, image_archive.stats)
+# API_STATUS 'archive_retention': size of the image archive and what was deleted to keep the SD card from filling
+rpi_status.register_live_field("archive_retention", rpi_status.DETAIL_SYSTEM, archive_retention.stats)
+
+# set by API_START_PRINT_JOB; applies to every examine/check until the next one
+print_job = {'build_id': None, 'archive_rpi_images': False, 'filenames': None}   # filenames: ImageFilenameBuilder
+
+PycamInfo = collections.namedtuple("PycamInfo", "camera_name image_format")     # what ImageFilenameBuilder needs
+
+
+# -----------------------------------------------------------------------------------------------------------
+# Request schemas (from the Client REQUEST fields in the ServerTest2.py docstring)
+STATUS_DETAIL = int_range(0, 63)        # bit flags, see common.py, build_rpi_info()
+PAGE_SIZE = matches(r"\d+(\.\d+)?x\d+(\.\d+)?", 'a page size such as "12x8"')
+
+START_HARDWARE_SCHEMA = Schema(
+    required={'x_resolution': POSITIVE_INT, 'y_resolution': POSITIVE_INT, 'image_format': STR, 'page_size': PAGE_SIZE})
+# a build_id that isn't a number (e.g. a traveler number with letters) files the images under General
+START_PRINT_JOB_SCHEMA = Schema(required={'build_id': any_of(INT, STR), 'archive_rpi_images': BOOL})
+STATUS_SCHEMA = Schema(optional={
+    'status_detail': STATUS_DETAIL,
+    'fields': list_of(one_of(*rpi_status.FIELD_GROUPS)),
+    'structured': BOOL,
+    'top_n': int_range(1, rpi_status.TOP_N_MAX),
+    'max_bytes': int_range(1024, MAX_FRAME_SIZE)})
+REAR_CONVEYOR_SCHEMA = Schema(required={'action': one_of(0, 1)}, optional={'conveyor_empty': BOOL})
+TAKE_PICTURE_SCHEMA = Schema(
+    required={'x_resolution': POSITIVE_INT, 'y_resolution': POSITIVE_INT, 'image_format': STR},
+    optional={'archive_rpi_images': BOOL})
+EXAMINE_PLATEN_PAGE_SCHEMA = Schema(
+    required={'page_num': INT, 'config_pt_1': POINT, 'config_pt_2': POINT},
+    optional={'image_only': BOOL, 'status_detail': STATUS_DETAIL})
+PAGE_ACTION_SCHEMA = Schema(      # API_CHECK_PLATEN_PUNCH, API_EXAMINE_OUTFEED_PAGE
+    required={'page_num': INT},
+    optional={'image_only': BOOL, 'status_detail': STATUS_DETAIL})
+BATCH_SCHEMA = Schema(required={'Requests': FieldType(lambda value: type(value) is list and 0 < len(value) <= MAX_BATCH,
+                                                      "a list of 1 to %d requests" % MAX_BATCH)})
+
+
+# -----------------------------------------------------------------------------------------------------------
+def parse_net_cmd(input_data_dict, session=None):
+    # The caller has already checked that NetCmd, API, Camera and TS1 are present.
+    # session: the client connection, from the server engine (see ServerTest3.Session); None if there isn't one
+    # returns dictionary: output_data_dict
+    net_cmd = input_data_dict["NetCmd"]
+    api_cmd = input_data_dict["API"]
+
+    entry = registry.lookup(net_cmd, api_cmd)
+    if entry is None:
+        if registry.has_net_cmd(net_cmd):
+            return invalid_api_problem(input_data_dict)
+        return {
+            'NetCmd': "NET_RESPONSE_PROBLEM",
+            'API': api_cmd,
+            'Camera': input_data_dict['Camera'],
+            'ParsingError': False,
+            'NetCmdError': True,
+            'APIError': False,
+            'SizeError': False,
+            'ErrorType': "Invalid NetCmd",
+            'ErrorDetails': "Client sent message with invalid NetCmd: %s" % net_cmd}
+
+    started = time.perf_counter()
+    # check the request against the API's schema before any camera or subprocess work is started
+    missing, invalid = entry.validate(input_data_dict)
+    if missing or invalid:
+        output_data_dict = {
+            'NetCmd': "NET_RESPONSE_PROBLEM",
+            'API': api_cmd,
+            'Camera': input_data_dict['Camera'],
+            'ParsingError': True,
+            'NetCmdError': False,
+            'APIError': False,
+            'SizeError': False,
+            'Status': "Invalid Request field(s)" if invalid else "Missing Request field(s)",
+            'ErrorType': "Invalid Client field(s)" if invalid else "Missing Client field(s)",
+            'ErrorDetails': "".join(missing + invalid)}
+    elif entry.mode == ASYNC:
+        output_data_dict = action_engine.submit(input_data_dict, entry.handler)
+    elif entry.session:
+        output_data_dict = entry.handler(input_data_dict, session)
+    else:
+        output_data_dict = entry.handler(input_data_dict)
+    registry.record(entry, time.perf_counter() - started, output_data_dict['NetCmd'] == "NET_RESPONSE_PROBLEM")
+    return output_data_dict
+
+
+def invalid_api_problem(input_data_dict):
+    net_cmd = input_data_dict["NetCmd"]
+    api_cmd = input_data_dict["API"]
+    if net_cmd == IMMEDIATE:
+        details = "Client sent invalid API Command"
+    else:
+        details = "Client sent %s message with invalid API Command: %s" % (net_cmd, api_cmd)
+    return {
+        'NetCmd': "NET_RESPONSE_PROBLEM",
+        'API': api_cmd,
+        'Camera': input_data_dict['Camera'],
+        'ParsingError': False,
+        'NetCmdError': False,
+        'APIError': True,
+        'SizeError': False,
+        'Status': "Invalid API Command",
+        'ErrorType': "Invalid API Command",
+        'ErrorDetails': details}
+
+
+# -----------------------------------------------------------------------------------------------------------
+# NET_REQUEST_IMMEDIATE
+# Commands allowed: API_PING, API_NOP, API_START_HARDWARE, API_START_PRINT_JOB, API_STATUS, API_REAR_CONVEYOR,
+# API_TAKE_PICTURE
+
+@registry.register(IMMEDIATE, "API_PING")
+def api_ping(input_data_dict):
+    # just send back response!
+    return {
+        'NetCmd': "NET_RESPONSE_IMMEDIATE",
+        'API': "API_PING",
+        'Camera': input_data_dict['Camera'],
+        'Status': "OK"
+    }
+
+
+@registry.register(IMMEDIATE, "API_NOP")
+def api_nop(input_data_dict):
+    # this is just formatting to help keep track of test start/end
+    print("--------------------------------------------------------")
+    return {
+        'NetCmd': "NET_RESPONSE_IMMEDIATE",
+        'API': "API_NOP",
+        'Camera': input_data_dict['Camera'],
+        'Status': "OK"
+    }
+
+
+@registry.register(IMMEDIATE, "API_START_HARDWARE", schema=START_HARDWARE_SCHEMA)
+def api_start_hardware(input_data_dict):
+    # start (or re-configure) the camera stream; see camera_capture.py
+    try:
+        # work out the punch check geometry for this page size now rather than on the first page; this also refuses
+        # a page size the punch check can't handle before the stream and its settings are touched
+        prepare_templates(input_data_dict['page_size'], input_data_dict['x_resolution'],
+                          input_data_dict['y_resolution'])
+        capture_engine.start(input_data_dict['x_resolution'], input_data_dict['y_resolution'],
+                             input_data_dict['image_format'], page_size=input_data_dict['page_size'])
+    except (CaptureError, ValueError) as e:
+        return camera_problem(input_data_dict, e)
+    return {
+        'NetCmd': "NET_RESPONSE_IMMEDIATE",
+        'API': "API_START_HARDWARE",
+        'Camera': input_data_dict['Camera'],
+        'Status': "Success"
+    }
+
+
+@registry.register(IMMEDIATE, "API_START_PRINT_JOB", schema=START_PRINT_JOB_SCHEMA)
+def api_start_print_job(input_data_dict):
+    if input_data_dict['build_id'] != print_job['build_id']:
+        print_job['filenames'] = None       # new build directory
+    print_job['build_id'] = input_data_dict['build_id']
+    print_job['archive_rpi_images'] = input_data_dict['archive_rpi_images']
+    if image_archive_root is not None:
+        # old builds' images are deleted when the SD card gets full, never this build's (see archive_retention.py)
+        archive_retention.start(image_archive_root(), input_data_dict['build_id'])
+    return {
+        'NetCmd': "NET_RESPONSE_IMMEDIATE",
+        'API': "API_START_PRINT_JOB",
+        'Camera': input_data_dict['Camera'],
+        'Status': "Success"
+    }
+
+
+@registry.register(IMMEDIATE, "API_STATUS", schema=STATUS_SCHEMA)
+def api_status(input_data_dict):
+    # answered from the background status collector's cache; see rpi_status.py
+    # 'fields' picks fields by name (instead of status_detail); 'structured' leaves out the big text fields.
+    # The status fields are cut down to fit in 'max_bytes' rather than failing with a SizeError.
+    fields = input_data_dict.get('fields')
+    if fields is not None:
+        detail = rpi_status.detail_for_fields(fields)
+    else:
+        detail = input_data_dict.get('status_detail', DEFAULT_DETAIL)
+    info_dict = rpi_status.select_fields(status_collector.get(detail), fields,
+                                         input_data_dict.get('structured', False),
+                                         input_data_dict.get('top_n', rpi_status.TOP_N))
+    rpi_status.fit_to_budget(info_dict, input_data_dict.get('max_bytes', rpi_status.STATUS_BYTE_BUDGET))
+
+    output_data_dict = {
+        'NetCmd': "NET_RESPONSE_IMMEDIATE",
+        'API': "API_STATUS",
+        'Camera': input_data_dict['Camera'],
+        'Status': "Success"
+    }
+    output_data_dict.update(info_dict)
+    return output_data_dict
+
+
+@registry.register(IMMEDIATE, "API_REAR_CONVEYOR", schema=REAR_CONVEYOR_SCHEMA)
+def api_rear_conveyor(input_data_dict):
+    # stuff to do here
+    # The motor isn't driven from here yet; only the outfeed analyzer follows the request (see examine_outfeed_page.py):
+    # it analyses every frame while the conveyor is said to run, and calibrates on the empty conveyor if told it is.
+    output_data_dict = {
+        'NetCmd': "NET_RESPONSE_IMMEDIATE",
+        'API': "API_REAR_CONVEYOR",
+        'Camera': input_data_dict['Camera'],
+        'ErrorType': "Command NOT IMPLEMENTED YET",     # FIX THIS!
+    }
+    try:
+        if input_data_dict.get('conveyor_empty', False):
+            with capture_engine.fresh_frame() as frame:
+                outfeed_analyzer.calibrate(frame.image)
+        if input_data_dict['action'] == 1:
+            outfeed_monitor.start()
+        else:
+            outfeed_monitor.stop()
+    except CaptureError as e:
+        return camera_problem(input_data_dict, e)
+    output_data_dict['outfeed_monitor'] = outfeed_monitor.running
+    output_data_dict['outfeed_calibrated'] = outfeed_analyzer.calibrated
+    return output_data_dict
+
+
+@registry.register(IMMEDIATE, "API_TAKE_PICTURE", schema=TAKE_PICTURE_SCHEMA)
+def api_take_picture(input_data_dict):
+    # the next frame from the running camera stream (so it was taken after this request arrived)
+    try:
+        with capture_engine.fresh_frame() as frame:
+            output_data_dict = {
+                'NetCmd': "NET_RESPONSE_IMMEDIATE",
+                'API': "API_TAKE_PICTURE",
+                'Camera': input_data_dict['Camera'],
+                'Status': "Success",
+                'frame_number': frame.frame_number,
+                'frame_time': round(frame.timestamp, 3),
+                'x_resolution': frame.image.shape[1],
+                'y_resolution': frame.image.shape[0],
+            }
+            if input_data_dict.get('archive_rpi_images', False):
+                output_data_dict.update(archive_frame(input_data_dict, frame, input_data_dict['image_format']))
+    except CaptureError as e:
+        return camera_problem(input_data_dict, e)
+    return output_data_dict
+
+
+def archive_frame(input_data_dict, frame, image_format=None):
+    # Queue the frame for the background image writer (see image_archive.py); returns the response fields for it:
+    # image_filename, and image_archived = "queued", "downsampled" (the RPi is behind writing images) or "dropped"
+    image_format = image_format or (capture_engine.settings or {}).get('image_format', "JPG")
+    if ImageFilenameBuilder is not None:
+        if print_job['filenames'] is None:
+            print_job['filenames'] = ImageFilenameBuilder(print_job['build_id'])
+        user_obj = dict(input_data_dict, ts1=frame.timestamp)
+        path = print_job['filenames'].build(PycamInfo(input_data_dict['Camera'], image_format.lower()), user_obj)
+    else:
+        path = os.path.join(camera_capture.IMAGE_DIR, "%s_%d.%s" % (input_data_dict['Camera'], frame.frame_number,
+                                                                   image_format.lower()))
+    return {'image_filename': path, 'image_archived': image_archive.submit(frame.image, path, image_format)}
+
+
+def archive_action_frame(input_data_dict, frame):
+    # the frame an examine/check action analyses is archived if the print job asked for it
+    if not print_job['archive_rpi_images']:
+        return {}
+    return archive_frame(input_data_dict, frame)
+
+
+def camera_problem(input_data_dict, error):
+    return {
+        'NetCmd': "NET_RESPONSE_PROBLEM",
+        'API': input_data_dict['API'],
+        'Camera': input_data_dict['Camera'],
+        'ParsingError': False,
+        'NetCmdError': False,
+        'APIError': False,
+        'SizeError': False,
+        'Status': "Camera problem",
+        'ErrorType': "Camera problem",
+        'ErrorDetails': str(error)}
+
+
+# -----------------------------------------------------------------------------------------------------------
+# NET_REQUEST_ACTION
+# Commands allowed: API_EXAMINE_PLATEN_PAGE, API_CHECK_PLATEN_PUNCH, API_EXAMINE_OUTFEED_PAGE, API_REBOOT
+# The examine/check actions run in the background (see action_jobs.py); the client gets ACK now and polls for results.
+# The platen analysis runs in the analysis worker processes (see analysis_pool.py); the outfeed analysis keeps its
+# background model in this process.
+
+registry.add(ACTION, "API_EXAMINE_PLATEN_PAGE", offloaded(examine_platen_page, keep_frame=archive_action_frame),
+             schema=EXAMINE_PLATEN_PAGE_SCHEMA, mode=ASYNC)
+registry.add(ACTION, "API_CHECK_PLATEN_PUNCH",
+             offloaded(check_platen_punch, keep_frame=archive_action_frame, page_size='page_size',
+                       template=current_template),     # built at API_START_HARDWARE; the workers don't rebuild it
+             schema=PAGE_ACTION_SCHEMA, mode=ASYNC)
+registry.add(ACTION, "API_EXAMINE_OUTFEED_PAGE", examine_outfeed_page, schema=PAGE_ACTION_SCHEMA, mode=ASYNC)
+
+
+@registry.register(ACTION, "API_REBOOT")
+def api_reboot(input_data_dict):
+    return {
+        'NetCmd': "NET_RESPONSE_ACK",
+        'API': "API_REBOOT",
+        'Camera': input_data_dict['Camera'],
+        'Reboot': True      # special flag that tells caller to reboot RPi after server ACK response sent over network
+    }   # Send back ack before we actually do the reboot.
+
+
+# -----------------------------------------------------------------------------------------------------------
+# NET_REQUEST_POLL / NET_REQUEST_ABORT
+# Command allowed: command used in a NET_REQUEST_ACTION that runs in the background
+
+def is_background_action(api_cmd):
+    entry = registry.lookup(ACTION, api_cmd)
+    return entry is not None and entry.mode == ASYNC
+
+
+@registry.register(POLL, ANY_API)
+def net_request_poll(input_data_dict):
+    if not is_background_action(input_data_dict["API"]):
+        return invalid_api_problem(input_data_dict)
+    return action_engine.poll(input_data_dict)
+
+
+@registry.register(ABORT, ANY_API)
+def net_request_abort(input_data_dict):
+    if not is_background_action(input_data_dict["API"]):
+        return invalid_api_problem(input_data_dict)
+    return action_engine.abort(input_data_dict)
+
+
+# -----------------------------------------------------------------------------------------------------------
+# NET_REQUEST_SUBSCRIBE
+# Command allowed: command used in a NET_REQUEST_ACTION that runs in the background
+# Instead of polling: the results are sent on this connection, without a request, as soon as the action finishes
+# (see action_jobs.py). Needs a server engine that can push (ServerTest3.py); the connection must stay open.
+
+@registry.register(SUBSCRIBE, ANY_API, session=True)
+def net_request_subscribe(input_data_dict, session):
+    if not is_background_action(input_data_dict["API"]):
+        return invalid_api_problem(input_data_dict)
+    if session is None:
+        return {
+            'NetCmd': "NET_RESPONSE_PROBLEM",
+            'API': input_data_dict['API'],
+            'Camera': input_data_dict['Camera'],
+            'ParsingError': False,
+            'NetCmdError': True,
+            'APIError': False,
+            'SizeError': False,
+            'Status': "Subscribe not available",
+            'ErrorType': "Subscribe not available",
+            'ErrorDetails': "NET_REQUEST_SUBSCRIBE needs a connection the server can send results on; use NET_REQUEST_POLL"}
+    subscription = session.subscription(input_data_dict["TS1"])
+    output_data_dict = action_engine.subscribe(input_data_dict, subscription.push)
+    if not output_data_dict.get('Subscribed'):
+        subscription.cancel()       # answered right away; nothing will be pushed
+    return output_data_dict
+
+
+# -----------------------------------------------------------------------------------------------------------
+# NET_REQUEST_BATCH
+# Command allowed: API_BATCH
+# Several requests in one round trip (e.g. API_EXAMINE_PLATEN_PAGE, API_CHECK_PLATEN_PUNCH and API_STATUS for a page).
+# 'Requests' is a list of request dictionaries, run in order exactly as if each had been sent on its own; a request
+# without Camera or TS1 uses the batch's. The NET_RESPONSE_BATCH has their responses, in the same order, in
+# 'Responses'; each has its own TS2/TS3 (when the server started and finished that request). A request that can't
+# be run gets a NET_RESPONSE_PROBLEM in its place; the others still run. Batches can't be nested.
+
+@registry.register(BATCH, "API_BATCH", schema=BATCH_SCHEMA, session=True)
+def api_batch(input_data_dict, session):
+    responses = []
+    for request_dict in input_data_dict['Requests']:
+        started = round(time.time(), 3)
+        output_data_dict = run_batch_request(input_data_dict, request_dict, session)
+        originated = input_data_dict["TS1"]
+        if type(request_dict) is dict:
+            originated = request_dict.get("TS1", originated)
+        output_data_dict["TS1"] = originated
+        output_data_dict["TS2"] = started
+        output_data_dict["TS3"] = round(time.time(), 3)
+        if 'Status' not in output_data_dict:
+            output_data_dict['Status'] = "[Not Implemented]"
+        output_data_dict['Response'] = True
+        responses.append(output_data_dict)
+    output_data_dict = {
+        'NetCmd': "NET_RESPONSE_BATCH",
+        'API': "API_BATCH",
+        'Camera': input_data_dict['Camera'],
+        'Responses': responses,
+        'Status': "Success"}
+    if any(response.get('Reboot') for response in responses):
+        output_data_dict['Reboot'] = True       # after the whole batch's response has been sent
+    return output_data_dict
+
+
+def run_batch_request(batch_dict, request_dict, session):
+    # one request of a NET_REQUEST_BATCH; same checks as the server does for a request on its own
+    if type(request_dict) is not dict:
+        return {
+            'NetCmd': "NET_RESPONSE_PROBLEM",
+            'API': 'N/A',
+            'Camera': 'N/A',
+            'ParsingError': True,
+            'NetCmdError': False,
+            'APIError': False,
+            'SizeError': False,
+            'ErrorType': "Client did not send dictionary",
+            'ErrorDetails': "Batch request item is not a dictionary"}
+    request_dict = dict(request_dict)
+    request_dict.setdefault("Camera", batch_dict["Camera"])
+    request_dict.setdefault("TS1", batch_dict["TS1"])
+    problems = "".join("Client request missing field: %s\n" % field
+                       for field in REQUEST_FIELDS if field not in request_dict)
+    if problems:
+        return {
+            'NetCmd': "NET_RESPONSE_PROBLEM",
+            'API': request_dict.get('API', 'N/A'),
+            'Camera': request_dict['Camera'],
+            'ParsingError': True,
+            'NetCmdError': False,
+            'APIError': False,
+            'SizeError': False,
+            'Status': "Missing Request field(s)",
+            'ErrorType': "Missing Client field(s)",
+            'ErrorDetails': problems}
+    if request_dict["NetCmd"] == BATCH:
+        return {
+            'NetCmd': "NET_RESPONSE_PROBLEM",
+            'API': request_dict['API'],
+            'Camera': request_dict['Camera'],
+            'ParsingError': False,
+            'NetCmdError': True,
+            'APIError': False,
+            'SizeError': False,
+            'ErrorType': "Invalid NetCmd",
+            'ErrorDetails': "NET_REQUEST_BATCH can't be sent inside a batch"}
+    return parse_net_cmd(request_dict, session)
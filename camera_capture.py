@@ -0,0 +1,356 @@
+# camera_capture.py
+#
+# Long-lived camera capture engine. API_START_HARDWARE starts it with the requested resolution/format and it keeps the
+# camera streaming in a background thread, so API_TAKE_PICTURE and the examine/check actions don't pay for opening,
+# configuring and closing the camera (hundreds of ms) on every request.
+#
+# Frames go into a small ring of NumPy buffers allocated once at start. Readers get the newest frame without a copy:
+#
+#       with capture_engine.latest_frame() as frame:
+#           frame.image         # read-only (height, width, 3) uint8 view of the ring buffer, RGB
+#           frame.frame_number, frame.timestamp
+#
+# While a reader holds a frame its buffer is "pinned" and the capture thread writes into the other buffers; release it
+# (leave the with block) promptly. If every buffer is pinned the capture thread drops frames (counted in 'dropped').
+#
+# Frame sources:
+#   PiCameraSource      the RPi camera, via picamera2
+#   FakeFrameSource     synthetic frames (or a given image), for testing without camera hardware
+# make_frame_source() picks the camera if picamera2 is installed, else the fake source.
+#
+# The ring buffers are allocated in shared memory (SHARED_FRAMES), so a frame can be handed to an analysis worker
+# process by name (Frame.shared_ref; see analysis_pool.py) instead of being copied or pickled. stop() frees the
+# buffers, except that a buffer still pinned (e.g. a worker process is reading it) is only unlinked when its last pin
+# is released; close() (at exit) frees everything.
+
+import atexit
+import threading
+import time
+from multiprocessing import shared_memory
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from picamera2 import Picamera2
+except ImportError:
+    Picamera2 = None
+
+RING_SIZE = 4           # frame buffers; readers can hold RING_SIZE - 2 frames and the camera still never stalls
+FRAME_TIMEOUT = 2.0     # seconds to wait for a frame before giving up
+FAKE_FPS = 15
+IMAGE_DIR = "/home/pi/ImpossibleObjects/images"     # where kept images go if common.build_image_filename() is missing
+SHARED_FRAMES = True    # ring buffers in shared memory, so analysis worker processes can read frames without a copy
+
+
+class CaptureError(Exception):
+    """Camera could not be started, or no frame is available"""
+    pass
+
+
+# -----------------------------------------------------------------------------------------------------------
+# Frame sources: open(width, height, image_format), read_into(buffer) -> timestamp, close()
+
+class FakeFrameSource:
+    # Synthetic platen: dark background with a white page in the middle, or a given image scaled to the frame size.
+    # Frames are delivered at about fps frames per second like a real camera.
+    def __init__(self, image=None, fps=FAKE_FPS):
+        self.image = image
+        self.fps = fps
+        self._base = None
+        self._next_time = 0.0
+
+    def open(self, width, height, image_format):
+        if self.image is not None:
+            src = np.asarray(self.image, dtype=np.uint8)
+            if src.ndim == 2:
+                src = np.repeat(src[:, :, np.newaxis], 3, axis=2)
+            # nearest-neighbor scaling with index arrays
+            rows = np.arange(height) * src.shape[0] // height
+            cols = np.arange(width) * src.shape[1] // width
+            self._base = np.ascontiguousarray(src[rows[:, np.newaxis], cols, :3])
+        else:
+            base = np.full((height, width, 3), 40, dtype=np.uint8)
+            top, left = height // 6, width // 6
+            base[top:height - top, left:width - left] = 235
+            self._base = base
+        self._next_time = time.monotonic()
+
+    def read_into(self, buffer):
+        delay = self._next_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self._next_time = max(self._next_time + 1.0 / self.fps, time.monotonic())
+        np.copyto(buffer, self._base)
+        return time.time()
+
+    def close(self):
+        self._base = None
+
+
+class PiCameraSource:
+    def __init__(self, camera_num=0):
+        self.camera_num = camera_num
+        self._camera = None
+
+    def open(self, width, height, image_format):
+        if Picamera2 is None:
+            raise CaptureError("picamera2 is not installed")
+        camera = Picamera2(self.camera_num)
+        camera.configure(camera.create_video_configuration(main={"size": (width, height), "format": "RGB888"}))
+        camera.start()
+        self._camera = camera
+
+    def read_into(self, buffer):
+        array = self._camera.capture_array("main")
+        timestamp = time.time()
+        # the camera may pad rows to an alignment boundary and add an alpha channel; copy just the picture
+        np.copyto(buffer, array[:buffer.shape[0], :buffer.shape[1], :3])
+        return timestamp
+
+    def close(self):
+        if self._camera is not None:
+            self._camera.stop()
+            self._camera.close()
+            self._camera = None
+
+
+def make_frame_source():
+    if Picamera2 is not None:
+        return PiCameraSource()
+    print("{S}: picamera2 not available; using fake frame source")
+    return FakeFrameSource()
+
+
+# -----------------------------------------------------------------------------------------------------------
+class _Slot:
+    def __init__(self, shape, shared):
+        self.shm = None
+        if shared:
+            self.shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+            self.buffer = np.ndarray(shape, dtype=np.uint8, buffer=self.shm.buf)
+        else:
+            self.buffer = np.empty(shape, dtype=np.uint8)
+        self.frame_number = 0
+        self.timestamp = 0.0
+        self.pins = 0
+        self.retired = False        # the engine stopped while this was pinned; free it when the last pin is released
+
+    def free(self):
+        self.buffer = None
+        if self.shm is not None:
+            self.shm.unlink()
+            try:
+                self.shm.close()
+            except BufferError:
+                pass    # a reader still has a Frame of it; the memory goes away when that is garbage collected
+            self.shm = None
+
+
+class Frame:
+    # A pinned ring buffer; call release() (or use as a context manager) when done with image
+    def __init__(self, engine, slot):
+        self._engine = engine
+        self._slot = slot
+        self.image = slot.buffer.view()
+        self.image.flags.writeable = False
+        self.frame_number = slot.frame_number
+        self.timestamp = slot.timestamp
+        # (shared memory name, shape) for handing the frame to another process, or None if not in shared memory
+        self.shared_ref = (slot.shm.name, slot.buffer.shape) if slot.shm is not None else None
+
+    def release(self):
+        if self._slot is not None:
+            slot, self._slot = self._slot, None
+            self.image = None       # before unpinning: the buffer may be freed then
+            self._engine._unpin(slot)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class CaptureEngine:
+    def __init__(self, source_factory=make_frame_source, ring_size=RING_SIZE, shared=SHARED_FRAMES):
+        self.source_factory = source_factory
+        self.ring_size = ring_size
+        self.shared = shared
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._source = None
+        self._slots = []
+        self._scratch = None        # frames that are dropped are read into here
+        self._latest = None
+        self._retired = []          # slots of a stopped ring still pinned by readers
+        self._frame_number = 0
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._control_lock = threading.RLock()     # one start()/stop() at a time
+        self.settings = None        # dictionary of the settings from API_START_HARDWARE while running
+        # stats
+        self.dropped = 0
+        self.errors = 0
+        self.last_error = None
+        self._started = 0.0
+        self._start_frame = 0
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, width, height, image_format, **settings):
+        """
+        (Re)start streaming at the given resolution. Extra keyword settings (e.g. page_size) are kept in self.settings.
+        Does nothing if already streaming with the same width/height/image_format, except update the settings.
+        """
+        if np is None:
+            raise CaptureError("numpy is not installed")
+        with self._control_lock:
+            self._start(width, height, image_format, settings)
+
+    def _start(self, width, height, image_format, settings):
+        settings = dict(settings, width=width, height=height, image_format=image_format)
+        if self.running and self.settings is not None and all(
+                self.settings[key] == settings[key] for key in ("width", "height", "image_format")):
+            self.settings = settings
+            return
+        self.stop()
+        source = self.source_factory()
+        try:
+            source.open(width, height, image_format)
+        except CaptureError:
+            raise
+        except Exception as e:
+            raise CaptureError("Unable to start camera: %s" % e)
+        # allocate the ring once; the capture thread only ever writes into these buffers
+        slots = [_Slot((height, width, 3), self.shared) for _ in range(self.ring_size)]
+        with self._lock:
+            self._source = source
+            self._slots = slots
+            self._scratch = np.empty((height, width, 3), dtype=np.uint8)
+            self._latest = None
+            self.settings = settings
+            self.dropped = 0
+            self.errors = 0
+            self.last_error = None
+            self._started = time.monotonic()
+            self._start_frame = self._frame_number
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._capture_loop, name="CaptureEngine", daemon=True)
+        self._thread.start()
+        print("{S}: Camera streaming %dx%d %s" % (width, height, image_format))
+
+    def stop(self):
+        with self._control_lock:
+            thread, self._thread = self._thread, None
+            if thread is None:
+                return
+            self._stop_event.set()
+            thread.join()
+            with self._cond:
+                self._source.close()
+                self._source = None
+                for slot in self._slots:
+                    if slot.pins:
+                        slot.retired = True     # freed by _unpin(); a reader (or worker process) still has it
+                        self._retired.append(slot)
+                    else:
+                        slot.free()
+                self._slots = []
+                self._latest = None
+                self.settings = None
+                self._cond.notify_all()     # wake readers waiting for a frame; they'll see the engine stopped
+
+    def close(self):
+        # stop(), and free the buffers still pinned too (the process is exiting)
+        self.stop()
+        with self._lock:
+            retired, self._retired = self._retired, []
+        for slot in retired:
+            slot.free()
+
+    def _free_slot(self):
+        # a buffer nobody is reading, other than the newest frame
+        for slot in self._slots:
+            if slot.pins == 0 and slot is not self._latest:
+                return slot
+        return None
+
+    def _capture_loop(self):
+        source = self._source
+        while not self._stop_event.is_set():
+            with self._lock:
+                slot = self._free_slot()
+            try:
+                if slot is None:
+                    # every buffer is being read; keep the camera stream moving but throw this frame away
+                    source.read_into(self._scratch)
+                    with self._lock:
+                        self.dropped += 1
+                    continue
+                timestamp = source.read_into(slot.buffer)
+            except Exception as e:
+                with self._lock:
+                    self.errors += 1
+                    self.last_error = str(e)
+                print("{S}: Camera capture error:", e)
+                self._stop_event.wait(0.5)
+                continue
+            with self._cond:
+                self._frame_number += 1
+                slot.frame_number = self._frame_number
+                slot.timestamp = timestamp
+                self._latest = slot
+                self._cond.notify_all()
+
+    def latest_frame(self, after=None, timeout=FRAME_TIMEOUT):
+        """
+        :param after: frame_number (or None); only return a frame captured later than this one, e.g. for a picture
+                      that must be taken after a request arrived
+        :return: pinned Frame of the newest buffer; release it when done
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                if not self.running:
+                    raise CaptureError("Camera not started (send API_START_HARDWARE)")
+                slot = self._latest
+                if slot is not None and (after is None or slot.frame_number > after):
+                    slot.pins += 1
+                    return Frame(self, slot)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise CaptureError("No frame from camera in %.1f seconds (%s)" % (timeout, self.last_error))
+                self._cond.wait(remaining)
+
+    def fresh_frame(self, timeout=FRAME_TIMEOUT):
+        # a frame captured after this call
+        return self.latest_frame(after=self._frame_number, timeout=timeout)
+
+    def _unpin(self, slot):
+        with self._lock:
+            slot.pins -= 1
+            if not (slot.retired and slot.pins == 0):
+                return
+            self._retired.remove(slot)
+        slot.free()
+
+    def stats(self):
+        with self._lock:
+            elapsed = time.monotonic() - self._started if self.running else 0.0
+            return {
+                'running': self.running,
+                'frames': self._frame_number,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'fps': round((self._frame_number - self._start_frame) / elapsed, 1) if elapsed > 0 else 0.0,
+                'pinned': sum(1 for slot in self._slots if slot.pins)}
+
+
+capture_engine = CaptureEngine()
+atexit.register(capture_engine.close)   # shared memory ring buffers outlive the process unless unlinked
+
@@ -0,0 +1,546 @@
+# camera_client.py
+#
+# Client side of the camera network protocol (what the printer's PC software uses to talk to the camera RPis), taken
+# out of ServerTest2.py; ServerTest2.client() is now a wrapper around the default CameraClient.
+#
+# A CameraClient is safe to share between the printer's control threads:
+#   - idle connections are pooled per (ip, port), up to MAX_IDLE_PER_ENDPOINT; a request takes one out of the pool
+#     (or opens one) for its own use and puts it back afterwards, so threads never share a socket and the connect
+#     cost is only paid when all pooled connections are busy
+#   - connections idle longer than POOL_IDLE_LIMIT are not reused; the server closes them after its IDLE_TIMEOUT
+#   - connecting and waiting for the response have separate timeouts: a camera that is down is noticed after
+#     connect_timeout (short) instead of the read_timeout a slow response may need
+#   - IMMEDIATE and POLL requests are retried (RETRIES times, with jittered exponential backoff) when the connection
+#     fails: refused, connect timeout, or the connection breaking before a response arrived. They are idempotent;
+#     ACTION and ABORT are not, so their failures are returned right away. A read timeout is not retried either:
+#     the camera is up but slow, and asking again would only stall the calling thread longer.
+#   - a pooled connection the server has already closed (its IDLE_TIMEOUT, a restart) is noticed and dropped before a
+#     request is sent on it. If a reused connection still breaks, the request is sent again on a fresh one only if it
+#     never got all the way out, or is idempotent: an ACTION or ABORT the server may have received is not repeated.
+#
+# fan_out() sends one request to several camera RPis at once (e.g. API_PING, API_STATUS, API_START_PRINT_JOB to the
+# Platen, Outfeed and Stacker cameras at startup). All the exchanges run together on non-blocking sockets from one
+# selector, so they take as long as the slowest camera (bounded by the deadline), not the sum of all of them.
+#
+# subscribe() waits for an action's results without polling: it sends NET_REQUEST_SUBSCRIBE on a connection of its
+# own and the server pushes the NET_RESPONSE_RESULTS on it as soon as the action finishes (see action_jobs.py).
+#
+# batch() sends several requests in one NET_REQUEST_BATCH round trip and returns their responses as a list.
+#
+# Responses are NET_RESPONSE_PROBLEM dictionaries (with 'Response': False) for every client-side failure, as before.
+
+import errno
+import random
+import selectors
+import socket
+import threading
+import time
+
+import net_codec
+import net_protocol
+
+MAX_FRAME_SIZE = net_protocol.MAX_FRAME_SIZE
+CONNECT_TIMEOUT = 1.0       # seconds to connect to a camera
+READ_TIMEOUT = 3.0          # seconds to wait for the response to a request
+MAX_IDLE_PER_ENDPOINT = 4   # idle connections kept per (ip, port)
+POOL_IDLE_LIMIT = 8.0       # seconds; a connection idle longer than this is closed instead of reused
+RETRIES = 2                 # extra attempts for an idempotent request whose connection failed
+RETRY_BACKOFF = 0.05        # seconds; attempt n waits a random time up to RETRY_BACKOFF * 2**n
+RESULTS_TIMEOUT = 30.0      # seconds subscribe() waits for an action's results to be pushed
+IDEMPOTENT = ("NET_REQUEST_IMMEDIATE", "NET_REQUEST_POLL")
+CAMERAS = ("Platen", "Outfeed", "Stacker")     # the camera RPis of one printer
+
+
+def problem(status, details=None):
+    # NET_RESPONSE_PROBLEM for something that went wrong on the client side
+    resp_dict = {
+        "NetCmd": "NET_RESPONSE_PROBLEM",
+        "Response": False,
+        "Status": status
+    }
+    if details is not None:
+        resp_dict["ErrorDetails"] = details
+    return resp_dict
+
+
+class _RequestFailed(Exception):
+    # retry: the request could not be sent, or the connection broke before a response came (safe to retry if the
+    # request is idempotent)
+    def __init__(self, response, retry=False):
+        Exception.__init__(self, response["Status"])
+        self.response = response
+        self.retry = retry
+
+
+# -----------------------------------------------------------------------------------------------------------
+class _ClientConnection:
+    # One open socket to the server, plus the frame reader (and its receive buffer) that goes with it
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = net_protocol.FrameReader(sock, MAX_FRAME_SIZE)
+        self.last_used = time.monotonic()
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def closed_by_server(self):
+        # True if the server has closed its side (or reset the connection) while it sat in the pool
+        try:
+            self.sock.setblocking(False)
+            try:
+                return self.sock.recv(1, socket.MSG_PEEK) == b""
+            finally:
+                self.sock.setblocking(True)
+        except BlockingIOError:
+            return False        # nothing to read: still open
+        except OSError:
+            return True
+
+
+class CameraClient:
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, retries=RETRIES,
+                 max_idle=MAX_IDLE_PER_ENDPOINT, codec=None):
+        """
+        :param codec: net_codec codec used for requests; default is msgpack if installed, else JSON (see net_codec.py)
+        """
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.max_idle = max_idle
+        self.codec = codec or net_codec.preferred_codec()
+        self._idle = {}             # (ip, port) -> list of idle _ClientConnection, most recently used last
+        self._json_only = set()     # (ip, port) of servers that don't have our codec
+        self._lock = threading.Lock()
+        # stats
+        self.connects = 0
+        self.reuses = 0
+        self.retried = 0
+
+    # -------------------------------------------------------------------------------------------------------
+    # Connection pool
+
+    def _checkout(self, endpoint):
+        now = time.monotonic()
+        stale = []
+        conn = None
+        with self._lock:
+            idle = self._idle.get(endpoint, [])
+            while idle:
+                candidate = idle.pop()
+                if now - candidate.last_used < POOL_IDLE_LIMIT and not candidate.closed_by_server():
+                    conn = candidate
+                    self.reuses += 1
+                    break
+                stale.append(candidate)
+        for candidate in stale:
+            candidate.close()
+        return conn
+
+    def _checkin(self, endpoint, conn):
+        conn.last_used = time.monotonic()
+        with self._lock:
+            idle = self._idle.setdefault(endpoint, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def _connect(self, endpoint):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(self.connect_timeout)
+        try:
+            sock.connect(endpoint)
+        except ConnectionRefusedError:
+            sock.close()
+            print("[C]: Connection refused!")
+            raise _RequestFailed(problem("Socket connection refused",
+                                         "Socket connection refused: %s / %s" % endpoint), retry=True)
+        except socket.timeout:
+            sock.close()
+            print("[C]: Socket timed out!")
+            raise _RequestFailed(problem("Socket connection timed out",
+                                         "Socket connection timed out: %s / %s" % endpoint), retry=True)
+        except OSError as e:
+            sock.close()
+            print("[C]: Unable to connect:", e)
+            raise _RequestFailed(problem("Socket connection failed", "%s / %s: %s" % (endpoint + (e,))), retry=True)
+        with self._lock:
+            self.connects += 1
+        return _ClientConnection(sock)
+
+    def close(self):
+        # Close all pooled connections, e.g. when the printer software shuts down
+        with self._lock:
+            conns = [conn for idle in self._idle.values() for conn in idle]
+            self._idle.clear()
+        for conn in conns:
+            conn.close()
+
+    # -------------------------------------------------------------------------------------------------------
+    def request(self, ip, port, message_dict, keep_alive=True, read_timeout=None, codec=None):
+        """
+        Send one request and wait for its response
+        :param keep_alive: False closes the connection afterwards instead of returning it to the pool
+        :param read_timeout: seconds to wait for this response instead of self.read_timeout
+        :param codec: codec for this request instead of self.codec
+        :return: response dictionary (with TS4, Delta1, Delta2 added), or a NET_RESPONSE_PROBLEM
+        """
+        if type(message_dict) is not dict:
+            return problem("Request was not a dictionary")
+        message_dict['TS1'] = round(time.time(), 3)       # when request sent out by client (PC clock)
+        endpoint = (ip, port)
+        attempts = 1 + (self.retries if message_dict.get('NetCmd') in IDEMPOTENT else 0)
+        for attempt in range(attempts):
+            if attempt:
+                time.sleep(random.uniform(0, RETRY_BACKOFF * 2 ** attempt))
+                with self._lock:
+                    self.retried += 1
+            try:
+                resp_bytes, resp_codec_id = self._exchange(endpoint, message_dict, keep_alive,
+                                                           read_timeout or self.read_timeout, codec or self.codec)
+                break
+            except _RequestFailed as e:
+                if not e.retry:
+                    return e.response
+                failure = e.response
+        else:
+            return failure
+        return self._decode_response(resp_bytes, resp_codec_id, message_dict)
+
+    def _exchange(self, endpoint, message_dict, keep_alive, read_timeout, codec):
+        # returns (response bytes, codec id); raises _RequestFailed
+        if endpoint in self._json_only:
+            codec = net_codec.JSON_CODEC
+        conn = self._checkout(endpoint) if keep_alive else None
+        reused = conn is not None
+        t1 = time.time()
+        while True:
+            if conn is None:
+                conn = self._connect(endpoint)
+
+            # turn dictionary into bytes (JSON or msgpack) so it can be sent to socket
+            out_bytes = codec.encode(message_dict)
+            if len(out_bytes) > MAX_FRAME_SIZE:
+                self._done(endpoint, conn, keep_alive)
+                raise _RequestFailed(problem("Request too large to send"))
+
+            sent = False
+            try:
+                conn.sock.settimeout(read_timeout)
+                net_protocol.send_frame(conn.sock, out_bytes, codec.codec_id)
+                sent = True
+                resp_bytes = conn.reader.read_frame()     # wait for server's response (this is blocking)
+            except socket.timeout:
+                conn.close()    # a late response would arrive out of step with the next request, so don't reuse it
+                print("[C]: THREW a timeout EXCEPTION waiting for a server response!!!")
+                print("[C]: Time Difference:", round(time.time() - t1, 2))
+                raise _RequestFailed(problem("Timeout occurred waiting for Response from server"))
+            except (net_protocol.FrameError, OSError) as e:
+                conn.close()
+                if reused and self._resend_safe(message_dict, sent):
+                    conn, reused = None, False
+                    continue
+                print("[C]: Error reading server response:", e)
+                raise _RequestFailed(problem("Error reading Response from server", str(e)), retry=True)
+            if resp_bytes is None:
+                conn.close()
+                if reused and self._resend_safe(message_dict, sent):
+                    conn, reused = None, False
+                    continue
+                print("[C]: Server closed connection without sending a response")
+                raise _RequestFailed(problem("Server closed connection without a Response"), retry=True)
+            if conn.reader.codec_id != codec.codec_id and codec is not net_codec.JSON_CODEC:
+                # The server doesn't have our codec and answered in JSON (with CodecError set); it never ran the
+                # request, so send it again in JSON and keep using JSON with this server.
+                print("[C]: Server does not support %s; using json" % codec.name)
+                with self._lock:
+                    self._json_only.add(endpoint)
+                codec = net_codec.JSON_CODEC
+                continue
+            resp_codec_id = conn.reader.codec_id
+            self._done(endpoint, conn, keep_alive)
+            return resp_bytes, resp_codec_id
+
+    @staticmethod
+    def _resend_safe(message_dict, sent):
+        # A kept-alive connection broke (the server closed it: idle timeout, restart). Sending the request again once
+        # on a fresh connection is safe if it never got all the way out (the server can't have run it), or if running
+        # it twice does no harm; otherwise the server may have started it, so its failure is returned instead.
+        return not sent or message_dict.get('NetCmd') in IDEMPOTENT
+
+    def _done(self, endpoint, conn, keep_alive):
+        if keep_alive:
+            self._checkin(endpoint, conn)
+        else:
+            conn.close()
+
+    # -------------------------------------------------------------------------------------------------------
+    def subscribe(self, ip, port, message_dict, timeout=RESULTS_TIMEOUT):
+        """
+        Wait for the results of an action the server pushes when it finishes, instead of polling for them
+        :param message_dict: names the action as for a NET_REQUEST_POLL (API, Camera, and job_id if known)
+        :param timeout: seconds to wait for the results after the server has ACKed the subscription
+        :return: the pushed response (NET_RESPONSE_RESULTS, or NAK if the action was aborted or dropped), or the
+                 server's answer if it didn't subscribe (results of an action already finished, NAK, PROBLEM)
+        """
+        if type(message_dict) is not dict:
+            return problem("Request was not a dictionary")
+        message_dict = dict(message_dict, NetCmd="NET_REQUEST_SUBSCRIBE", TS1=round(time.time(), 3))
+        endpoint = (ip, port)
+        codec = net_codec.JSON_CODEC if endpoint in self._json_only else self.codec
+        try:
+            # a connection of its own: the pushed frame must not be taken for the response to some other request
+            conn = self._connect(endpoint)
+        except _RequestFailed as e:
+            return e.response
+        try:
+            conn.sock.settimeout(self.read_timeout)
+            net_protocol.send_frame(conn.sock, codec.encode(message_dict), codec.codec_id)
+            resp_bytes = conn.reader.read_frame()
+            if resp_bytes is None:
+                return problem("Server closed connection without a Response")
+            resp_dict = self._decode_response(resp_bytes, conn.reader.codec_id, message_dict)
+            if not resp_dict.get('Subscribed'):
+                return resp_dict
+            conn.sock.settimeout(timeout)
+            resp_bytes = conn.reader.read_frame()
+            if resp_bytes is None:
+                return problem("Server closed connection without sending the results")
+            return self._decode_response(resp_bytes, conn.reader.codec_id, message_dict)
+        except socket.timeout:
+            print("[C]: Timed out waiting for results to be pushed")
+            return problem("Timeout occurred waiting for Response from server")
+        except (net_protocol.FrameError, OSError) as e:
+            print("[C]: Error reading server response:", e)
+            return problem("Error reading Response from server", str(e))
+        finally:
+            conn.close()
+
+    def batch(self, ip, port, requests, camera=None, read_timeout=None):
+        """
+        Send several requests in one NET_REQUEST_BATCH round trip; the server runs them in order
+        :param requests: list of request dictionaries (Camera may be left out if camera is given)
+        :param camera: Camera of the batch itself; default is the first request's
+        :return: list of response dictionaries in the order of requests (each of them the NET_RESPONSE_PROBLEM if the
+                 batch as a whole failed)
+        """
+        if camera is None:
+            camera = requests[0].get("Camera", "N/A") if requests and type(requests[0]) is dict else "N/A"
+        message_dict = {"NetCmd": "NET_REQUEST_BATCH", "API": "API_BATCH", "Camera": camera, "Requests": requests}
+        resp_dict = self.request(ip, port, message_dict, read_timeout=read_timeout)
+        if resp_dict.get('NetCmd') != "NET_RESPONSE_BATCH":
+            return [dict(resp_dict) for _ in requests]
+        for response in resp_dict['Responses']:
+            response['TS4'] = resp_dict['TS4']
+            response['Delta1'] = resp_dict['Delta1']
+            response['Delta2'] = round(response['TS3'] - response['TS2'], 3)
+        return resp_dict['Responses']
+
+    def fan_out(self, cameras, message_dict, deadline=None):
+        """
+        Send message_dict to every camera at the same time and wait for all the responses
+        :param cameras: dictionary of camera name ("Platen", ...) -> (ip, port); each gets a copy of message_dict
+                        with its name as 'Camera'
+        :param deadline: seconds each camera has to connect and respond (default connect_timeout + read_timeout);
+                         a camera that takes longer gets a NET_RESPONSE_PROBLEM, the others are not held up
+        :return: dictionary of camera name -> response dictionary
+        """
+        if type(message_dict) is not dict:
+            return {camera: problem("Request was not a dictionary") for camera in cameras}
+        if deadline is None:
+            deadline = self.connect_timeout + self.read_timeout
+        selector = selectors.DefaultSelector()
+        exchanges = []
+        for camera, endpoint in cameras.items():
+            request_dict = dict(message_dict, Camera=camera, TS1=round(time.time(), 3))
+            exchange = _FanOutExchange(self, camera, tuple(endpoint), request_dict, time.monotonic() + deadline)
+            exchanges.append(exchange)
+            exchange.start(selector)
+        try:
+            while True:
+                pending = [exchange for exchange in exchanges if exchange.response is None]
+                if not pending:
+                    break
+                now = time.monotonic()
+                for exchange in pending:
+                    if now >= exchange.deadline:
+                        exchange.timed_out(selector)
+                remaining = [exchange.deadline - now for exchange in pending if exchange.response is None]
+                if not remaining:
+                    break
+                for key, _ in selector.select(max(0.0, min(remaining))):
+                    key.data.on_ready(selector)
+        finally:
+            selector.close()
+        return {exchange.camera: exchange.response for exchange in exchanges}
+
+    @staticmethod
+    def _decode_response(resp_bytes, resp_codec_id, message_dict):
+        # decode the response in whatever codec the server says it used
+        resp_codec = net_codec.get_codec(resp_codec_id) or net_codec.JSON_CODEC
+        try:
+            resp_dict = resp_codec.decode(resp_bytes)
+        except ValueError:      # json.JSONDecodeError, net_codec.DecodeError
+            # Server returned something that was not valid json (or msgpack); this should not happen
+            print("[C]: Error: client received something that is not a valid message (not valid %s)" % resp_codec.name)
+            print("[C]: Client received from server:", resp_bytes)
+            return {"Status": "Error: Server response was not a valid message (not valid %s)" % resp_codec.name}
+
+        if type(resp_dict) is not dict:
+            print("[C]: **Client received a message from the server that did not evaluate to a dictionary")
+            print("[C]: ", type(resp_dict))
+            print("[C]: ", resp_dict)
+            return {"Status": "Error: Server response did not evaluate to a dictionary"}
+
+        if 'NetCmd' not in resp_dict:   # this shouldn't happen either
+            print("[C]: **Client received a dictionary response from the server that did not include a 'NetCmd' field; cannot parse")
+            print(resp_dict)
+            return {"Status": "Error: Server response did not contain 'NetCmd' field so unable to understand it"}
+
+        received = round(time.time(), 3)
+        resp_dict['TS4'] = received      # when response received by client (PC clock)
+        resp_dict['Delta1'] = round(received - message_dict['TS1'], 3)    # time from client sent request to receive response
+        resp_dict['Delta2'] = round(resp_dict['TS3'] - resp_dict['TS2'], 3)   # time server spend processing the request
+        return resp_dict
+
+    def stats(self):
+        with self._lock:
+            return {
+                'idle_connections': sum(len(idle) for idle in self._idle.values()),
+                'connects': self.connects,
+                'reuses': self.reuses,
+                'retried': self.retried}
+
+
+class _FanOutExchange:
+    # One request/response of a fan_out() on a non-blocking socket: connect, send the frame, read the response frame
+    def __init__(self, client, camera, endpoint, message_dict, deadline):
+        self.client = client
+        self.camera = camera
+        self.endpoint = endpoint
+        self.message_dict = message_dict
+        self.deadline = deadline
+        self.response = None
+        self.conn = None
+        self.reused = False
+        self.connected = False
+        self.codec = net_codec.JSON_CODEC if endpoint in client._json_only else client.codec
+        self._out = None            # rest of the request frame still to send
+        self._received = bytearray()
+
+    def start(self, selector, fresh=False):
+        out_bytes = self.codec.encode(self.message_dict)
+        if len(out_bytes) > MAX_FRAME_SIZE:
+            self.response = problem("Request too large to send")
+            return
+        self.conn = None if fresh else self.client._checkout(self.endpoint)
+        self.reused = self.connected = self.conn is not None
+        if self.conn is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            result = sock.connect_ex(self.endpoint)
+            if result not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                sock.close()
+                self.response = self._connect_problem(OSError(result, errno.errorcode.get(result, "")))
+                return
+            self.conn = _ClientConnection(sock)
+            with self.client._lock:
+                self.client.connects += 1
+        else:
+            self.conn.sock.setblocking(False)
+        self._out = memoryview(net_protocol.encode_frame(out_bytes, self.codec.codec_id))
+        self._received = bytearray()
+        selector.register(self.conn.sock, selectors.EVENT_WRITE, self)
+
+    def on_ready(self, selector):
+        sock = self.conn.sock
+        try:
+            if self._out is not None:
+                if not self.connected:
+                    error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if error:
+                        self.fail(selector, self._connect_problem(OSError(error, errno.errorcode.get(error, ""))))
+                        return
+                sent = sock.send(self._out)
+                self.connected = True
+                self._out = self._out[sent:] if sent < len(self._out) else None
+                if self._out is None:
+                    selector.modify(sock, selectors.EVENT_READ, self)
+                return
+            data = sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            if not self.connected:
+                self.fail(selector, self._connect_problem(e))
+            else:
+                self._broken(selector, problem("Error reading Response from server", str(e)))
+            return
+        if not data:
+            self._broken(selector, problem("Server closed connection without a Response"))
+            return
+        self._received += data
+        if len(self._received) < net_protocol.HEADER_SIZE:
+            return
+        length, codec_id = net_protocol.HEADER.unpack_from(self._received)
+        if length > MAX_FRAME_SIZE:
+            self.fail(selector, problem("Error reading Response from server",
+                                        str(net_protocol.FrameTooLarge(length, MAX_FRAME_SIZE))))
+            return
+        if len(self._received) < net_protocol.HEADER_SIZE + length:
+            return
+        resp_bytes = bytes(self._received[net_protocol.HEADER_SIZE:net_protocol.HEADER_SIZE + length])
+        selector.unregister(sock)
+        sock.setblocking(True)
+        sock.settimeout(self.client.read_timeout)       # back to how request() uses pooled connections
+        self.client._checkin(self.endpoint, self.conn)
+        self.conn = None
+        if codec_id != self.codec.codec_id and self.codec is not net_codec.JSON_CODEC:
+            # The server doesn't have our codec and answered in JSON (with CodecError set); it never ran the
+            # request, so send it again in JSON
+            with self.client._lock:
+                self.client._json_only.add(self.endpoint)
+            self.codec = net_codec.JSON_CODEC
+            self.start(selector)
+            return
+        self.response = self.client._decode_response(resp_bytes, codec_id, self.message_dict)
+
+    def _broken(self, selector, response):
+        if self.reused and not self._received and CameraClient._resend_safe(self.message_dict, self._out is None):
+            # see CameraClient._resend_safe()
+            selector.unregister(self.conn.sock)
+            self.conn.close()
+            self.start(selector, fresh=True)
+            return
+        self.fail(selector, response)
+
+    def _connect_problem(self, error):
+        if isinstance(error, ConnectionRefusedError):
+            return problem("Socket connection refused", "Socket connection refused: %s / %s" % self.endpoint)
+        return problem("Socket connection failed", "%s / %s: %s" % (self.endpoint + (error,)))
+
+    def timed_out(self, selector):
+        if self.connected:
+            self.fail(selector, problem("Timeout occurred waiting for Response from server"))
+        else:
+            self.fail(selector, problem("Socket connection timed out",
+                                        "Socket connection timed out: %s / %s" % self.endpoint))
+
+    def fail(self, selector, response):
+        if self.conn is not None:
+            selector.unregister(self.conn.sock)
+            self.conn.close()   # a late response would arrive out of step with the next request, so don't reuse it
+            self.conn = None
+        print("[C]: %s: %s" % (self.camera, response["Status"]))
+        self.response = response
+
+
+default_client = CameraClient()
+
+
+def fan_out(cameras, message_dict, deadline=None):
+    # CameraClient.fan_out() with the default client
+    return default_client.fan_out(cameras, message_dict, deadline)
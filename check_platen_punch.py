@@ -1,5 +1,140 @@
 # check_platen_punch.py
+#
+# Punch check for API_CHECK_PLATEN_PUNCH: are the registration holes punched in the page on the platen?
+#
+# Where the holes are depends only on the page size (API_START_HARDWARE page_size, e.g. "12x8") and the camera
+# resolution, so everything geometric is worked out once per (page_size, width, height) and cached:
+# for each hole a small region of the frame, a disk mask for the hole itself and a ring mask for the paper around it.
+# API_START_HARDWARE builds the templates for the new settings (prepare_templates()), so a punch check only has to
+# compare the mean brightness of a few small regions: the hole shows the dark platen through the paper.
+# The check runs in the analysis worker processes (analysis_pool.py), whose caches are their own; the server passes
+# them the template it already built (current_template()) with each check, so no worker builds one itself.
+#
+# Geometry: the camera sees PLATEN_VIEW inches of platen; the page's top left corner sits at PAGE_ORIGIN (inches from
+# the top left of the view) and the holes are PUNCH_INSET inches in from the page's left edge, at PUNCH_POSITIONS
+# (fractions of the page height).
 
-def check_platen_punch(input_data_dict):
-    # TODO
-    return input_data_dict  # TODO: change this!!!!
+import functools
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from camera_capture import capture_engine, CaptureError
+
+PLATEN_VIEW = (16.0, 12.0)      # width, height (inches) of platen seen by the camera
+PAGE_ORIGIN = (1.0, 1.0)        # top left corner of the page (inches from top left of the view)
+PUNCH_INSET = 0.5               # hole centers from the page's left edge, inches
+PUNCH_POSITIONS = (0.2, 0.5, 0.8)   # hole centers down the page, fraction of page height
+PUNCH_DIAMETER = 0.25           # inches
+RING_WIDTH = 0.15               # width of the ring of paper around a hole used as reference, inches
+MIN_HOLE_CONTRAST = 40          # gray levels by which a hole must be darker than the paper around it
+
+
+def parse_page_size(page_size):
+    # "12x8" -> (12.0, 8.0) inches
+    width, height = page_size.lower().split("x")
+    return float(width), float(height)
+
+
+class PunchTemplate:
+    # Precomputed regions and masks for one page size at one camera resolution
+    def __init__(self, page_size, width, height):
+        page_width, page_height = parse_page_size(page_size)
+        scale_x = width / PLATEN_VIEW[0]
+        scale_y = height / PLATEN_VIEW[1]
+        radius = PUNCH_DIAMETER / 2
+        outer = radius + RING_WIDTH
+        self.page_size = page_size
+        self.width, self.height = width, height
+        self.holes = []     # (center x, center y, rows slice, cols slice, hole mask, ring mask)
+        for position in PUNCH_POSITIONS:
+            center_x = (PAGE_ORIGIN[0] + PUNCH_INSET) * scale_x
+            center_y = (PAGE_ORIGIN[1] + position * page_height) * scale_y
+            x0, x1 = int(center_x - outer * scale_x), int(center_x + outer * scale_x) + 1
+            y0, y1 = int(center_y - outer * scale_y), int(center_y + outer * scale_y) + 1
+            if x0 < 0 or y0 < 0 or x1 > width or y1 > height:
+                raise ValueError("Punch hole for page size %s is outside the camera view" % page_size)
+            # distance of every pixel of the region from the hole center, in inches
+            yy, xx = np.mgrid[y0:y1, x0:x1]
+            distance = np.hypot((xx + 0.5 - center_x) / scale_x, (yy + 0.5 - center_y) / scale_y)
+            hole = distance <= radius * 0.8         # stay clear of the hole's edge
+            ring = (distance >= radius * 1.3) & (distance <= outer)
+            self.holes.append((round(center_x, 1), round(center_y, 1), slice(y0, y1), slice(x0, x1), hole, ring))
+        self.page_width, self.page_height = page_width, page_height
+
+    def check(self, image):
+        """
+        :param image: (height, width, 3) RGB or (height, width) gray frame at this template's resolution
+        :return: list of dictionaries, one per hole: x, y, found, contrast
+        """
+        punches = []
+        for center_x, center_y, rows, cols, hole, ring in self.holes:
+            region = image[rows, cols]
+            if region.ndim == 3:
+                region = region[..., 1]     # green is close enough to brightness for dark-vs-white
+            contrast = float(region[ring].mean()) - float(region[hole].mean())
+            punches.append({
+                'x': center_x,
+                'y': center_y,
+                'found': contrast >= MIN_HOLE_CONTRAST,
+                'contrast': round(contrast, 1)})
+        return punches
+
+
+@functools.lru_cache(maxsize=8)
+def get_template(page_size, width, height):
+    return PunchTemplate(page_size, width, height)
+
+
+def prepare_templates(page_size, width, height):
+    # called when the hardware starts, so the first punch check doesn't pay for building the template
+    if np is not None:
+        get_template(page_size, width, height)
+
+
+def current_template(settings):
+    # template for the API_START_HARDWARE settings, from this process's cache (filled by prepare_templates())
+    if np is None or not settings.get('page_size'):
+        return None
+    return get_template(settings['page_size'], settings['width'], settings['height'])
+
+
+def check_platen_punch(input_data_dict, abort_event=None, image=None, page_size=None, template=None):
+    """
+    Runs in the background (see action_jobs.py); returns dictionary of result fields for NET_RESPONSE_RESULTS
+    :param image: RGB frame to check instead of a camera frame
+    :param page_size: page size when checking a given image; otherwise the one from API_START_HARDWARE
+    :param template: PunchTemplate already built for page_size at the image's resolution (used if it matches)
+    """
+    if np is None:
+        raise CaptureError("numpy is not installed")
+    if image is not None:
+        results = _check(image, page_size, input_data_dict, template)
+    else:
+        settings = capture_engine.settings or {}
+        with capture_engine.fresh_frame() as frame:
+            results = _check(frame.image, page_size or settings.get('page_size'), input_data_dict, template)
+            results['frame_number'] = frame.frame_number
+    results['page_num'] = input_data_dict['page_num']
+    return results
+
+
+def _check(image, page_size, input_data_dict, template=None):
+    if input_data_dict.get('image_only', False):
+        return {'image_only': True}
+    if not page_size:
+        raise ValueError("No page_size; send API_START_HARDWARE first")
+    started = time.perf_counter()
+    height, width = image.shape[:2]
+    if template is None or (template.page_size, template.width, template.height) != (page_size, width, height):
+        template = get_template(page_size, width, height)
+    punches = template.check(image)
+    found = sum(1 for punch in punches if punch['found'])
+    return {
+        'punch_ok': found == len(punches),
+        'punches_found': found,
+        'punches': punches,
+        'analysis_ms': round(1000 * (time.perf_counter() - started), 2)}
@@ -6,59 +6,78 @@ import time
 import datetime
 import os
 #from ioutils.camera_api_constants import *     # this provides camera error constants and helper funcs
-import subprocess
+from rpi_status import status_collector
 
 # ??? MAYBE PUT log_event IN HERE AS WELL????
 
 
-def build_image_filename(pycam_info, user_obj):
-
-    flavor_suffix = ""
-    try:
-        api = user_obj['API']
-        if api == "API_EXAMINE_PLATEN_PAGE":      # 1010
-            flavor_suffix = "__A"
-        elif api == "API_CHECK_PLATEN_PUNCH":     # 1012
-            flavor_suffix = "__B"
-        elif api == "API_EXAMINE_OUTFEED_PAGE":   # 1011
-            flavor_suffix = ""      # don't use for outfeed images
-        else:
-            flavor_suffix = "__M"  # menu used to take an image
-        # Why these letters? Because Examine/Punch images follow each other, so a/b in filenames; others will
-        # be by themselves, so to tell them apart give then next letter.
-    except:
-        pass
+# image filename suffix for the API the image was taken for; other APIs (menu used to take an image) get "__M"
+# Why these letters? Because Examine/Punch images follow each other, so a/b in filenames; others will
+# be by themselves, so to tell them apart give then next letter.
+FLAVOR_SUFFIXES = {
+    "API_EXAMINE_PLATEN_PAGE": "__A",     # 1010
+    "API_CHECK_PLATEN_PUNCH": "__B",      # 1012
+    "API_EXAMINE_OUTFEED_PAGE": "",       # 1011  don't use for outfeed images
+}
+MAX_CACHED_DIRS = 32        # (day, camera) directories an ImageFilenameBuilder remembers
 
-    local_path = get_data_subpath("camera")
 
-    # use "ts1" as timestamp for filename, unless it is unreasonably old, in which case use current timestamp
-    now = datetime.datetime.fromtimestamp(user_obj["ts1"])
-    raw_time = user_obj["ts1"]
-    yesterday = time.time() - 86400
-    tomorrow = time.time() + 86400
-    if raw_time < yesterday or raw_time > tomorrow:
-        print("Unreasonable value ts1")
-        now = datetime.datetime.now()
-    datestamp = now.strftime("%Y-%m-%d")
+def image_archive_root():
+    # directory the archived images of every build are under
+    return get_data_subpath("camera")
 
-    if 'build_id' in user_obj and isinstance(user_obj['build_id'],int):
-        build_id_str = "Build_%d" % user_obj['build_id']
-    else:
-        build_id_str = "General"
 
-    if 'page_num' in user_obj and isinstance(user_obj['page_num'],int):
-        page_str = "pg-%04d" % user_obj['page_num']
-        timestamp = now.strftime("__%H-%M-%S")
-    else:
-        page_str = ''
-        timestamp = now.strftime("%H-%M-%S")
-
-    image_suffix = pycam_info.image_format
+class ImageFilenameBuilder:
+    """
+    Image filenames for one print job:  <camera data dir>/Build_<build_id>/<YYYY-MM-DD>/<camera_name>/<file>
+    where <file> is pg-0001__HH-MM-SS__A.jpg (or HH-MM-SS__M.jpg when there is no page_num).
+    The directory part only changes with the day and camera, so it is worked out (and created) once and reused;
+    each image only formats its page/time/suffix.
+    """
+    def __init__(self, build_id=None):
+        if isinstance(build_id, int):
+            build_id_str = "Build_%d" % build_id
+        else:
+            build_id_str = "General"
+        self.build_dir = os.path.join(image_archive_root(), build_id_str)
+        self._dirs = {}         # (date, camera_name) -> directory, already created
+
+    def build(self, pycam_info, user_obj):
+        api = user_obj.get('API')
+        flavor_suffix = FLAVOR_SUFFIXES.get(api, "__M") if api is not None else ""
+
+        # use "ts1" as timestamp for filename, unless it is unreasonably old, in which case use current timestamp
+        raw_time = user_obj["ts1"]
+        current = time.time()
+        if raw_time < current - 86400 or raw_time > current + 86400:
+            print("Unreasonable value ts1")
+            raw_time = current
+        now = datetime.datetime.fromtimestamp(raw_time)
+
+        page_num = user_obj.get('page_num')
+        if isinstance(page_num, int):
+            filename = "pg-%04d__%02d-%02d-%02d%s.%s" % (page_num, now.hour, now.minute, now.second, flavor_suffix,
+                                                        pycam_info.image_format)
+        else:
+            filename = "%02d-%02d-%02d%s.%s" % (now.hour, now.minute, now.second, flavor_suffix,
+                                                pycam_info.image_format)
+        return os.path.join(self._directory(now.date(), pycam_info.camera_name), filename)
+
+    def _directory(self, day, camera_name):
+        key = (day, camera_name)
+        directory = self._dirs.get(key)
+        if directory is None:
+            directory = os.path.join(self.build_dir, day.strftime("%Y-%m-%d"), camera_name)
+            os.makedirs(directory, exist_ok=True)
+            if len(self._dirs) >= MAX_CACHED_DIRS:
+                self._dirs.clear()
+            self._dirs[key] = directory
+        return directory
 
-    filename = "%s%s%s.%s" % (page_str, timestamp, flavor_suffix, image_suffix)
-    full_name = os.path.join(local_path, build_id_str, datestamp,  pycam_info.camera_name, filename)
 
-    return full_name
+def build_image_filename(pycam_info, user_obj):
+    # One-off filename (and its directory is created); for the images of a print job keep an ImageFilenameBuilder
+    return ImageFilenameBuilder(user_obj.get('build_id')).build(pycam_info, user_obj)
 
 
 def build_rpi_info(detail):
@@ -68,89 +87,28 @@ def build_rpi_info(detail):
 
     Note: detail & 1 is for Outfeed camera thread info; that is handled elsewhere
 
+    The values come from the background status collector (see rpi_status.py, proc_probe.py); no programs are forked.
+    They are collected on the calling thread only if never collected before or out of date. The dictionary also includes
+    status_age = {field: seconds since that field was collected}
+
     if detail & 2
-        disk_usage = string     # from: df -h
-        uptime = string         # from: uptime
+        disk_usage = string     # like: df -h (root file system, from os.statvfs)
+        uptime = string         # like: uptime (from /proc/uptime, /proc/loadavg)
+        disk_total, disk_used, disk_free = number of bytes; disk_percent = number
+        uptime_seconds = number; load_avg = [1 min, 5 min, 15 min]
     if detail & 4
-        cpu_temp = string       # from: vcgencmd measure_temp
-        top = string            # from: top -1 -b
+        watchdog_count = number  # lines in /home/pi/ImpossibleObjects/watchdog/watchdog.log (-999 if unreadable)
+        watchdog_recent = string # last 5 lines of /home/pi/ImpossibleObjects/watchdog/watchdog.log
     if detail & 8
-        debian = string         # from: cat /etc/debian (version of Debian running)
-        release = string        # from: cat /etc/os-release (OS release notes)
-        kernal = string         # from: uname -a
+        cpu_temp = string       # like: vcgencmd measure_temp (from /sys/class/thermal)
+        top = string            # like: top -n 1 -b (from /proc)
+        cpu_temp_c = number or None; cpu_percent = number; mem_total_kb, mem_available_kb = number
     if detail & 16
-        processes = string      # from: ps -ef
+        debian = string         # from: /etc/debian (version of Debian running)
+        release = string        # from: /etc/os-release (OS release notes)
+        kernal = string         # like: uname -a
     if detail & 32
-        watchdog_count = number  # from: wc -l /home/pi/ImpossibleObjects/watchdog/watchdog.log
-        watchdog_recent = number # from: tail -5 /home/pi/ImpossibleObjects/watchdog/watchdog.log
+        processes = string      # like: ps -ef (from /proc)
+        process_count = number
     """
-    info_dict = {}
-
-    if detail & 2:
-        bash_cmd = ["df","-h"]
-        process = subprocess.Popen(bash_cmd, stdout=subprocess.PIPE)
-        output, error = process.communicate()
-        info_dict["disk_usage"] = output.decode("utf-8")
-
-        bash_cmd = ["uptime",]
-        process = subprocess.Popen(bash_cmd, stdout=subprocess.PIPE)
-        output, error = process.communicate()
-        info_dict["uptime"] = output.decode("utf-8")
-
-    if detail & 4:
-        # This is how many times the watchdog timer has restarted; this includes power-up as well as reboot cmds
-        # It can be watched over time to see how often the watchdog runs. Note that the watchdog can be triggered
-        # to reboot the RPi via GPIO signal. (It is also possible to reboot the RPi using a network message from
-        # the client; however this is not recorded as a watchdog event.) In the future the hardware will be able
-        # to power cycle the RPi to insure it reboots, but this is in the future.
-        bash_cmd = ["wc","-l","/home/pi/ImpossibleObjects/watchdog/watchdog.log"]
-        process = subprocess.Popen(bash_cmd, stdout=subprocess.PIPE)
-        output, error = process.communicate()
-        num_value = -999    # flag in case of problem
-        if len(output) > 0:
-            tup = output.split(' ')     # return string looks like: '47 watchdog.log'
-            value = tup[0]
-            if type(value) == int:
-                num_value = int(value)
-        info_dict["watchdog_count"] = num_value
-
-        # This lists the five most recent times the watchdog restarted
-        bash_cmd = ["tail","-5","/home/pi/ImpossibleObjects/watchdog/watchdog.log"]
-        process = subprocess.Popen(bash_cmd, stdout=subprocess.PIPE)
-        output, error = process.communicate()
-        info_dict["watchdog_recent"] = output.decode("utf-8")
-
-    if detail & 8:
-        bash_cmd = ["vcgencmd", "measure_temp"]
-        process = subprocess.Popen(bash_cmd, stdout=subprocess.PIPE)
-        output, error = process.communicate()
-        info_dict["cpu_temp"] = output.decode("utf-8")
-
-        bash_cmd = ["top","-n", "1", "-b"]
-        process = subprocess.Popen(bash_cmd, stdout=subprocess.PIPE)
-        output, error = process.communicate()
-        info_dict["top"] = output.decode("utf-8")
-
-    if detail & 16:
-        bash_cmd = ["cat","/etc/debian"]
-        process = subprocess.Popen(bash_cmd, stdout=subprocess.PIPE)
-        output, error = process.communicate()
-        info_dict["debian"] = output.decode("utf-8")
-
-        bash_cmd = ["cat","/etc/os-release"]
-        process = subprocess.Popen(bash_cmd, stdout=subprocess.PIPE)
-        output, error = process.communicate()
-        info_dict["release"] = output.decode("utf-8")
-
-        bash_cmd = ["uname","-a"]
-        process = subprocess.Popen(bash_cmd, stdout=subprocess.PIPE)
-        output, error = process.communicate()
-        info_dict["kernal"] = output.decode("utf-8")
-
-    if detail & 32:
-        bash_cmd = ["ps","-ef"]
-        process = subprocess.Popen(bash_cmd, stdout=subprocess.PIPE)
-        output, error = process.communicate()
-        info_dict["processes"] = output.decode("utf-8")
-
-    return info_dict
\ No newline at end of file
+    return status_collector.get(detail)
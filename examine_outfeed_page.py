@@ -1,5 +1,260 @@
 # examine_outfeed_page.py
+#
+# Outfeed check for API_EXAMINE_OUTFEED_PAGE. The outfeed camera looks at the moving rear conveyor, so instead of
+# analysing every frame from scratch the OutfeedAnalyzer keeps state across frames:
+#   - a background model of the empty conveyor (running average, updated only outside the page)
+#   - the previous frame, to find which tiles (TILE x TILE pixel blocks of the downsampled frame) changed
+#   - the per-tile page/dark classification, which is only redone for tiles that changed
+# A page shows up as tiles that differ from the background; the page region is those tiles with the gaps between them
+# filled in (a large ink blot can look like conveyor). Defects are tiles with dark spots (dark compared to the paper)
+# in the interior of the page region, so the conveyor showing at the page's edge is not taken for a defect, while
+# ink as dark as the conveyor still is.
+#
+# The background model starts from an empty conveyor: API_REAR_CONVEYOR with conveyor_empty calls calibrate() with
+# the next frame. Without that, the first frame analysed is used, and a page that was on the conveyor then is part of
+# the background and is not found; the results say 'calibrated': False until calibrate() has been called.
+#
+# While the conveyor runs (API_REAR_CONVEYOR action 1) the OutfeedMonitor feeds it every camera frame in a background
+# thread, so the background model stays current and an examine request just picks up the next analysed frame.
+# With the conveyor stopped, an examine request analyses one fresh frame.
 
-def examine_outfeed_page(input_data_dict):
-    # TODO
-    return input_data_dict  # TODO: change this!!!!
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from camera_capture import capture_engine, CaptureError, FRAME_TIMEOUT
+
+ANALYSIS_SIZE = 320         # longer side of the downsampled frame, pixels
+TILE = 8                    # tile size in downsampled pixels
+BACKGROUND_RATE = 0.05      # how fast the background model follows the empty conveyor (0-1 per frame)
+MOTION_THRESHOLD = 6.0      # mean gray level change of a tile since the previous frame that counts as changed
+FOREGROUND_THRESHOLD = 30   # gray level difference from the background that counts as "not conveyor"
+PAGE_TILE_FRACTION = 0.5    # a tile is page if this fraction of its pixels are foreground
+MIN_PAGE_TILES = 12         # fewer page tiles than this is noise, not a page
+DEFECT_DELTA = 60           # gray levels darker than the paper that count as a defect
+DEFECT_TILE_FRACTION = 0.1  # a page tile is defective if this fraction of its pixels are that dark
+MAX_DEFECTS_REPORTED = 10
+
+
+class OutfeedAnalyzer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._background = None     # float32 downsampled gray of the empty conveyor
+        self._previous = None       # float32 downsampled gray of the previous frame
+        self._page_tiles = None     # bool per tile
+        self._dark_tiles = None     # bool per tile: has dark spots compared to the paper
+        self._defect_tiles = None   # bool per tile
+        self._step = 1
+        self._last_center = None
+        self._last_time = None
+        self.frames = 0
+        self.calibrated = False     # background taken from an empty conveyor (calibrate())
+
+    def calibrate(self, image):
+        # image is a frame of the empty conveyor: start the background model from it
+        gray, step = self._gray(image)
+        with self._lock:
+            self._start(gray, step)
+            self.calibrated = True
+
+    def _start(self, gray, step):
+        # called with self._lock held
+        self.reset()
+        self._background = gray.copy()
+        self._previous = gray
+        self._step = step
+        shape = (gray.shape[0] // TILE, gray.shape[1] // TILE)
+        self._page_tiles = np.zeros(shape, dtype=bool)
+        self._dark_tiles = np.zeros(shape, dtype=bool)
+        self._defect_tiles = np.zeros(shape, dtype=bool)
+
+    def _gray(self, image):
+        # downsampled (strided view) gray, cropped to whole tiles
+        height, width = image.shape[:2]
+        step = max(1, -(-max(width, height) // ANALYSIS_SIZE))
+        small = image[::step, ::step]
+        rows = small.shape[0] // TILE * TILE
+        cols = small.shape[1] // TILE * TILE
+        small = small[:rows, :cols]
+        if small.ndim == 3:
+            gray = small[..., 0] * np.float32(0.299) + small[..., 1] * np.float32(0.587) + \
+                   small[..., 2] * np.float32(0.114)
+        else:
+            gray = small.astype(np.float32)
+        return gray, step
+
+    @staticmethod
+    def _tiles(array):
+        # (tile rows, tile cols, TILE, TILE) view of a 2D array
+        rows, cols = array.shape
+        return array.reshape(rows // TILE, TILE, cols // TILE, TILE).swapaxes(1, 2)
+
+    def update(self, image, timestamp=None):
+        """
+        Add one frame and return the analysis of it (see _results())
+        """
+        gray, step = self._gray(image)
+        with self._lock:
+            if self._background is None or self._background.shape != gray.shape:
+                self._start(gray, step)     # not calibrated: the first frame has to do as the empty conveyor
+                changed = np.ones(self._page_tiles.shape, dtype=bool)
+            else:
+                changed = self._tiles(np.abs(gray - self._previous)).mean(axis=(2, 3)) > MOTION_THRESHOLD
+            self.frames += 1
+
+            # full analysis only for the tiles that changed since the previous frame
+            if changed.any():
+                tiles = self._tiles(gray)[changed]                          # (n, TILE, TILE)
+                background = self._tiles(self._background)[changed]
+                foreground = np.abs(tiles - background) > FOREGROUND_THRESHOLD
+                self._page_tiles[changed] = foreground.mean(axis=(1, 2)) > PAGE_TILE_FRACTION
+                paper = self._paper_level(gray)
+                if paper is not None:
+                    self._dark_tiles[changed] = (tiles < paper - DEFECT_DELTA).mean(axis=(1, 2)) > DEFECT_TILE_FRACTION
+                else:
+                    self._dark_tiles[changed] = False
+            region = self._page_region()
+            self._defect_tiles = self._interior(region) & self._dark_tiles
+
+            # follow slow changes (lighting, belt wear) of the empty conveyor, but not where the page is
+            conveyor = ~region[:, None, :, None]
+            background = self._background.reshape(self._page_tiles.shape[0], TILE, self._page_tiles.shape[1], TILE)
+            background += BACKGROUND_RATE * (gray.reshape(background.shape) - background) * conveyor
+            self._previous = gray
+            return self._results(changed, timestamp if timestamp is not None else time.time())
+
+    def _paper_level(self, gray):
+        # typical brightness of the page: median of the mean brightness of its tiles
+        if not self._page_tiles.any():
+            return None
+        return float(np.median(self._tiles(gray).mean(axis=(2, 3))[self._page_tiles]))
+
+    def _page_region(self):
+        # page tiles plus the tiles between them, along both rows and columns
+        page = self._page_tiles
+        across = np.logical_or.accumulate(page, axis=1) & np.logical_or.accumulate(page[:, ::-1], axis=1)[:, ::-1]
+        down = np.logical_or.accumulate(page, axis=0) & np.logical_or.accumulate(page[::-1], axis=0)[::-1]
+        return across & down
+
+    @staticmethod
+    def _interior(region):
+        # tiles of the region whose four neighbours are in it too
+        padded = np.pad(region, 1)
+        return region & padded[:-2, 1:-1] & padded[2:, 1:-1] & padded[1:-1, :-2] & padded[1:-1, 2:]
+
+    def _results(self, changed, timestamp):
+        scale = TILE * self._step       # tile -> full resolution pixels
+        page_count = int(self._page_tiles.sum())
+        results = {
+            'page_present': page_count >= MIN_PAGE_TILES,
+            'changed_fraction': round(float(changed.mean()), 3),
+            'frames_analyzed': self.frames,
+            'calibrated': self.calibrated,
+        }
+        if not results['page_present']:
+            self._last_center = None
+            return results
+        rows = np.flatnonzero(self._page_tiles.any(axis=1))
+        cols = np.flatnonzero(self._page_tiles.any(axis=0))
+        tile_rows, tile_cols = np.nonzero(self._page_tiles)
+        center = ((float(tile_cols.mean()) + 0.5) * scale, (float(tile_rows.mean()) + 0.5) * scale)
+        results['page_box'] = [int(cols[0]) * scale, int(rows[0]) * scale,
+                               (int(cols[-1]) + 1) * scale, (int(rows[-1]) + 1) * scale]
+        results['page_center'] = [round(center[0], 1), round(center[1], 1)]
+        if self._last_center is not None and timestamp > self._last_time:
+            elapsed = timestamp - self._last_time
+            results['page_motion'] = [round((center[0] - self._last_center[0]) / elapsed, 1),
+                                      round((center[1] - self._last_center[1]) / elapsed, 1)]    # pixels/second
+        self._last_center, self._last_time = center, timestamp
+        defect_rows, defect_cols = np.nonzero(self._defect_tiles)
+        results['defect_count'] = len(defect_rows)
+        results['defects'] = [[int(c) * scale, int(r) * scale, (int(c) + 1) * scale, (int(r) + 1) * scale]
+                              for r, c in zip(defect_rows[:MAX_DEFECTS_REPORTED], defect_cols[:MAX_DEFECTS_REPORTED])]
+        return results
+
+
+# -----------------------------------------------------------------------------------------------------------
+class OutfeedMonitor:
+    # Feeds every camera frame to the analyzer while the rear conveyor runs
+    def __init__(self, analyzer):
+        self.analyzer = analyzer
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._cond = threading.Condition()
+        self._latest = None         # (frame_number, results) of the last analysed frame
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if np is None:
+            raise CaptureError("numpy is not installed")
+        if self._thread is None:
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name="OutfeedMonitor", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop_event.set()
+            thread.join()
+
+    def _run(self):
+        frame_number = None
+        while not self._stop_event.is_set():
+            try:
+                with capture_engine.latest_frame(after=frame_number) as frame:
+                    frame_number = frame.frame_number
+                    results = self.analyzer.update(frame.image, frame.timestamp)
+            except CaptureError as e:
+                print("{S}: Outfeed monitor waiting for camera:", e)
+                self._stop_event.wait(1.0)
+                continue
+            with self._cond:
+                self._latest = (frame_number, results)
+                self._cond.notify_all()
+
+    def next_results(self, timeout=FRAME_TIMEOUT):
+        # (frame_number, results) of the next frame analysed after this call
+        with self._cond:
+            current = self._latest
+            if not self._cond.wait_for(lambda: self._latest is not current, timeout):
+                raise CaptureError("Outfeed monitor produced no results in %.1f seconds" % timeout)
+            return self._latest
+
+
+outfeed_analyzer = OutfeedAnalyzer()
+outfeed_monitor = OutfeedMonitor(outfeed_analyzer)
+
+
+def examine_outfeed_page(input_data_dict, abort_event=None, image=None):
+    """
+    Runs in the background (see action_jobs.py); returns dictionary of result fields for NET_RESPONSE_RESULTS
+    :param image: RGB frame to add to the analyzer instead of a camera frame
+    """
+    if np is None:
+        raise CaptureError("numpy is not installed")
+    started = time.perf_counter()
+    if input_data_dict.get('image_only', False):
+        results = {'image_only': True}
+    elif image is not None:
+        results = outfeed_analyzer.update(image)
+    elif outfeed_monitor.running:
+        frame_number, results = outfeed_monitor.next_results()
+        results = dict(results, frame_number=frame_number)
+    else:
+        with capture_engine.fresh_frame() as frame:
+            results = outfeed_analyzer.update(frame.image, frame.timestamp)
+            results['frame_number'] = frame.frame_number
+    results['page_num'] = input_data_dict['page_num']
+    results['analysis_ms'] = round(1000 * (time.perf_counter() - started), 1)
+    return results
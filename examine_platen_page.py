@@ -1,5 +1,186 @@
 # examine_platen_page.py
+#
+# Platen inspection for API_EXAMINE_PLATEN_PAGE: find the page inside the region between config_pt_1 and config_pt_2
+# and measure how much of that region it covers and how skewed it is.
+#
+# The frame comes from the running camera stream (camera_capture.py), or from an image file for offline benchmarking:
+#       python examine_platen_page.py image.jpg x1 y1 x2 y2
+#
+# All steps are whole-array NumPy operations on a downsampled copy of the region (no per-pixel Python loops):
+#   1. crop the region and take every n-th pixel so its longer side is at most ANALYSIS_SIZE
+#   2. grayscale with integer weights
+#   3. Otsu threshold from the histogram: the page is the bright part, the platen the dark part
+#   4. coverage = bright fraction; bounding box from the rows/columns that contain page
+#   5. skew from the page's edges: the angle of the smallest rectangle around the mask's outline pixels (the moments
+#      of the mask were used before, but they give no orientation for a square page, e.g. "12x12")
 
-def examine_platen_page(input_data_dict):
-    # TODO
-    return input_data_dict  # TODO: change this!!!!
+import sys
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+from camera_capture import capture_engine, CaptureError
+
+ANALYSIS_SIZE = 320         # longer side of the downsampled region, pixels
+MIN_COVERAGE = 0.05         # less page than this in the region means no page found
+MIN_CONTRAST = 30           # gray levels between page and platen; less than this means the region is all one thing
+SKEW_COARSE_STEP = 0.5      # degrees between the rectangle angles tried first
+SKEW_FINE_STEP = 0.05       # degrees between the angles tried around the best coarse one
+
+
+def examine_platen_page(input_data_dict, abort_event=None, image=None, image_path=None):
+    """
+    Runs in the background (see action_jobs.py); returns dictionary of result fields for NET_RESPONSE_RESULTS
+    :param image: (height, width, 3) RGB array to examine instead of a camera frame
+    :param image_path: image file to examine instead of a camera frame (offline benchmarking)
+    """
+    if np is None:
+        raise CaptureError("numpy is not installed")
+    if image is None and image_path is not None:
+        image = load_image(image_path)
+    if image is not None:
+        started = time.perf_counter()
+        results = _examine(image, input_data_dict, abort_event)
+    else:
+        with capture_engine.fresh_frame() as frame:
+            started = time.perf_counter()
+            results = _examine(frame.image, input_data_dict, abort_event)
+            results['frame_number'] = frame.frame_number
+    results['page_num'] = input_data_dict['page_num']
+    results['analysis_ms'] = round(1000 * (time.perf_counter() - started), 1)     # not counting the wait for a frame
+    return results
+
+
+def _examine(image, input_data_dict, abort_event):
+    if input_data_dict.get('image_only', False):
+        return {'image_only': True}
+
+    (x1, y1), (x2, y2) = input_data_dict['config_pt_1'], input_data_dict['config_pt_2']
+    height, width = image.shape[:2]
+    left, right = sorted((max(0, min(int(x1), width)), max(0, min(int(x2), width))))
+    top, bottom = sorted((max(0, min(int(y1), height)), max(0, min(int(y2), height))))
+    if right - left < 2 or bottom - top < 2:
+        raise ValueError("config_pt_1/config_pt_2 region is empty in a %dx%d image" % (width, height))
+
+    # 1. downsample the region (a strided view, no copy yet)
+    step = max(1, -(-max(right - left, bottom - top) // ANALYSIS_SIZE))
+    roi = image[top:bottom:step, left:right:step]
+
+    # 2. grayscale: (77 R + 150 G + 29 B) / 256
+    if roi.ndim == 3:
+        gray = (roi[..., 0].astype(np.uint16) * 77 + roi[..., 1].astype(np.uint16) * 150 +
+                roi[..., 2].astype(np.uint16) * 29) >> 8
+    else:
+        gray = roi.astype(np.uint16)
+    if abort_event is not None and abort_event.is_set():
+        return {'aborted': True}
+
+    # 3. page mask
+    threshold, contrast = otsu_threshold(gray)
+    mask = gray > threshold
+    if contrast < MIN_CONTRAST:
+        mask[:] = gray.mean() > 127     # one flat brightness: all page or all platen
+
+    # 4. coverage and bounding box
+    coverage = float(mask.mean())
+    results = {
+        'page_found': coverage >= MIN_COVERAGE,
+        'coverage': round(coverage, 4),
+        'threshold': int(threshold),
+        'contrast': round(float(contrast), 1),
+    }
+    if not results['page_found']:
+        return results
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    results['page_box'] = [left + int(cols[0]) * step, top + int(rows[0]) * step,
+                           left + (int(cols[-1]) + 1) * step, top + (int(rows[-1]) + 1) * step]
+
+    # 5. skew from the page's edges
+    ys, xs = np.nonzero(mask)
+    cx, cy = xs.mean(), ys.mean()
+    results['skew_deg'] = round(edge_skew(mask), 2)
+    results['page_center'] = [round(left + float(cx) * step, 1), round(top + float(cy) * step, 1)]
+    return results
+
+
+def edge_skew(mask):
+    """
+    :param mask: boolean array, True on the page
+    :return: rotation of the page's edges from the image axes, degrees in [-45, 45): the angle of the minimum-area
+             rectangle around the outline pixels of the mask
+    """
+    padded = np.pad(mask, 1)
+    inner = padded[1:-1, 1:-1] & padded[:-2, 1:-1] & padded[2:, 1:-1] & padded[1:-1, :-2] & padded[1:-1, 2:]
+    ys, xs = np.nonzero(mask & ~inner)
+    xs = xs - xs.mean()
+    ys = ys - ys.mean()
+
+    def best(angles):
+        # area of the bounding box of the outline rotated by -angle, for each angle; returns the smallest one's angle
+        radians = np.radians(angles)[:, None]
+        cos, sin = np.cos(radians), np.sin(radians)
+        u = xs * cos + ys * sin
+        v = ys * cos - xs * sin
+        areas = (u.max(axis=1) - u.min(axis=1)) * (v.max(axis=1) - v.min(axis=1))
+        return float(angles[int(np.argmin(areas))])
+
+    coarse = best(np.arange(-45.0, 45.0, SKEW_COARSE_STEP))
+    fine = best(np.arange(coarse - SKEW_COARSE_STEP, coarse + SKEW_COARSE_STEP, SKEW_FINE_STEP))
+    return (fine + 45.0) % 90.0 - 45.0
+
+
+def otsu_threshold(gray):
+    """
+    :param gray: array of gray levels 0..255
+    :return: (threshold, contrast): the level that best separates dark from bright pixels, and the difference between
+             the mean levels of the two classes
+    """
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256, dtype=np.float64)
+    weight_dark = np.cumsum(hist)
+    weight_bright = weight_dark[-1] - weight_dark
+    sum_dark = np.cumsum(hist * levels)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_dark = sum_dark / weight_dark
+        mean_bright = (sum_dark[-1] - sum_dark) / weight_bright
+        between = weight_dark * weight_bright * (mean_dark - mean_bright) ** 2
+    between = np.nan_to_num(between)
+    threshold = int(np.argmax(between))
+    if weight_bright[threshold] == 0 or weight_dark[threshold] == 0:
+        return threshold, 0.0
+    return threshold, float(mean_bright[threshold] - mean_dark[threshold])
+
+
+def load_image(image_path):
+    # RGB array from an image file (needs OpenCV), or from a NumPy .npy file
+    if image_path.endswith(".npy"):
+        return np.load(image_path)
+    if cv2 is None:
+        raise CaptureError("OpenCV is not installed; cannot read %s" % image_path)
+    image = cv2.imread(image_path, cv2.IMREAD_COLOR)
+    if image is None:
+        raise CaptureError("Unable to read image file %s" % image_path)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+if __name__ == "__main__":
+    # offline benchmark: python examine_platen_page.py image.jpg x1 y1 x2 y2 [repeat]
+    path = sys.argv[1]
+    x1, y1, x2, y2 = (int(v) for v in sys.argv[2:6])
+    repeat = int(sys.argv[6]) if len(sys.argv) > 6 else 20
+    test_image = load_image(path)
+    request = {'page_num': 0, 'config_pt_1': [x1, y1], 'config_pt_2': [x2, y2]}
+    t1 = time.perf_counter()
+    for _ in range(repeat):
+        test_results = examine_platen_page(request, image=test_image)
+    print(test_results)
+    print("average %.1f ms per page" % (1000 * (time.perf_counter() - t1) / repeat))
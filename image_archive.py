@@ -0,0 +1,192 @@
+# image_archive.py
+#
+# Background writer for the images kept when archive_rpi_images is on (API_START_PRINT_JOB, API_TAKE_PICTURE).
+# Encoding a frame to JPG and writing it to the SD card takes tens to hundreds of ms, and the SD card sometimes stalls
+# for much longer; doing that on the request or action thread made every examine/check that slow.
+#
+# submit() copies the frame into a bounded queue and returns right away; one writer thread encodes and writes.
+#   - each file is written to a temporary name in the same directory, synced to disk and renamed, so nobody copying
+#     images off the RPi (or reading them after a power cut) ever sees half an image under the real name; a failed
+#     write removes its temporary file
+#   - directories already created are remembered, so makedirs isn't called for every image of a build/day/camera;
+#     one deleted since (archive_retention.py) is created again when writing into it fails
+#   - backpressure: once the queue is DOWNSAMPLE_AT deep the SD card isn't keeping up, and frames are queued at half
+#     resolution (a quarter of the bytes to encode and write); when the queue is full, new frames are dropped
+# stats() (write latency, queue depth, dropped/downsampled counts) is reported in API_STATUS as 'image_archive'.
+
+import atexit
+import collections
+import os
+import queue
+import threading
+import time
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+ARCHIVE_QUEUE_SIZE = 16     # frames waiting to be written
+DOWNSAMPLE_AT = 8           # queue depth from which frames are queued at half resolution
+LATENCY_SAMPLES = 100       # recent writes kept for the latency figures in stats()
+MAX_KNOWN_DIRS = 64         # directories remembered as already created
+JPEG_QUALITY = 90
+
+QUEUED = "queued"
+DOWNSAMPLED = "downsampled"
+DROPPED = "dropped"
+
+
+class ImageArchive:
+    def __init__(self, queue_size=ARCHIVE_QUEUE_SIZE, downsample_at=DOWNSAMPLE_AT):
+        self.downsample_at = downsample_at
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._known_dirs = collections.OrderedDict()
+        self._write_ms = collections.deque(maxlen=LATENCY_SAMPLES)     # encode + write + rename, per image
+        self._wait_ms = collections.deque(maxlen=LATENCY_SAMPLES)      # time in the queue, per image
+        # stats
+        self.written = 0
+        self.bytes_written = 0
+        self.downsampled = 0
+        self.dropped = 0
+        self.errors = 0
+        self.last_error = None
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="ImageArchive", daemon=True)
+                self._thread.start()
+
+    def submit(self, image, path, image_format):
+        """
+        Queue a copy of image to be written to path (the caller can release the frame as soon as this returns)
+        :return: QUEUED, DOWNSAMPLED or DROPPED
+        """
+        if self._queue.full():
+            with self._stats_lock:
+                self.dropped += 1
+            print("{S}: Image archive is behind; dropped", path)
+            return DROPPED
+        status = QUEUED
+        if self._queue.qsize() >= self.downsample_at:
+            image = image[::2, ::2]
+            status = DOWNSAMPLED
+        try:
+            self._queue.put_nowait((image.copy(), path, image_format, time.monotonic()))
+        except queue.Full:
+            with self._stats_lock:
+                self.dropped += 1
+            return DROPPED
+        if status == DOWNSAMPLED:
+            with self._stats_lock:
+                self.downsampled += 1
+        self.start()
+        return status
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            image, path, image_format, queued = item
+            started = time.monotonic()
+            try:
+                size = self._write(image, path, image_format)
+            except Exception as e:
+                with self._stats_lock:
+                    self.errors += 1
+                    self.last_error = "%s: %s" % (path, e)
+                print("{S}: Image archive error:", self.last_error)
+                continue
+            finally:
+                self._queue.task_done()
+            finished = time.monotonic()
+            with self._stats_lock:
+                self.written += 1
+                self.bytes_written += size
+                self._wait_ms.append(1000 * (started - queued))
+                self._write_ms.append(1000 * (finished - started))
+
+    def _write(self, image, path, image_format):
+        if cv2 is None:
+            raise RuntimeError("OpenCV is not installed; cannot encode %s images" % image_format)
+        ok, encoded = cv2.imencode("." + image_format.lower(), cv2.cvtColor(image, cv2.COLOR_RGB2BGR),
+                                   [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+        if not ok:
+            raise RuntimeError("Unable to encode %s image" % image_format)
+        directory = os.path.dirname(path)
+        self._make_dir(directory)
+        temp_path = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            try:
+                f = open(temp_path, "wb")
+            except FileNotFoundError:
+                # the directory was deleted since it was created (archive_retention evicted that day); create it again
+                self._known_dirs.pop(directory, None)
+                self._make_dir(directory)
+                f = open(temp_path, "wb")
+            with f:
+                f.write(encoded.tobytes())
+                f.flush()
+                os.fsync(f.fileno())    # the data must be on disk before the rename makes it visible
+            os.replace(temp_path, path)
+        except BaseException:
+            # don't leave a partial temp file behind (disk full, I/O error)
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        return len(encoded)
+
+    def _make_dir(self, directory):
+        if directory in self._known_dirs:
+            self._known_dirs.move_to_end(directory)
+            return
+        os.makedirs(directory, exist_ok=True)
+        self._known_dirs[directory] = True
+        if len(self._known_dirs) > MAX_KNOWN_DIRS:
+            self._known_dirs.popitem(last=False)
+
+    def flush(self):
+        # wait until everything queued so far is written
+        self._queue.join()
+
+    def stop(self):
+        with self._start_lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)       # after the images already queued
+            thread.join()
+
+    def stats(self):
+        with self._stats_lock:
+            write_ms = sorted(self._write_ms)
+            wait_ms = sorted(self._wait_ms)
+            return {
+                'queued': self._queue.qsize(),
+                'written': self.written,
+                'bytes_written': self.bytes_written,
+                'downsampled': self.downsampled,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'last_error': self.last_error,
+                'write_ms': _latency(write_ms),
+                'queue_wait_ms': _latency(wait_ms)}
+
+
+def _latency(samples):
+    # median, 95th percentile and max of a sorted list of recent latencies
+    if not samples:
+        return None
+    return {'p50': round(samples[len(samples) // 2], 1),
+            'p95': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 1),
+            'max': round(samples[-1], 1)}
+
+
+image_archive = ImageArchive()
+atexit.register(image_archive.stop)     # finish writing what is queued
@@ -0,0 +1,93 @@
+# net_codec.py
+#
+# Serialization of the request/response dictionaries. Every frame carries the id of the codec its payload was
+# encoded with (see net_protocol.py), and the server always answers in the codec the request used, so each
+# connection can pick its own format:
+#
+#   CODEC_JSON (0)      JSON text. Always available. Uses orjson for encoding/decoding when it is installed
+#                       (several times faster than the json module, and it works directly on bytes); otherwise
+#                       the standard json module, set up to produce the same wire format as orjson: compact (no
+#                       spaces after ',' and ':'), UTF-8, non-ASCII characters written as they are rather than as
+#                       \uXXXX escapes.
+#   CODEC_MSGPACK (1)   MessagePack binary, when the msgpack package is installed. Smaller than JSON and cheaper to
+#                       encode/decode, especially for API_STATUS responses carrying large text blobs.
+#
+# A client that asks for a codec the server doesn't have gets a NET_RESPONSE_PROBLEM (with 'CodecError': True)
+# encoded in JSON, and falls back to JSON for that connection.
+#
+# Decoding always works directly on the received bytes; there is no intermediate str.
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+CODEC_JSON = 0
+CODEC_MSGPACK = 1
+
+
+class DecodeError(ValueError):
+    """The payload could not be decoded with the codec it claims to use"""
+    pass
+
+
+# -----------------------------------------------------------------------------------------------------------
+class JsonCodec:
+    codec_id = CODEC_JSON
+    name = "json"
+
+    def encode(self, obj):
+        if orjson is not None:
+            try:
+                return orjson.dumps(obj)
+            except TypeError:
+                pass    # something orjson won't handle (e.g. non-str dict keys); the json module converts these
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def decode(self, data):
+        try:
+            if orjson is not None:
+                return orjson.loads(data)
+            return json.loads(data)
+        except (ValueError, UnicodeDecodeError) as e:
+            raise DecodeError(str(e))
+
+
+class MsgpackCodec:
+    codec_id = CODEC_MSGPACK
+    name = "msgpack"
+
+    def encode(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, data):
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except Exception as e:      # msgpack raises several unrelated exception types for bad data
+            raise DecodeError(str(e))
+
+
+JSON_CODEC = JsonCodec()
+
+CODECS = {CODEC_JSON: JSON_CODEC}      # codec id -> codec, for every codec available on this computer
+if msgpack is not None:
+    CODECS[CODEC_MSGPACK] = MsgpackCodec()
+
+CODECS_BY_NAME = {codec.name: codec for codec in CODECS.values()}
+
+
+def get_codec(codec_id):
+    # returns the codec for codec_id, or None if it is not available here
+    return CODECS.get(codec_id)
+
+
+def preferred_codec():
+    # The codec a client uses unless told otherwise: binary if available, else JSON
+    return CODECS.get(CODEC_MSGPACK, JSON_CODEC)
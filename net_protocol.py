@@ -0,0 +1,111 @@
+# net_protocol.py
+#
+# Wire framing shared by the camera server (ServerTest3.py / ServerTest2.py) and the client code.
+#
+# Every message sent across the socket, in either direction, is one "frame":
+#
+#       +----------------------+------------------+----------------------------------+
+#       | length (4 bytes, BE) | codec id (1 byte) | payload (encoded dictionary)     |
+#       +----------------------+------------------+----------------------------------+
+#
+# The codec id says how the payload dictionary was serialized (JSON, msgpack; see net_codec.py).
+#
+# The length header lets the receiver keep reading until the whole message has arrived, so a request that
+# gets split across several TCP segments (slow Wi-Fi to the RPi, busy network) is reassembled correctly,
+# and messages are no longer limited to a single 2K recv().
+
+import struct
+
+HEADER = struct.Struct("!IB")       # payload length (unsigned 32 bit) and codec id, network byte order
+HEADER_SIZE = HEADER.size
+
+INITIAL_BUFFER_SIZE = 2048          # starting size of the receive buffer; grows as needed up to max_frame_size
+MAX_FRAME_SIZE = 1024 * 1024        # largest payload we are willing to send or receive (1 MB)
+
+
+class FrameError(Exception):
+    """Base class for problems reading a frame from the socket"""
+    pass
+
+
+class FrameTooLarge(FrameError):
+    """The length header announced a payload larger than the configured max_frame_size"""
+    def __init__(self, length, max_frame_size):
+        super().__init__("Frame of %d bytes exceeds max frame size of %d bytes" % (length, max_frame_size))
+        self.length = length
+        self.max_frame_size = max_frame_size
+
+
+class ConnectionClosedMidFrame(FrameError):
+    """The other side closed the connection after sending only part of a frame"""
+    pass
+
+
+# -----------------------------------------------------------------------------------------------------------
+def encode_frame(payload, codec_id=0):
+    # Returns header + payload as one bytes object so it can go out in a single sendall() call
+    return HEADER.pack(len(payload), codec_id) + payload
+
+
+def send_frame(sock, payload, codec_id=0):
+    sock.sendall(encode_frame(payload, codec_id))
+
+
+# -----------------------------------------------------------------------------------------------------------
+class FrameReader:
+    """
+    Reads length-prefixed frames from one socket. The receive buffer is allocated once per connection and
+    reused for every frame (it only grows when a larger frame arrives), and data is read directly into it
+    with recv_into(), so reading a frame does not build up a list of partial byte strings.
+    After each read_frame(), codec_id is the codec id from that frame's header.
+    """
+    def __init__(self, sock, max_frame_size=MAX_FRAME_SIZE, initial_size=INITIAL_BUFFER_SIZE):
+        self.sock = sock
+        self.max_frame_size = max_frame_size
+        self._header = bytearray(HEADER_SIZE)
+        self._buffer = bytearray(min(initial_size, max_frame_size))
+        self.codec_id = 0
+
+    def _read_into(self, view):
+        # Fill the whole view; returns the number of bytes read (less than len(view) only if the socket closed)
+        total = 0
+        size = len(view)
+        while total < size:
+            count = self.sock.recv_into(view[total:], size - total)
+            if count == 0:
+                break
+            total += count
+        return total
+
+    def read_frame(self):
+        """
+        :return: the payload bytes of the next frame, or None if the other side closed the connection cleanly
+                 (between frames).
+        Raises FrameTooLarge if the header announces a payload larger than max_frame_size, and
+        ConnectionClosedMidFrame if the connection closes part way through a frame.
+        socket.timeout is passed through to the caller.
+        """
+        count = self._read_into(memoryview(self._header))
+        if count == 0:
+            return None
+        if count < HEADER_SIZE:
+            raise ConnectionClosedMidFrame("Connection closed while reading frame header")
+
+        length, self.codec_id = HEADER.unpack(self._header)
+        if length > self.max_frame_size:
+            raise FrameTooLarge(length, self.max_frame_size)
+
+        if length > len(self._buffer):
+            # grow geometrically so a series of slightly larger messages doesn't reallocate every time
+            self._buffer = bytearray(min(max(length, 2 * len(self._buffer)), self.max_frame_size))
+
+        view = memoryview(self._buffer)[:length]
+        if self._read_into(view) < length:
+            raise ConnectionClosedMidFrame("Connection closed after %d byte header announced %d bytes" %
+                                           (HEADER_SIZE, length))
+        return bytes(view)
+
+
+def recv_frame(sock, max_frame_size=MAX_FRAME_SIZE):
+    # Convenience for one-shot use; long-lived connections should keep a FrameReader instead
+    return FrameReader(sock, max_frame_size).read_frame()
@@ -0,0 +1,102 @@
+# net_registry.py
+#
+# Table that maps a client request (NetCmd, API) to the function that handles it, replacing the if/elif chains
+# that used to be in parse_net_cmd(), net_request_immediate() and net_request_action().
+# The table itself lives in camera_api.py; this file only has the generic machinery.
+#
+# Each entry declares:
+#   handler     function(input_data_dict) -> output_data_dict (SYNC), or the work function for the action job
+#               engine, work(input_data_dict, abort_event) -> results dictionary (ASYNC)
+#   schema      net_schema.Schema of the request fields needed besides NetCmd/API/Camera/TS1
+#   mode        SYNC: the handler's response is sent straight back (IMMEDIATE requests, API_REBOOT)
+#               ASYNC: the handler runs in the background; the client gets ACK and polls for the results
+#   session     True if a SYNC handler also needs the client's connection: handler(input_data_dict, session), where
+#               session is supplied by the server engine (None if there isn't one), e.g. NET_REQUEST_SUBSCRIBE
+# and keeps simple per-API metrics (request count, problem responses, handling time), reported in API_STATUS as
+# 'api_metrics'.
+
+import threading
+
+from net_schema import NO_FIELDS
+
+SYNC = "sync"
+ASYNC = "async"
+ANY_API = "*"       # entry used for a NetCmd when there is no entry for its specific API (e.g. POLL, ABORT)
+
+
+class ApiEntry:
+    def __init__(self, net_cmd, api, handler, schema=NO_FIELDS, mode=SYNC, session=False):
+        if mode not in (SYNC, ASYNC):
+            raise ValueError("Unknown handler mode: %s" % mode)
+        if session and mode != SYNC:
+            raise ValueError("Only SYNC handlers can be given the session")
+        self.net_cmd = net_cmd
+        self.api = api
+        self.handler = handler
+        self.schema = schema
+        self.mode = mode
+        self.session = session
+        # metrics
+        self.count = 0
+        self.problems = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def validate(self, input_data_dict):
+        # returns (missing, invalid) lists of problem descriptions; see net_schema.Schema.validate()
+        return self.schema.validate(input_data_dict)
+
+    def metrics(self):
+        return {
+            'count': self.count,
+            'problems': self.problems,
+            'avg_ms': round(1000 * self.total_time / self.count, 3) if self.count else 0.0,
+            'max_ms': round(1000 * self.max_time, 3)}
+
+
+# -----------------------------------------------------------------------------------------------------------
+class NetCmdRegistry:
+    def __init__(self):
+        self._entries = {}      # (NetCmd, API) -> ApiEntry
+        self._net_cmds = set()
+        self._metrics_lock = threading.Lock()
+
+    def add(self, net_cmd, api, handler, schema=NO_FIELDS, mode=SYNC, session=False):
+        key = (net_cmd, api)
+        if key in self._entries:
+            raise ValueError("Handler already registered for %s / %s" % key)
+        entry = ApiEntry(net_cmd, api, handler, schema, mode, session)
+        self._entries[key] = entry
+        self._net_cmds.add(net_cmd)
+        return entry
+
+    def register(self, net_cmd, api, schema=NO_FIELDS, mode=SYNC, session=False):
+        # decorator form of add()
+        def decorator(handler):
+            self.add(net_cmd, api, handler, schema, mode, session)
+            return handler
+        return decorator
+
+    def lookup(self, net_cmd, api):
+        # returns the ApiEntry for this request, or None
+        entry = self._entries.get((net_cmd, api))
+        if entry is None:
+            entry = self._entries.get((net_cmd, ANY_API))
+        return entry
+
+    def has_net_cmd(self, net_cmd):
+        return net_cmd in self._net_cmds
+
+    def record(self, entry, elapsed, problem):
+        with self._metrics_lock:
+            entry.count += 1
+            entry.total_time += elapsed
+            if elapsed > entry.max_time:
+                entry.max_time = elapsed
+            if problem:
+                entry.problems += 1
+
+    def metrics(self):
+        # dictionary "NetCmd/API" -> metrics, for every entry that has handled at least one request
+        with self._metrics_lock:
+            return {"%s/%s" % key: entry.metrics() for key, entry in self._entries.items() if entry.count}
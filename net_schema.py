@@ -0,0 +1,99 @@
+# net_schema.py
+#
+# Per-API request schemas. Each API in camera_api.py declares which request fields it needs and what they must look
+# like; parse_net_cmd() checks the request against it before calling the handler, so a malformed request is
+# answered with a precise NET_RESPONSE_PROBLEM instead of failing somewhere deep in the camera code.
+#
+# A schema is built once (when camera_api.py is imported) into a flat tuple of (field, required, check, expected)
+# so checking a request is one short loop of cheap type tests.
+
+import re
+
+
+# -----------------------------------------------------------------------------------------------------------
+# Field checks: each is a function value -> True/False, with a description used in the error message
+
+def _is_int(value):
+    return type(value) is int      # note: bool is a subclass of int, but True/False are not valid numbers here
+
+
+def _is_number(value):
+    return type(value) in (int, float)
+
+
+class FieldType:
+    def __init__(self, check, expected):
+        self.check = check
+        self.expected = expected
+
+
+INT = FieldType(_is_int, "an integer")
+POSITIVE_INT = FieldType(lambda value: _is_int(value) and value > 0, "a positive integer")
+BOOL = FieldType(lambda value: type(value) is bool, "true or false")
+STR = FieldType(lambda value: type(value) is str and len(value) > 0, "a non-empty string")
+POINT = FieldType(lambda value: type(value) in (list, tuple) and len(value) == 2 and all(_is_number(v) for v in value),
+                  "a pair of numbers [x, y]")
+
+
+def one_of(*choices):
+    return FieldType(lambda value: value in choices and type(value) in set(type(c) for c in choices),
+                     "one of: %s" % ", ".join(repr(c) for c in choices))
+
+
+def any_of(*field_types):
+    checks = tuple(field_type.check for field_type in field_types)
+    return FieldType(lambda value: any(check(value) for check in checks),
+                     " or ".join(field_type.expected for field_type in field_types))
+
+
+def int_range(low, high):
+    return FieldType(lambda value: _is_int(value) and low <= value <= high, "an integer from %d to %d" % (low, high))
+
+
+def list_of(field_type):
+    check = field_type.check
+    return FieldType(lambda value: type(value) is list and all(check(v) for v in value),
+                     "a list, each item %s" % field_type.expected)
+
+
+def matches(pattern, expected):
+    regex = re.compile(pattern)
+    return FieldType(lambda value: type(value) is str and regex.fullmatch(value) is not None, expected)
+
+
+# -----------------------------------------------------------------------------------------------------------
+class Schema:
+    def __init__(self, required=None, optional=None):
+        """
+        :param required: dictionary field name -> FieldType for fields the request must have
+        :param optional: dictionary field name -> FieldType for fields that are checked only if present
+        """
+        fields = []
+        for name, field_type in (required or {}).items():
+            fields.append((name, True, field_type.check, field_type.expected))
+        for name, field_type in (optional or {}).items():
+            fields.append((name, False, field_type.check, field_type.expected))
+        self._fields = tuple(fields)
+
+    def validate(self, input_data_dict):
+        """
+        :return: (missing, invalid) lists of problem descriptions; both empty if the request is OK
+        """
+        missing = []
+        invalid = []
+        for name, required, check, expected in self._fields:
+            if name not in input_data_dict:
+                if required:
+                    missing.append("Client request missing field: %s\n" % name)
+            elif not check(input_data_dict[name]):
+                invalid.append("Client request field %s must be %s, not %s\n" %
+                               (name, expected, _short_repr(input_data_dict[name])))
+        return missing, invalid
+
+
+NO_FIELDS = Schema()
+
+
+def _short_repr(value, limit=40):
+    text = repr(value)
+    return text if len(text) <= limit else text[:limit] + "..."
@@ -0,0 +1,203 @@
+# poll_scheduler.py
+#
+# Client side: runs a NET_REQUEST_ACTION through to its results without the printer's PC software having to decide
+# how often to send NET_REQUEST_POLL. Polling at a fixed interval either costs the RPi CPU and network time for
+# nothing (interval too short) or leaves the results waiting on the RPi (interval too long).
+#
+# submit() sends the ACTION and returns a concurrent.futures.Future right away; the Future's result is the final
+# response dictionary (NET_RESPONSE_RESULTS, or the NAK/PROBLEM that ended the action). One scheduler thread decides
+# when to poll every action in flight; the POLLs themselves are sent by a worker thread per camera (ip, port), so a
+# camera that is slow to answer only holds up its own actions, not the other cameras':
+#   - it keeps a running estimate of each API's completed_duration from the RESULTS responses it has seen, and sends
+#     the first POLL a little before the action is expected to be done (FIRST_POLL_LEAD of the estimate; longer if the
+#     ACK says the action was queued behind others)
+#   - after a NET_RESPONSE_WAIT it polls again with exponential backoff (MIN_POLL_INTERVAL doubling up to
+#     MAX_POLL_INTERVAL), but not before the estimate says the action should be done, going by the WAIT's 'duration'
+#   - an action not done after action_timeout is aborted (NET_REQUEST_ABORT) and ends with a NET_RESPONSE_PROBLEM
+# In asyncio code, await asyncio.wrap_future(future).
+#
+# stats() gives the estimates and how many POLLs each action has needed on average.
+
+import concurrent.futures
+import heapq
+import itertools
+import threading
+import time
+
+import camera_client
+
+FIRST_POLL_LEAD = 0.8       # first POLL at this fraction of the expected completed_duration
+DEFAULT_EXPECTED = 0.5      # seconds; expected completed_duration of an API not seen yet
+ESTIMATE_WEIGHT = 0.3       # weight of the latest completed_duration in the running estimate
+MIN_POLL_INTERVAL = 0.02    # seconds; backoff after the first NET_RESPONSE_WAIT
+MAX_POLL_INTERVAL = 1.0     # seconds; longest backoff
+ACTION_TIMEOUT = 30.0       # seconds before an action is aborted
+
+
+class _PendingAction:
+    # An ACKed action waiting for its results
+    def __init__(self, ip, port, action_dict, ack, future, timeout):
+        self.ip = ip
+        self.port = port
+        self.api = action_dict['API']
+        self.camera = action_dict['Camera']
+        self.job_id = ack.get('job_id')
+        self.queue_position = ack.get('QueuePosition', 0)
+        self.future = future
+        self.give_up = time.monotonic() + timeout
+        self.interval = MIN_POLL_INTERVAL
+        self.polls = 0
+
+    def request(self, net_cmd):
+        request_dict = {"NetCmd": net_cmd, "API": self.api, "Camera": self.camera}
+        if self.job_id is not None:
+            request_dict["job_id"] = self.job_id
+        return request_dict
+
+
+class PollScheduler:
+    def __init__(self, client=None, action_timeout=ACTION_TIMEOUT):
+        self.client = client if client is not None else camera_client.default_client
+        self.action_timeout = action_timeout
+        self._estimates = {}        # API -> expected completed_duration, seconds
+        self._due = []              # heap of (when, seq, _PendingAction); time.monotonic()
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._workers = {}          # (ip, port) -> single-thread executor that sends that camera's POLLs and ABORTs
+        self._polling = 0           # actions handed to a worker and not back in _due (or finished) yet
+        # stats
+        self.actions = 0
+        self.polls = 0
+        self.timeouts = 0
+
+    def expected(self, api):
+        with self._cond:
+            return self._estimates.get(api, DEFAULT_EXPECTED)
+
+    def submit(self, ip, port, action_dict):
+        """
+        Send a NET_REQUEST_ACTION and poll for its results in the background
+        :return: concurrent.futures.Future whose result is the final response dictionary; if the ACTION is not
+                 ACKed (NAK, PROBLEM) the Future is already done with that response
+        """
+        future = concurrent.futures.Future()
+        future.set_running_or_notify_cancel()
+        ack = self.client.request(ip, port, action_dict)
+        if ack.get('NetCmd') != "NET_RESPONSE_ACK":
+            future.set_result(ack)
+            return future
+        pending = _PendingAction(ip, port, action_dict, ack, future, self.action_timeout)
+        with self._cond:
+            self.actions += 1
+        # a queued action also has to wait for the ones ahead of it
+        expected = self.expected(pending.api) * (1 + pending.queue_position)
+        self._schedule(pending, time.monotonic() + FIRST_POLL_LEAD * expected)
+        return future
+
+    def _schedule(self, pending, when, start=True):
+        with self._cond:
+            if self._thread is None:
+                if not start:
+                    return      # a POLL that was being sent when stop() was called
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, name="PollScheduler", daemon=True)
+                self._thread.start()
+            heapq.heappush(self._due, (min(when, pending.give_up), next(self._seq), pending))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopping:
+                    now = time.monotonic()
+                    if self._due and self._due[0][0] <= now:
+                        break
+                    self._cond.wait(self._due[0][0] - now if self._due else None)
+                if self._stopping:
+                    return
+                pending = heapq.heappop(self._due)[2]
+                endpoint = (pending.ip, pending.port)
+                worker = self._workers.get(endpoint)
+                if worker is None:
+                    worker = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="Poll")
+                    self._workers[endpoint] = worker
+                self._polling += 1
+            worker.submit(self._poll_on_worker, pending)
+
+    def _poll_on_worker(self, pending):
+        try:
+            self._poll(pending)
+        except Exception as e:
+            pending.future.set_exception(e)
+        finally:
+            with self._cond:
+                self._polling -= 1
+
+    def _poll(self, pending):
+        if time.monotonic() >= pending.give_up:
+            resp = self.client.request(pending.ip, pending.port, pending.request("NET_REQUEST_ABORT"))
+            if resp.get('NetCmd') != "NET_RESPONSE_RESULTS":     # it may have finished just now
+                with self._cond:
+                    self.timeouts += 1
+                print("[C]: Gave up waiting for %s on camera %s" % (pending.api, pending.camera))
+                resp = camera_client.problem("Timeout occurred waiting for action results",
+                                             "No results after %.1f seconds; action aborted" % self.action_timeout)
+            pending.future.set_result(resp)
+            return
+
+        resp = self.client.request(pending.ip, pending.port, pending.request("NET_REQUEST_POLL"))
+        pending.polls += 1
+        with self._cond:
+            self.polls += 1
+        if resp.get('NetCmd') == "NET_RESPONSE_WAIT":
+            remaining = self.expected(pending.api) - resp.get('duration', 0.0)
+            self._schedule(pending, time.monotonic() + max(pending.interval, remaining), start=False)
+            pending.interval = min(2 * pending.interval, MAX_POLL_INTERVAL)
+            return
+        if resp.get('NetCmd') == "NET_RESPONSE_RESULTS" and pending.queue_position == 0:
+            # (a queued action's completed_duration includes the wait in the queue, so it isn't used)
+            self._learn(pending.api, resp.get('completed_duration'))
+        pending.future.set_result(resp)
+
+    def _learn(self, api, completed_duration):
+        if not isinstance(completed_duration, (int, float)):
+            return
+        with self._cond:
+            estimate = self._estimates.get(api)
+            if estimate is None:
+                self._estimates[api] = completed_duration
+            else:
+                self._estimates[api] = (1 - ESTIMATE_WEIGHT) * estimate + ESTIMATE_WEIGHT * completed_duration
+
+    def stop(self):
+        # actions still in flight are left unresolved
+        with self._cond:
+            thread, self._thread = self._thread, None
+            self._stopping = True
+            self._cond.notify()
+        if thread is not None:
+            thread.join()
+        with self._cond:
+            workers, self._workers = list(self._workers.values()), {}
+        for worker in workers:
+            worker.shutdown(wait=True)      # lets a POLL already being sent finish
+
+    def stats(self):
+        with self._cond:
+            return {
+                'in_flight': len(self._due) + self._polling,
+                'actions': self.actions,
+                'polls': self.polls,
+                'polls_per_action': round(self.polls / self.actions, 2) if self.actions else None,
+                'timeouts': self.timeouts,
+                'expected': {api: round(estimate, 3) for api, estimate in self._estimates.items()}}
+
+
+poll_scheduler = PollScheduler()
+
+
+def submit(ip, port, action_dict):
+    # PollScheduler.submit() with the default scheduler
+    return poll_scheduler.submit(ip, port, action_dict)
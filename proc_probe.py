@@ -0,0 +1,297 @@
+# proc_probe.py
+#
+# In-process readers for the RPi system info in API_STATUS, replacing the programs build_rpi_info() used to fork
+# (each fork+exec costs a few MB and some tens of ms on a Pi; top -n 1 -b alone takes about a second).
+#
+# Everything is read from /proc, /sys/class/thermal and os.statvfs. Each reader returns structured numbers; the
+# *_text() functions format the same numbers like the output of the program they replace (df -h, uptime, top, ps -ef,
+# vcgencmd measure_temp), so the legacy text fields of the status response stay readable for the PC operators.
+#
+# CPU percentages need two samples: ProcProbe remembers the previous /proc/stat and per-process CPU times, so each
+# call reports the CPU use since the previous call (the status collector calls it every few seconds).
+#
+# Linux only; on other computers the readers return empty/zero values instead of raising.
+
+import math
+import os
+import pwd
+import threading
+import time
+
+THERMAL_ZONE = "/sys/class/thermal/thermal_zone0/temp"
+
+try:
+    CLK_TCK = os.sysconf("SC_CLK_TCK")
+    PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError, OSError):
+    CLK_TCK = 100
+    PAGE_SIZE = 4096
+
+
+def _read_text(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return ""
+
+
+# -----------------------------------------------------------------------------------------------------------
+# Disk, uptime, load, memory, temperature
+
+def disk_usage(path="/"):
+    # like df: sizes in bytes of the file system holding path
+    st = os.statvfs(path)
+    total = st.f_blocks * st.f_frsize
+    free = st.f_bavail * st.f_frsize
+    used = (st.f_blocks - st.f_bfree) * st.f_frsize
+    return {
+        'total': total,
+        'used': used,
+        'free': free,
+        'percent': round(100.0 * used / (used + free), 1) if used + free else 0.0}
+
+
+def uptime_seconds():
+    text = _read_text("/proc/uptime")
+    return float(text.split()[0]) if text else 0.0
+
+
+def load_average():
+    # (1 minute, 5 minute, 15 minute) load averages
+    fields = _read_text("/proc/loadavg").split()
+    if len(fields) < 3:
+        return (0.0, 0.0, 0.0)
+    return tuple(float(value) for value in fields[:3])
+
+
+def meminfo():
+    # /proc/meminfo as a dictionary name -> kB, e.g. 'MemTotal', 'MemAvailable'
+    info = {}
+    for line in _read_text("/proc/meminfo").splitlines():
+        name, _, rest = line.partition(":")
+        fields = rest.split()
+        if fields:
+            info[name] = int(fields[0])
+    return info
+
+
+def cpu_temperature():
+    # degrees C of the SoC, or None if there is no thermal zone (not running on the RPi)
+    text = _read_text(THERMAL_ZONE)
+    if not text.strip():
+        return None
+    return round(int(text) / 1000.0, 1)
+
+
+def watchdog_log(path, recent=5):
+    # (number of lines, last `recent` lines as text) of the watchdog log; (-999, "") if it can't be read
+    try:
+        with open(path, "rb") as f:
+            count = 0
+            tail = []
+            for line in f:
+                count += 1
+                tail.append(line)
+                if len(tail) > recent:
+                    del tail[0]
+    except OSError:
+        return -999, ""
+    return count, b"".join(tail).decode("utf-8", "replace")
+
+
+# -----------------------------------------------------------------------------------------------------------
+# Processes
+
+_user_names = {}
+
+
+def _user_name(uid):
+    name = _user_names.get(uid)
+    if name is None:
+        try:
+            name = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            name = str(uid)
+        _user_names[uid] = name
+    return name
+
+
+def _read_process(pid):
+    # one /proc/[pid]/stat as a dictionary, or None if the process has gone away
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            stat = f.read()
+        uid = os.stat("/proc/%d" % pid).st_uid
+    except OSError:
+        return None
+    # the command name is in parentheses and may itself contain spaces or parentheses
+    comm = stat[stat.index("(") + 1:stat.rindex(")")]
+    fields = stat[stat.rindex(")") + 2:].split()
+    cmdline = _read_text("/proc/%d/cmdline" % pid).replace("\0", " ").strip()
+    return {
+        'pid': pid,
+        'ppid': int(fields[1]),
+        'user': _user_name(uid),
+        'state': fields[0],
+        'name': comm,
+        'cmd': cmdline or "[%s]" % comm,
+        'ticks': int(fields[11]) + int(fields[12]),     # utime + stime
+        'start_ticks': int(fields[19]),
+        'rss_kb': int(fields[21]) * PAGE_SIZE // 1024}
+
+
+def _pids():
+    try:
+        return [int(name) for name in os.listdir("/proc") if name.isdigit()]
+    except OSError:
+        return []
+
+
+def _cpu_ticks():
+    # (busy, total) jiffies of all CPUs from the first line of /proc/stat, plus the per-mode values
+    line = _read_text("/proc/stat").partition("\n")[0]
+    values = [int(v) for v in line.split()[1:]]
+    if len(values) < 4:
+        return 0, 0, values
+    idle = values[3] + (values[4] if len(values) > 4 else 0)      # idle + iowait
+    total = sum(values[:8])     # guest time is already counted in user/nice
+    return total - idle, total, values
+
+
+class ProcProbe:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_cpu = None           # (busy, total, values) from the previous cpu_usage() call
+        self._last_ticks = {}           # pid -> ticks from the previous processes() call
+        self._last_time = None
+
+    def cpu_usage(self):
+        """
+        :return: dictionary of percent of all CPUs since the previous call: 'cpu_percent' (busy) plus 'us', 'sy',
+                 'ni', 'id', 'wa' like the %Cpu(s) line of top. The first call measures over a short pause.
+        """
+        with self._lock:
+            if self._last_cpu is None:
+                self._last_cpu = _cpu_ticks()
+                time.sleep(0.1)
+            busy, total, values = _cpu_ticks()
+            last_busy, last_total, last_values = self._last_cpu
+            self._last_cpu = (busy, total, values)
+        elapsed = total - last_total
+        if elapsed <= 0 or len(values) < 5 or len(last_values) < 5:
+            return {'cpu_percent': 0.0, 'us': 0.0, 'sy': 0.0, 'ni': 0.0, 'id': 100.0, 'wa': 0.0}
+        delta = [now - before for now, before in zip(values, last_values)]
+        return {
+            'cpu_percent': round(100.0 * (busy - last_busy) / elapsed, 1),
+            'us': round(100.0 * delta[0] / elapsed, 1),
+            'ni': round(100.0 * delta[1] / elapsed, 1),
+            'sy': round(100.0 * delta[2] / elapsed, 1),
+            'id': round(100.0 * delta[3] / elapsed, 1),
+            'wa': round(100.0 * delta[4] / elapsed, 1)}
+
+    def processes(self):
+        """
+        :return: list of process dictionaries (see _read_process()) with 'cpu_percent' (of one CPU, like top) since the
+                 previous call, and 'mem_percent'. The first call measures over a short pause.
+        """
+        with self._lock:
+            if self._last_time is None:
+                self._last_ticks = {}
+                for pid in _pids():
+                    proc = _read_process(pid)
+                    if proc is not None:
+                        self._last_ticks[pid] = proc['ticks']
+                self._last_time = time.monotonic()
+                time.sleep(0.1)
+            now = time.monotonic()
+            elapsed_ticks = max(now - self._last_time, 0.001) * CLK_TCK
+            mem_total = meminfo().get('MemTotal', 0)
+            procs = []
+            ticks = {}
+            for pid in _pids():
+                proc = _read_process(pid)
+                if proc is None:
+                    continue
+                ticks[pid] = proc['ticks']
+                before = self._last_ticks.get(pid, proc['ticks'])
+                proc['cpu_percent'] = round(100.0 * (proc['ticks'] - before) / elapsed_ticks, 1)
+                proc['mem_percent'] = round(100.0 * proc['rss_kb'] / mem_total, 1) if mem_total else 0.0
+                procs.append(proc)
+            self._last_ticks = ticks
+            self._last_time = now
+        return procs
+
+
+# -----------------------------------------------------------------------------------------------------------
+# Legacy text, formatted like the programs these readers replace
+
+def _format_size(num_bytes):
+    # like df -h: 1K based, one decimal below 10
+    for unit in ("", "K", "M", "G", "T"):
+        if num_bytes < 1024 or unit == "T":
+            break
+        num_bytes /= 1024.0
+    if unit == "":
+        return "%d" % num_bytes
+    return ("%.1f%s" if num_bytes < 10 else "%.0f%s") % (num_bytes, unit)
+
+
+def disk_usage_text(path, usage):
+    # the line of df -h for the file system holding path
+    return ("%-16s %6s %6s %6s %5s %s\n" % ("Filesystem", "Size", "Used", "Avail", "Use%", "Mounted on") +
+            "%-16s %6s %6s %6s %4d%% %s\n" % (path, _format_size(usage['total']), _format_size(usage['used']),
+                                              _format_size(usage['free']), math.ceil(usage['percent']), path))
+
+
+def _up_text(seconds):
+    days, rest = divmod(int(seconds), 86400)
+    hours, rest = divmod(rest, 3600)
+    minutes = rest // 60
+    if days:
+        return "%d day%s, %2d:%02d" % (days, "" if days == 1 else "s", hours, minutes)
+    return "%2d:%02d" % (hours, minutes)
+
+
+def uptime_text(seconds, load):
+    return " %s up %s,  load average: %.2f, %.2f, %.2f\n" % ((time.strftime("%H:%M:%S"), _up_text(seconds)) + load)
+
+
+def cpu_temp_text(temperature):
+    # like vcgencmd measure_temp
+    return "" if temperature is None else "temp=%.1f'C\n" % temperature
+
+
+def _cpu_time_text(ticks):
+    seconds = ticks / CLK_TCK
+    return "%d:%05.2f" % divmod(seconds, 60)
+
+
+def top_text(seconds, load, cpu, mem, procs, limit=20):
+    # like the first screen of top -n 1 -b, busiest processes first
+    running = sum(1 for proc in procs if proc['state'] == "R")
+    lines = [
+        "top - %s up %s,  load average: %.2f, %.2f, %.2f" % ((time.strftime("%H:%M:%S"), _up_text(seconds)) + load),
+        "Tasks: %d total, %d running" % (len(procs), running),
+        "%%Cpu(s): %4.1f us, %4.1f sy, %4.1f ni, %4.1f id, %4.1f wa" % (
+            cpu['us'], cpu['sy'], cpu['ni'], cpu['id'], cpu['wa']),
+        "MiB Mem : %8.1f total, %8.1f free, %8.1f avail Mem" % (
+            mem.get('MemTotal', 0) / 1024.0, mem.get('MemFree', 0) / 1024.0, mem.get('MemAvailable', 0) / 1024.0),
+        "",
+        "  PID USER        RES S  %CPU  %MEM     TIME+ COMMAND"]
+    for proc in sorted(procs, key=lambda p: (-p['cpu_percent'], -p['rss_kb']))[:limit]:
+        lines.append("%5d %-8.8s %7d %s %5.1f %5.1f %9s %s" % (
+            proc['pid'], proc['user'], proc['rss_kb'], proc['state'], proc['cpu_percent'], proc['mem_percent'],
+            _cpu_time_text(proc['ticks']), proc['name']))
+    return "\n".join(lines) + "\n"
+
+
+def ps_text(procs, boot_time):
+    # like ps -ef (without the TTY column)
+    lines = ["%-8s %5s %5s %5s %8s %s" % ("UID", "PID", "PPID", "STIME", "TIME", "CMD")]
+    for proc in sorted(procs, key=lambda p: p['pid']):
+        started = time.localtime(boot_time + proc['start_ticks'] / CLK_TCK)
+        lines.append("%-8.8s %5d %5d %5s %8s %s" % (
+            proc['user'], proc['pid'], proc['ppid'], time.strftime("%H:%M", started),
+            time.strftime("%H:%M:%S", time.gmtime(proc['ticks'] // CLK_TCK)), proc['cmd']))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,350 @@
+# rpi_status.py
+#
+# Background collector for the RPi system info returned by API_STATUS (and the status_detail field of the
+# examine/check actions). build_rpi_info() used to fork up to 10 programs (df, uptime, wc, tail, vcgencmd, top, cat x2,
+# uname, ps) one after the other on the request thread, every time any PC asked for status; several PCs polling could
+# keep the RPi busy doing nothing else.
+#
+# Now each status_detail bit group is collected by a background thread on its own interval, and requests are answered
+# from the cache. Values are read in-process from /proc, /sys and os.statvfs (see proc_probe.py) instead of forking
+# a program, and each group has numeric fields next to the legacy text ones.
+# Every cached field has an age: the response includes 'status_age', a dictionary of field name -> seconds since the
+# value was collected. If a group was never collected, or its value is older than its TTL (the collector is stuck or
+# the group was not being refreshed), it is collected right away on the request thread.
+#
+# A group is only refreshed in the background while someone is asking for it (requested in the last IDLE_AFTER
+# seconds), so the RPi does no status work when no PC is polling.
+#
+# status_detail bits (see also common.py, build_rpi_info()):
+#     1   Outfeed camera thread info; live fields registered by the camera modules (see register_live_field())
+#     2   disk_usage, uptime; disk_total, disk_used, disk_free (bytes), disk_percent, uptime_seconds, load_avg;
+#         archive_retention (live field, see archive_retention.py); api_metrics (live field, see net_registry.py)
+#     4   watchdog_count, watchdog_recent
+#     8   cpu_temp, top; cpu_temp_c, cpu_percent, mem_total_kb, mem_available_kb
+#     16  debian, release, kernal
+#     32  processes; process_count
+
+import json
+import os
+import threading
+import time
+
+import proc_probe
+from proc_probe import ProcProbe
+
+DETAIL_OUTFEED = 1
+DETAIL_SYSTEM = 2
+DETAIL_WATCHDOG = 4
+DETAIL_CPU = 8
+DETAIL_OS = 16
+DETAIL_PROCESSES = 32
+DEFAULT_DETAIL = 3
+
+WATCHDOG_LOG = "/home/pi/ImpossibleObjects/watchdog/watchdog.log"
+
+# seconds between background refreshes of each group; the OS group hardly ever changes
+GROUP_INTERVALS = {
+    DETAIL_SYSTEM: 30,
+    DETAIL_WATCHDOG: 60,
+    DETAIL_CPU: 5,
+    DETAIL_OS: 3600,
+    DETAIL_PROCESSES: 10,
+}
+# Structured status (see select_fields() and fit_to_budget() below)
+# field name -> status_detail bit of the group that collects it
+FIELD_GROUPS = {
+    "disk_usage": DETAIL_SYSTEM, "uptime": DETAIL_SYSTEM, "disk_total": DETAIL_SYSTEM, "disk_used": DETAIL_SYSTEM,
+    "disk_free": DETAIL_SYSTEM, "disk_percent": DETAIL_SYSTEM, "uptime_seconds": DETAIL_SYSTEM,
+    "load_avg": DETAIL_SYSTEM,
+    "watchdog_count": DETAIL_WATCHDOG, "watchdog_recent": DETAIL_WATCHDOG,
+    "cpu_temp": DETAIL_CPU, "top": DETAIL_CPU, "cpu_temp_c": DETAIL_CPU, "cpu_percent": DETAIL_CPU,
+    "mem_total_kb": DETAIL_CPU, "mem_available_kb": DETAIL_CPU,
+    "debian": DETAIL_OS, "release": DETAIL_OS, "kernal": DETAIL_OS,
+    "processes": DETAIL_PROCESSES, "process_count": DETAIL_PROCESSES, "top_processes": DETAIL_PROCESSES,
+}
+# field name -> (status_detail bit, function returning the value): fields that are cheap to read from a running
+# part of the server (e.g. the analysis pool's queue), so they are read on every request instead of cached
+LIVE_FIELDS = {}
+# the multi-line text fields, left out of structured responses unless asked for by name
+TEXT_FIELDS = ("disk_usage", "uptime", "watchdog_recent", "cpu_temp", "top", "debian", "release", "kernal", "processes")
+# order in which fields are cut down when a status response is over its byte budget, least useful first;
+# the numeric fields are small and never cut
+TRIM_ORDER = ("processes", "top", "release", "debian", "kernal", "watchdog_recent", "top_processes", "disk_usage",
+              "uptime", "cpu_temp")
+TRUNCATED_MARK = "\n...[truncated]\n"
+MIN_TEXT_KEPT = 200         # a text field that would be cut below this many characters is dropped instead
+STATUS_BYTE_BUDGET = 32 * 1024      # default size limit of the status fields of a response; a request can ask for more
+PROCESS_SUMMARY_KEYS = ("pid", "name", "user", "cpu_percent", "mem_percent", "rss_kb")
+TOP_N = 5               # busiest processes in top_processes unless the request asks for a different number
+TOP_N_MAX = 20          # most the collector keeps
+
+TTL_FACTOR = 3          # a cached group is stale (collected again on the request thread) after TTL_FACTOR intervals
+IDLE_AFTER = 300        # stop refreshing a group in the background if nobody asked for it for this many seconds
+
+
+# -----------------------------------------------------------------------------------------------------------
+# Collectors: one function per status_detail group, returning a dictionary of fields
+
+def _read_text(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return ""
+
+
+# separate probes so the CPU percentages of each group are measured over that group's own interval
+_cpu_probe = ProcProbe()
+_process_probe = ProcProbe()
+
+
+def collect_system():
+    usage = proc_probe.disk_usage("/")
+    seconds = proc_probe.uptime_seconds()
+    load = proc_probe.load_average()
+    return {
+        "disk_usage": proc_probe.disk_usage_text("/", usage),
+        "uptime": proc_probe.uptime_text(seconds, load),
+        "disk_total": usage['total'],
+        "disk_used": usage['used'],
+        "disk_free": usage['free'],
+        "disk_percent": usage['percent'],
+        "uptime_seconds": round(seconds, 1),
+        "load_avg": list(load)}
+
+
+def collect_watchdog():
+    # This is how many times the watchdog timer has restarted; this includes power-up as well as reboot cmds
+    # It can be watched over time to see how often the watchdog runs. Note that the watchdog can be triggered
+    # to reboot the RPi via GPIO signal. (It is also possible to reboot the RPi using a network message from
+    # the client; however this is not recorded as a watchdog event.) In the future the hardware will be able
+    # to power cycle the RPi to insure it reboots, but this is in the future.
+    count, recent = proc_probe.watchdog_log(WATCHDOG_LOG, 5)     # -999 flag in case of problem
+    return {
+        "watchdog_count": count,
+        # This lists the five most recent times the watchdog restarted
+        "watchdog_recent": recent}
+
+
+def collect_cpu():
+    temperature = proc_probe.cpu_temperature()
+    cpu = _cpu_probe.cpu_usage()
+    mem = proc_probe.meminfo()
+    procs = _cpu_probe.processes()
+    return {
+        "cpu_temp": proc_probe.cpu_temp_text(temperature),
+        "top": proc_probe.top_text(proc_probe.uptime_seconds(), proc_probe.load_average(), cpu, mem, procs),
+        "cpu_temp_c": temperature,
+        "cpu_percent": cpu['cpu_percent'],
+        "mem_total_kb": mem.get('MemTotal', 0),
+        "mem_available_kb": mem.get('MemAvailable', 0)}
+
+
+def collect_os():
+    return {
+        "debian": _read_text("/etc/debian"),
+        "release": _read_text("/etc/os-release"),
+        "kernal": " ".join(os.uname()) + "\n"}
+
+
+def collect_processes():
+    procs = _process_probe.processes()
+    busiest = sorted(procs, key=lambda p: (-p['cpu_percent'], -p['rss_kb']))[:TOP_N_MAX]
+    return {
+        "processes": proc_probe.ps_text(procs, time.time() - proc_probe.uptime_seconds()),
+        "process_count": len(procs),
+        "top_processes": [{key: proc[key] for key in PROCESS_SUMMARY_KEYS} for proc in busiest]}
+
+
+COLLECTORS = {
+    DETAIL_SYSTEM: collect_system,
+    DETAIL_WATCHDOG: collect_watchdog,
+    DETAIL_CPU: collect_cpu,
+    DETAIL_OS: collect_os,
+    DETAIL_PROCESSES: collect_processes,
+}
+
+
+def register_live_field(name, bit, provider):
+    # Add a live field (see LIVE_FIELDS); register before building a schema from FIELD_GROUPS
+    LIVE_FIELDS[name] = (bit, provider)
+    FIELD_GROUPS[name] = bit
+
+
+# -----------------------------------------------------------------------------------------------------------
+class _CachedGroup:
+    def __init__(self, bit, collector, interval):
+        self.bit = bit
+        self.collector = collector
+        self.interval = interval
+        self.fields = None          # dictionary from the last collection, None until collected once
+        self.collected = 0.0        # time.monotonic() of the last collection
+        self.requested = float("-inf")  # time.monotonic() of the last request for this group
+        self.lock = threading.Lock()    # one collection at a time, so a burst of requests forks only once
+
+    def refresh(self, only_if_stale=False):
+        with self.lock:
+            if only_if_stale and not self.is_stale(time.monotonic()):
+                return      # another thread collected it while we waited for the lock
+            try:
+                fields = self.collector()
+            except Exception as e:
+                print("{S}: Error collecting status group %d: %s" % (self.bit, e))
+                fields = {"status_error_%d" % self.bit: str(e)}
+            self.fields = fields
+            self.collected = time.monotonic()
+
+    def is_stale(self, now):
+        return self.fields is None or now - self.collected > self.interval * TTL_FACTOR
+
+    def is_due(self, now):
+        return now - self.requested < IDLE_AFTER and now - self.collected >= self.interval
+
+
+class StatusCollector:
+    def __init__(self, intervals=None, collectors=None):
+        intervals = dict(GROUP_INTERVALS, **(intervals or {}))
+        collectors = collectors or COLLECTORS
+        self._groups = {bit: _CachedGroup(bit, collectors[bit], intervals[bit]) for bit in sorted(collectors)}
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, name="StatusCollector", daemon=True)
+                self._thread.start()
+
+    def get(self, detail):
+        """
+        :param detail: status_detail bit flags
+        :return: dictionary of the fields for the requested groups, plus 'status_age' (field -> seconds since collected)
+        """
+        self.start()
+        now = time.monotonic()
+        info_dict = {}
+        ages = {}
+        woke = False
+        for bit, group in self._groups.items():
+            if not detail & bit:
+                continue
+            if now - group.requested >= IDLE_AFTER:
+                woke = True     # group was idle; the background thread needs to put it back on its schedule
+            group.requested = now
+            if group.is_stale(now):
+                group.refresh(only_if_stale=True)
+            fields, collected = group.fields, group.collected
+            info_dict.update(fields)
+            age = round(max(0.0, time.monotonic() - collected), 3)
+            for name in fields:
+                ages[name] = age
+        if woke:
+            self._wakeup.set()
+        for name, (bit, provider) in LIVE_FIELDS.items():
+            if detail & bit:
+                try:
+                    info_dict[name] = provider()
+                except Exception as e:
+                    print("{S}: Error reading status field %s: %s" % (name, e))
+                    info_dict["status_error_" + name] = str(e)
+                ages[name] = 0.0
+        info_dict["status_age"] = ages
+        return info_dict
+
+    def _run(self):
+        while not self._stopping:
+            now = time.monotonic()
+            next_due = now + IDLE_AFTER
+            for group in self._groups.values():
+                if group.is_due(now):
+                    group.refresh()
+                    now = time.monotonic()
+                if now - group.requested < IDLE_AFTER:
+                    next_due = min(next_due, group.collected + group.interval)
+            self._wakeup.wait(max(0.05, next_due - time.monotonic()))
+            self._wakeup.clear()
+
+    def shutdown(self):
+        self._stopping = True
+        self._wakeup.set()
+        with self._start_lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+
+status_collector = StatusCollector()
+
+
+# -----------------------------------------------------------------------------------------------------------
+# Structured, compact status responses
+
+def detail_for_fields(fields):
+    # status_detail bits needed to collect the named fields
+    detail = 0
+    for name in fields:
+        detail |= FIELD_GROUPS.get(name, 0)
+    return detail
+
+
+def select_fields(info_dict, fields=None, structured=False, top_n=TOP_N):
+    """
+    :param info_dict: from StatusCollector.get()
+    :param fields: list of field names to keep, or None for all
+    :param structured: True leaves out the TEXT_FIELDS (unless they are named in fields)
+    :param top_n: number of processes kept in top_processes
+    :return: new dictionary with only the selected fields (and their status_age)
+    """
+    if fields is not None:
+        keep = set(fields)
+    elif structured:
+        keep = set(FIELD_GROUPS) - set(TEXT_FIELDS)
+    else:
+        keep = set(FIELD_GROUPS)
+    selected = {name: value for name, value in info_dict.items() if name in keep or name.startswith("status_error")}
+    if "top_processes" in selected:
+        selected["top_processes"] = selected["top_processes"][:top_n]
+    selected["status_age"] = {name: age for name, age in info_dict.get("status_age", {}).items() if name in selected}
+    return selected
+
+
+def _json_size(value):
+    return len(json.dumps(value))
+
+
+def fit_to_budget(info_dict, budget=STATUS_BYTE_BUDGET):
+    """
+    Cut down the lowest priority fields (TRIM_ORDER) until the JSON encoding of info_dict is at most budget bytes:
+    text is truncated (marked with TRUNCATED_MARK), lists lose their last entries, and a field that would be too short
+    to be useful is dropped. The names of the fields that were cut are listed in 'status_truncated'.
+    This changes info_dict; cached lists are copied before being shortened.
+    """
+    excess = _json_size(info_dict) - budget
+    truncated = []
+    for name in TRIM_ORDER:
+        if excess <= 0:
+            break
+        if name not in info_dict:
+            continue
+        value = info_dict[name]
+        before = _json_size(value)
+        if isinstance(value, str) and len(value) - excess - len(TRUNCATED_MARK) >= MIN_TEXT_KEPT:
+            # cut a little more than needed, since escaped characters take more than one byte in JSON
+            keep = len(value) - excess - len(TRUNCATED_MARK) - (before - len(value))
+            info_dict[name] = value[:max(keep, MIN_TEXT_KEPT)] + TRUNCATED_MARK
+        elif isinstance(value, list) and len(value) > 1:
+            value = list(value)
+            while len(value) > 1 and _json_size(value) > before - excess:
+                value.pop()
+            info_dict[name] = value
+        else:
+            del info_dict[name]
+            info_dict.get("status_age", {}).pop(name, None)
+        truncated.append(name)
+        excess = _json_size(info_dict) - budget
+    if truncated:
+        info_dict["status_truncated"] = truncated
+    return info_dict
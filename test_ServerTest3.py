@@ -1,6 +1,12 @@
+import socket
+import threading
+import time
 import unittest
-import ServerTest2 as ClientLogic
-# TODO: move client logic to different package; doesn't belong in something called "Server"
+import ServerTest2 as ClientLogic      # client() is a wrapper around camera_client.py
+import camera_client
+import net_codec
+import net_protocol
+import poll_scheduler
 # TODO: in fact, this test_Server2.py file should be called something else; it is USED to test Camera net protocol
 
 
@@ -103,7 +109,7 @@ class TestMethods(unittest.TestCase):
             "NetCmd": "NET_REQUEST_IMMEDIATE",
             "API": "garbage",
             "Camera": "Test",
-            "BigField": "x" * 3000
+            "BigField": "x" * ClientLogic.MAX_FRAME_SIZE
         }
         resp = ClientLogic.client(TestMethods.ip, TestMethods.port, req_dict)
         print("(T): -->",resp)
@@ -163,6 +169,23 @@ class TestMethods(unittest.TestCase):
         self.assertEqual(resp["Status"],"Missing Request field(s)")
         self.assertEqual(resp["Response"], True)
 
+    def test_msg_IMMEDIATE_START_HARDWARE_Invalid_Field(self):
+        req_dict = {
+            "NetCmd": "NET_REQUEST_IMMEDIATE",
+            "API": "API_START_HARDWARE",
+            "Camera": "Test",
+            "x_resolution": "640",
+            "y_resolution": 480,
+            "image_format": "JPG",
+            "page_size": "12x8"
+        }
+        resp = ClientLogic.client(TestMethods.ip, TestMethods.port, req_dict)
+        print("(T): -->",resp)
+        self.assertEqual(resp["NetCmd"], "NET_RESPONSE_PROBLEM")
+        self.assertEqual(resp["Status"], "Invalid Request field(s)")
+        self.assertIn("x_resolution", resp["ErrorDetails"])
+        self.assertEqual(resp["Response"], True)
+
     # ---[Test normal operation of Immediate Requests]----------------------------------------------
     def test_msg_IMMEDIATE_PING(self):
         req_dict = {
@@ -179,27 +202,201 @@ class TestMethods(unittest.TestCase):
         self.assertEqual(resp["Status"], "OK")
         self.assertEqual(resp["Response"], True)
 
+    def test_client_threads(self):
+        # one client shared by several threads; each request gets a pooled connection of its own
+        client = camera_client.CameraClient()
+        statuses = []
+
+        def ping():
+            for _ in range(10):
+                resp = client.request(TestMethods.ip, TestMethods.port,
+                                      {"NetCmd": "NET_REQUEST_IMMEDIATE", "API": "API_PING", "Camera": "Test"})
+                statuses.append(resp["Status"])
+        threads = [threading.Thread(target=ping) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        client.close()
+        self.assertEqual(statuses, ["OK"] * 40)
+        self.assertLessEqual(client.stats()['connects'], 4)
+
+    def test_idle_connections_do_not_hold_workers(self):
+        # more idle keep-alive connections than the server has workers; each new one is still answered right away
+        start = time.time()
+        idle_clients = [camera_client.CameraClient() for _ in range(12)]
+        for idle_client in idle_clients:
+            idle_client.request(TestMethods.ip, TestMethods.port,
+                                {"NetCmd": "NET_REQUEST_IMMEDIATE", "API": "API_PING", "Camera": "TestIdle"})
+        client = camera_client.CameraClient()
+        resp = client.request(TestMethods.ip, TestMethods.port,
+                              {"NetCmd": "NET_REQUEST_IMMEDIATE", "API": "API_PING", "Camera": "TestIdle"})
+        elapsed = time.time() - start
+        for idle_client in idle_clients + [client]:
+            idle_client.close()
+        self.assertEqual(resp["Status"], "OK")
+        self.assertLess(elapsed, 1.0)
+
+    def test_client_no_resend_of_sent_action(self):
+        # A local stand-in server answers the first request on each connection, then drops the connection after
+        # reading the second. An ACTION the server may have started must not be sent again; a PING may.
+        listener = socket.create_server(("127.0.0.1", 0))
+        listener.settimeout(5)
+        received = []
+
+        def serve():
+            for _ in range(3):
+                conn, _ = listener.accept()
+                with conn:
+                    reader = net_protocol.FrameReader(conn)
+                    received.append(net_codec.JSON_CODEC.decode(reader.read_frame())["NetCmd"])
+                    net_protocol.send_frame(conn, net_codec.JSON_CODEC.encode(
+                        {"NetCmd": "NET_RESPONSE_IMMEDIATE", "TS2": 0, "TS3": 0}))
+                    payload = reader.read_frame()
+                    if payload is not None:
+                        received.append(net_codec.JSON_CODEC.decode(payload)["NetCmd"])
+        server_thread = threading.Thread(target=serve, daemon=True)
+        server_thread.start()
+        endpoint = listener.getsockname()
+        client = camera_client.CameraClient(codec=net_codec.JSON_CODEC)
+        ping = {"NetCmd": "NET_REQUEST_IMMEDIATE", "API": "API_PING", "Camera": "Test"}
+        client.request(*endpoint, ping)
+        resp = client.request(*endpoint, {"NetCmd": "NET_REQUEST_ACTION", "API": "API_EXAMINE_PLATEN_PAGE",
+                                          "Camera": "Test", "page_num": 1})
+        self.assertEqual(resp["NetCmd"], "NET_RESPONSE_PROBLEM")
+
+        client.request(*endpoint, ping)
+        resp = client.request(*endpoint, ping)      # sent again on a fresh connection
+        client.close()
+        server_thread.join()
+        listener.close()
+        self.assertEqual(resp["NetCmd"], "NET_RESPONSE_IMMEDIATE")
+        self.assertEqual(received, ["NET_REQUEST_IMMEDIATE", "NET_REQUEST_ACTION",
+                                    "NET_REQUEST_IMMEDIATE", "NET_REQUEST_IMMEDIATE", "NET_REQUEST_IMMEDIATE"])
+
+    def test_client_fan_out(self):
+        # the same request to several cameras at once; an unreachable camera gets a problem response of its own
+        client = camera_client.CameraClient()
+        cameras = {"Platen": (TestMethods.ip, TestMethods.port),
+                   "Outfeed": (TestMethods.ip, TestMethods.port),
+                   "Stacker": ("127.0.0.1", 1)}
+        resp = client.fan_out(cameras, {"NetCmd": "NET_REQUEST_IMMEDIATE", "API": "API_PING"}, deadline=2.0)
+        client.close()
+        print("(T): -->", resp)
+        self.assertEqual(resp["Platen"]["Status"], "OK")
+        self.assertEqual(resp["Outfeed"]["Status"], "OK")
+        self.assertEqual(resp["Stacker"]["NetCmd"], "NET_RESPONSE_PROBLEM")
+
+    def test_msg_IMMEDIATE_STATUS_cached(self):
+        req_dict = {
+            "NetCmd": "NET_REQUEST_IMMEDIATE",
+            "API": "API_STATUS",
+            "Camera": "Test",
+            "status_detail": 2
+        }
+        resp = ClientLogic.client(TestMethods.ip, TestMethods.port, dict(req_dict))
+        print("(T): -->",resp)
+        self.assertEqual(resp["NetCmd"], "NET_RESPONSE_IMMEDIATE")
+        self.assertIn("disk_usage", resp)
+        self.assertIn("uptime", resp)
+        self.assertNotIn("processes", resp)
+
+        # second request is answered from the cache; every field says how old it is
+        resp = ClientLogic.client(TestMethods.ip, TestMethods.port, dict(req_dict))
+        self.assertEqual(set(resp["status_age"]), {"disk_usage", "uptime", "disk_total", "disk_used", "disk_free",
+                                                   "disk_percent", "uptime_seconds", "load_avg", "archive_retention",
+                                                   "api_metrics"})
+        self.assertGreaterEqual(resp["status_age"]["uptime"], 0)
+        self.assertGreater(resp["disk_total"], 0)
+        self.assertGreaterEqual(resp["api_metrics"]["NET_REQUEST_IMMEDIATE/API_STATUS"]["count"], 1)
+
+    def test_msg_IMMEDIATE_STATUS_structured(self):
+        req_dict = {
+            "NetCmd": "NET_REQUEST_IMMEDIATE",
+            "API": "API_STATUS",
+            "Camera": "Test",
+            "fields": ["cpu_percent", "process_count", "top_processes", "processes"],
+            "top_n": 3,
+            "max_bytes": 1024
+        }
+        resp = ClientLogic.client(TestMethods.ip, TestMethods.port, req_dict)
+        print("(T): -->",resp)
+        self.assertEqual(resp["NetCmd"], "NET_RESPONSE_IMMEDIATE")
+        self.assertNotIn("disk_usage", resp)
+        self.assertLessEqual(len(resp["top_processes"]), 3)
+        self.assertIn("process_count", resp)
+        # the ps -ef text doesn't fit in 1K, so it is cut instead of the whole response failing
+        self.assertIn("processes", resp["status_truncated"])
+
     def test_msg_IMMEDIATE_START_HARDWARE(self):
         req_dict = {
             "NetCmd": "NET_REQUEST_IMMEDIATE",
             "API": "API_START_HARDWARE",
-            "Camera": "Test"
+            "Camera": "Test",
+            "x_resolution": 640,
+            "y_resolution": 480,
+            "image_format": "JPG",
+            "page_size": "12x8"
         }
         resp = ClientLogic.client(TestMethods.ip, TestMethods.port, req_dict)
         print("(T): -->",resp)
-        assert False
+        self.assertEqual(resp["NetCmd"], "NET_RESPONSE_IMMEDIATE")
+        self.assertEqual(resp["Status"], "Success")
+
+        # once the camera is streaming, pictures come from the running stream
+        req_dict = {
+            "NetCmd": "NET_REQUEST_IMMEDIATE",
+            "API": "API_TAKE_PICTURE",
+            "Camera": "Test",
+            "x_resolution": 640,
+            "y_resolution": 480,
+            "image_format": "JPG"
+        }
+        resp = ClientLogic.client(TestMethods.ip, TestMethods.port, req_dict)
+        print("(T): -->",resp)
+        self.assertEqual(resp["NetCmd"], "NET_RESPONSE_IMMEDIATE")
+        self.assertEqual(resp["x_resolution"], 640)
+        self.assertGreater(resp["frame_number"], 0)
 
-    """
     def test_msg_IMMEDIATE_START_PRINT_JOB(self):
         req_dict = {
             "NetCmd": "NET_REQUEST_IMMEDIATE",
             "API": "API_START_PRINT_JOB",
-            "Camera": "Test"
+            "Camera": "Test",
+            "build_id": 1234,
+            "archive_rpi_images": False
         }
         resp = ClientLogic.client(TestMethods.ip, TestMethods.port, req_dict)
         print("(T): -->",resp)
-        assert False
+        self.assertEqual(resp["NetCmd"], "NET_RESPONSE_IMMEDIATE")
+        self.assertEqual(resp["Status"], "Success")
+
+        # images are written in the background; API_STATUS reports how the writer is keeping up
+        req_dict = {
+            "NetCmd": "NET_REQUEST_IMMEDIATE",
+            "API": "API_STATUS",
+            "Camera": "Test",
+            "fields": ["image_archive", "archive_retention"]
+        }
+        resp = ClientLogic.client(TestMethods.ip, TestMethods.port, req_dict)
+        print("(T): -->",resp)
+        self.assertIn("dropped", resp["image_archive"])
+        self.assertIn("write_ms", resp["image_archive"])
+        self.assertIn("evicted_bytes", resp["archive_retention"])
+
+        # a traveler number that isn't a number is accepted too (its images go under General)
+        req_dict = {
+            "NetCmd": "NET_REQUEST_IMMEDIATE",
+            "API": "API_START_PRINT_JOB",
+            "Camera": "Test",
+            "build_id": "T-77",
+            "archive_rpi_images": False
+        }
+        resp = ClientLogic.client(TestMethods.ip, TestMethods.port, req_dict)
+        print("(T): -->",resp)
+        self.assertEqual(resp["Status"], "Success")
 
+    """
     def test_msg_IMMEDIATE_STATUS(self):
         req_dict = {
             "NetCmd": "NET_REQUEST_IMMEDIATE",
@@ -231,6 +428,412 @@ class TestMethods(unittest.TestCase):
         assert False
     """
 
+    # ---[Test ACTION / POLL / ABORT]----------------------------------------------
+    def test_msg_POLL_no_action(self):
+        req_dict = {
+            "NetCmd": "NET_REQUEST_POLL",
+            "API": "API_EXAMINE_OUTFEED_PAGE",
+            "Camera": "TestIdle"
+        }
+        resp = ClientLogic.client(TestMethods.ip, TestMethods.port, req_dict)
+        print("(T): -->",resp)
+        self.assertEqual(resp["NetCmd"], "NET_RESPONSE_NAK")
+        self.assertEqual(resp["Response"], True)
+
+    def test_msg_ABORT_no_action(self):
+        req_dict = {
+            "NetCmd": "NET_REQUEST_ABORT",
+            "API": "API_EXAMINE_OUTFEED_PAGE",
+            "Camera": "TestIdle"
+        }
+        resp = ClientLogic.client(TestMethods.ip, TestMethods.port, req_dict)
+        print("(T): -->",resp)
+        self.assertEqual(resp["NetCmd"], "NET_RESPONSE_NAK")
+        self.assertEqual(resp["Response"], True)
+
+    def test_msg_ACTION_then_POLL(self):
+        # the analysis works on frames from the camera stream
+        req_dict = {
+            "NetCmd": "NET_REQUEST_IMMEDIATE",
+            "API": "API_START_HARDWARE",
+            "Camera": "Test",
+            "x_resolution": 640,
+            "y_resolution": 480,
+            "image_format": "JPG",
+            "page_size": "12x8"
+        }
+        resp = ClientLogic.client(TestMethods.ip, TestMethods.port, req_dict)
+        self.assertEqual(resp["NetCmd"], "NET_RESPONSE_IMMEDIATE")
+
+        req_dict = {
+            "NetCmd": "NET_REQUEST_ACTION",
+            "API": "API_EXAMINE_PLATEN_PAGE",
+            "Camera": "Test",
+            "page_num": 1,
+            "config_pt_1": [0, 0],
+            "config_pt_2": [640, 480],
+        }
+        resp = ClientLogic.client(TestMethods.ip, TestMethods.port, req_dict)
+        print("(T): -->",resp)
+        self.assertEqual(resp["NetCmd"], "NET_RESPONSE_ACK")
+
+        poll_dict = {
+            "NetCmd": "NET_REQUEST_POLL",
+            "API": "API_EXAMINE_PLATEN_PAGE",
+            "Camera": "Test"
+        }
+        for _ in range(100):
+            resp = ClientLogic.client(TestMethods.ip, TestMethods.port, dict(poll_dict))
+            if resp["NetCmd"] != "NET_RESPONSE_WAIT":
+                break
+            self.assertIn("duration", resp)
+            time.sleep(0.1)
+        print("(T): -->",resp)
+        self.assertEqual(resp["NetCmd"], "NET_RESPONSE_RESULTS")
+        self.assertIn("completed_duration", resp)
+        self.assertEqual(resp["page_num"], 1)
+        self.assertIn("page_found", resp)
+        self.assertIn("skew_deg", resp)
+
+        # results are only returned once
+        resp = ClientLogic.client(TestMethods.ip, TestMethods.port, dict(poll_dict))
+        self.assertEqual(resp["NetCmd"], "NET_RESPONSE_NAK")
+
+    def test_poll_scheduler(self):
+        # the scheduler polls for the results; the Future gives the RESULTS response
+        req_dict = {
+            "NetCmd": "NET_REQUEST_IMMEDIATE",
+            "API": "API_START_HARDWARE",
+            "Camera": "TestPoll",
+            "x_resolution": 640,
+            "y_resolution": 480,
+            "image_format": "JPG",
+            "page_size": "12x8"
+        }
+        resp = ClientLogic.client(TestMethods.ip, TestMethods.port, req_dict)
+        self.assertEqual(resp["NetCmd"], "NET_RESPONSE_IMMEDIATE")
+
+        scheduler = poll_scheduler.PollScheduler()
+        for page_num in (1, 2):
+            req_dict = {
+                "NetCmd": "NET_REQUEST_ACTION",
+                "API": "API_EXAMINE_PLATEN_PAGE",
+                "Camera": "TestPoll",
+                "page_num": page_num,
+                "config_pt_1": [0, 0],
+                "config_pt_2": [640, 480],
+            }
+            resp = scheduler.submit(TestMethods.ip, TestMethods.port, req_dict).result(timeout=30)
+            print("(T): -->", resp)
+            self.assertEqual(resp["NetCmd"], "NET_RESPONSE_RESULTS")
+            self.assertEqual(resp["page_num"], page_num)
+        scheduler.stop()
+        stats = scheduler.stats()
+        print("(T): -->", stats)
+        self.assertEqual(stats["actions"], 2)
+        self.assertIn("API_EXAMINE_PLATEN_PAGE", stats["expected"])
+
+    def test_poll_scheduler_slow_camera(self):
+        # A local stand-in camera ACKs the action, then takes 2 seconds to answer each POLL. An action on the real
+        # server still gets its results without waiting for the slow camera's POLL.
+        listener = socket.create_server(("127.0.0.1", 0))
+
+        def answer(conn):
+            with conn:
+                reader = net_protocol.FrameReader(conn)
+                while True:
+                    payload = reader.read_frame()
+                    if payload is None:
+                        return
+                    if net_codec.JSON_CODEC.decode(payload)["NetCmd"] == "NET_REQUEST_POLL":
+                        time.sleep(2)
+                        resp_dict = {"NetCmd": "NET_RESPONSE_WAIT", "duration": 0.0, "TS2": 0, "TS3": 0}
+                    else:
+                        resp_dict = {"NetCmd": "NET_RESPONSE_ACK", "TS2": 0, "TS3": 0}
+                    net_protocol.send_frame(conn, net_codec.JSON_CODEC.encode(resp_dict))
+
+        def serve():
+            while True:
+                try:
+                    conn, _ = listener.accept()
+                except OSError:
+                    return      # listener closed
+                threading.Thread(target=answer, args=(conn,), daemon=True).start()
+        threading.Thread(target=serve, daemon=True).start()
+
+        req_dict = {
+            "NetCmd": "NET_REQUEST_IMMEDIATE",
+            "API": "API_START_HARDWARE",
+            "Camera": "TestPoll",
+            "x_resolution": 640,
+            "y_resolution": 480,
+            "image_format": "JPG",
+            "page_size": "12x8"
+        }
+        resp = ClientLogic.client(TestMethods.ip, TestMethods.port, req_dict)
+        self.assertEqual(resp["NetCmd"], "NET_RESPONSE_IMMEDIATE")
+
+        req_dict = {
+            "NetCmd": "NET_REQUEST_ACTION",
+            "API": "API_EXAMINE_PLATEN_PAGE",
+            "Camera": "TestPoll",
+            "page_num": 1,
+            "config_pt_1": [0, 0],
+            "config_pt_2": [640, 480],
+        }
+        scheduler = poll_scheduler.PollScheduler(client=camera_client.CameraClient(codec=net_codec.JSON_CODEC))
+        slow = scheduler.submit(*listener.getsockname(), dict(req_dict))
+        time.sleep(0.5)     # the slow camera's first POLL is now waiting for its answer
+        start = time.time()
+        resp = scheduler.submit(TestMethods.ip, TestMethods.port, dict(req_dict)).result(timeout=30)
+        elapsed = time.time() - start
+        listener.close()
+        scheduler.stop()
+        print("(T): -->", resp)
+        self.assertEqual(resp["NetCmd"], "NET_RESPONSE_RESULTS")
+        self.assertLess(elapsed, 1.5)
+        self.assertFalse(slow.done())
+
+    def test_msg_ACTION_then_SUBSCRIBE(self):
+        # the results are pushed when the action finishes, instead of being polled for
+        req_dict = {
+            "NetCmd": "NET_REQUEST_IMMEDIATE",
+            "API": "API_START_HARDWARE",
+            "Camera": "TestSubscribe",
+            "x_resolution": 640,
+            "y_resolution": 480,
+            "image_format": "JPG",
+            "page_size": "12x8"
+        }
+        resp = ClientLogic.client(TestMethods.ip, TestMethods.port, req_dict)
+        self.assertEqual(resp["NetCmd"], "NET_RESPONSE_IMMEDIATE")
+
+        req_dict = {
+            "NetCmd": "NET_REQUEST_ACTION",
+            "API": "API_EXAMINE_PLATEN_PAGE",
+            "Camera": "TestSubscribe",
+            "page_num": 3,
+            "config_pt_1": [0, 0],
+            "config_pt_2": [640, 480],
+        }
+        resp = ClientLogic.client(TestMethods.ip, TestMethods.port, req_dict)
+        self.assertEqual(resp["NetCmd"], "NET_RESPONSE_ACK")
+
+        sub_dict = {
+            "API": "API_EXAMINE_PLATEN_PAGE",
+            "Camera": "TestSubscribe",
+            "job_id": resp["job_id"]
+        }
+        resp = camera_client.default_client.subscribe(TestMethods.ip, TestMethods.port, sub_dict)
+        print("(T): -->",resp)
+        self.assertEqual(resp["NetCmd"], "NET_RESPONSE_RESULTS")
+        self.assertEqual(resp["page_num"], 3)
+
+        # results are only sent once
+        poll_dict = {
+            "NetCmd": "NET_REQUEST_POLL",
+            "API": "API_EXAMINE_PLATEN_PAGE",
+            "Camera": "TestSubscribe"
+        }
+        resp = ClientLogic.client(TestMethods.ip, TestMethods.port, poll_dict)
+        self.assertEqual(resp["NetCmd"], "NET_RESPONSE_NAK")
+
+    def test_msg_BATCH(self):
+        # several requests in one round trip; a bad one gets a problem response in its place
+        requests = [
+            {"NetCmd": "NET_REQUEST_IMMEDIATE", "API": "API_PING"},
+            {"NetCmd": "NET_REQUEST_IMMEDIATE", "API": "API_STATUS", "status_detail": 2},
+            {"NetCmd": "NET_REQUEST_IMMEDIATE", "API": "API_NO_SUCH_THING"},
+            "not a request"
+        ]
+        resp = camera_client.default_client.batch(TestMethods.ip, TestMethods.port, requests, camera="Test")
+        print("(T): -->",resp)
+        self.assertEqual([r["NetCmd"] for r in resp], ["NET_RESPONSE_IMMEDIATE", "NET_RESPONSE_IMMEDIATE",
+                                                      "NET_RESPONSE_PROBLEM", "NET_RESPONSE_PROBLEM"])
+        self.assertEqual(resp[0]["Status"], "OK")
+        self.assertIn("uptime", resp[1])
+        self.assertTrue(resp[2]["APIError"])
+        self.assertTrue(resp[3]["ParsingError"])
+        for r in resp:
+            self.assertLessEqual(r["TS2"], r["TS3"])
+
+    def test_examine_platen_square_page_skew(self):
+        # a square page ("12x12") has no long axis; the skew must come from its edges
+        import math
+        import numpy as np
+        from examine_platen_page import examine_platen_page
+        yy, xx = np.mgrid[0:480, 0:480] - 240.0
+        for skew in (3, -5, 10):
+            angle = math.radians(skew)
+            u = xx * math.cos(angle) + yy * math.sin(angle)
+            v = yy * math.cos(angle) - xx * math.sin(angle)
+            image = np.full((480, 480, 3), 30, np.uint8)
+            image[(abs(u) <= 125) & (abs(v) <= 125)] = 230        # 250x250 page rotated by skew degrees
+            req_dict = {"page_num": 1, "config_pt_1": [0, 0], "config_pt_2": [480, 480]}
+            resp = examine_platen_page(req_dict, image=image)
+            print("(T): -->", skew, resp["skew_deg"])
+            self.assertAlmostEqual(resp["skew_deg"], skew, delta=0.5)
+
+    def test_punch_template_passed_to_worker(self):
+        # the analysis workers are given the template the server built; they don't build their own
+        import numpy as np
+        import check_platen_punch as punch
+        from analysis_pool import analysis_pool
+        template = punch.PunchTemplate("12x8", 640, 480)
+        image = np.full((480, 640, 3), 200, np.uint8)
+        punch.get_template.cache_clear()
+        resp = punch.check_platen_punch({"page_num": 1}, image=image, page_size="12x8", template=template)
+        self.assertEqual(punch.get_template.cache_info().currsize, 0)       # nothing built here
+        self.assertEqual(len(resp["punches"]), 3)
+        resp = analysis_pool.run(punch.check_platen_punch, {"page_num": 1}, image=image, page_size="12x8",
+                                 template=template)
+        self.assertEqual(len(resp["punches"]), 3)
+
+    def test_archive_retention_keeps_active_and_today(self):
+        # eviction never picks the active build (General for a non-numeric build_id) or today's images of any build
+        import os
+        import tempfile
+        from archive_retention import ArchiveRetention
+        today = time.strftime("%Y-%m-%d")
+        with tempfile.TemporaryDirectory() as root:
+            for build, day in (("Build_1", "2020-01-01"), ("Build_1", today), ("General", "2020-01-02"),
+                               ("General", today), ("lost+found", "2020-01-01")):
+                os.makedirs(os.path.join(root, build, day, "Platen"))
+            retention = ArchiveRetention()
+            retention.root = root
+            retention.set_active_build("T-77")
+            self.assertEqual(retention._eviction_order(), [("Build_1", "2020-01-01")])
+            retention.set_active_build(1)
+            self.assertEqual(retention._eviction_order(), [("General", "2020-01-02")])
+
+    def test_capture_stop_keeps_pinned_frame(self):
+        # a frame still being read when the engine stops keeps its shared memory until it is released
+        from multiprocessing import shared_memory
+        import camera_capture
+        engine = camera_capture.CaptureEngine(source_factory=camera_capture.FakeFrameSource, shared=True)
+        engine.start(64, 48, "JPG")
+        frame = engine.latest_frame()
+        name = frame.shared_ref[0]
+        engine.stop()
+        self.assertGreater(int(frame.image.mean()), 0)      # still readable
+        shared_memory.SharedMemory(name=name).close()       # still there
+        frame.release()
+        with self.assertRaises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
+        engine.close()
+
+    def test_msg_ACTION_CHECK_PLATEN_PUNCH(self):
+        req_dict = {
+            "NetCmd": "NET_REQUEST_IMMEDIATE",
+            "API": "API_START_HARDWARE",
+            "Camera": "TestPunch",
+            "x_resolution": 640,
+            "y_resolution": 480,
+            "image_format": "JPG",
+            "page_size": "12x8"
+        }
+        resp = ClientLogic.client(TestMethods.ip, TestMethods.port, req_dict)
+        self.assertEqual(resp["NetCmd"], "NET_RESPONSE_IMMEDIATE")
+
+        # a page size whose punch holes are outside the camera view is refused and leaves the settings as they were
+        req_dict["page_size"] = "12x18"
+        resp = ClientLogic.client(TestMethods.ip, TestMethods.port, req_dict)
+        print("(T): -->",resp)
+        self.assertEqual(resp["NetCmd"], "NET_RESPONSE_PROBLEM")
+
+        req_dict = {
+            "NetCmd": "NET_REQUEST_ACTION",
+            "API": "API_CHECK_PLATEN_PUNCH",
+            "Camera": "TestPunch",
+            "page_num": 2
+        }
+        resp = ClientLogic.client(TestMethods.ip, TestMethods.port, req_dict)
+        self.assertEqual(resp["NetCmd"], "NET_RESPONSE_ACK")
+        poll_dict = {
+            "NetCmd": "NET_REQUEST_POLL",
+            "API": "API_CHECK_PLATEN_PUNCH",
+            "Camera": "TestPunch"
+        }
+        for _ in range(100):
+            resp = ClientLogic.client(TestMethods.ip, TestMethods.port, dict(poll_dict))
+            if resp["NetCmd"] != "NET_RESPONSE_WAIT":
+                break
+            time.sleep(0.1)
+        print("(T): -->",resp)
+        self.assertEqual(resp["NetCmd"], "NET_RESPONSE_RESULTS")
+        self.assertEqual(len(resp["punches"]), 3)
+        self.assertIn("punch_ok", resp)
+
+        # the check ran in the analysis worker processes
+        req_dict = {
+            "NetCmd": "NET_REQUEST_IMMEDIATE",
+            "API": "API_STATUS",
+            "Camera": "TestPunch",
+            "fields": ["analysis_pool"]
+        }
+        resp = ClientLogic.client(TestMethods.ip, TestMethods.port, req_dict)
+        print("(T): -->",resp)
+        self.assertGreaterEqual(resp["analysis_pool"]["completed"], 1)
+        self.assertEqual(resp["analysis_pool"]["queued"], 0)
+
+    def test_msg_ACTION_EXAMINE_OUTFEED_PAGE_conveyor(self):
+        req_dict = {
+            "NetCmd": "NET_REQUEST_IMMEDIATE",
+            "API": "API_START_HARDWARE",
+            "Camera": "TestOutfeed",
+            "x_resolution": 640,
+            "y_resolution": 480,
+            "image_format": "JPG",
+            "page_size": "12x8"
+        }
+        resp = ClientLogic.client(TestMethods.ip, TestMethods.port, req_dict)
+        self.assertEqual(resp["NetCmd"], "NET_RESPONSE_IMMEDIATE")
+        req_dict = {
+            "NetCmd": "NET_REQUEST_IMMEDIATE",
+            "API": "API_REAR_CONVEYOR",
+            "Camera": "TestOutfeed",
+            "action": 1,
+            "conveyor_empty": True
+        }
+        resp = ClientLogic.client(TestMethods.ip, TestMethods.port, req_dict)
+        print("(T): -->",resp)
+        self.assertEqual(resp["ErrorType"], "Command NOT IMPLEMENTED YET")    # the motor itself isn't driven yet
+        self.assertTrue(resp["outfeed_monitor"])
+        self.assertTrue(resp["outfeed_calibrated"])
+
+        req_dict = {
+            "NetCmd": "NET_REQUEST_ACTION",
+            "API": "API_EXAMINE_OUTFEED_PAGE",
+            "Camera": "TestOutfeed",
+            "page_num": 3
+        }
+        resp = ClientLogic.client(TestMethods.ip, TestMethods.port, req_dict)
+        self.assertEqual(resp["NetCmd"], "NET_RESPONSE_ACK")
+        poll_dict = {
+            "NetCmd": "NET_REQUEST_POLL",
+            "API": "API_EXAMINE_OUTFEED_PAGE",
+            "Camera": "TestOutfeed"
+        }
+        for _ in range(100):
+            resp = ClientLogic.client(TestMethods.ip, TestMethods.port, dict(poll_dict))
+            if resp["NetCmd"] != "NET_RESPONSE_WAIT":
+                break
+            time.sleep(0.1)
+        print("(T): -->",resp)
+        self.assertEqual(resp["NetCmd"], "NET_RESPONSE_RESULTS")
+        self.assertIn("page_present", resp)
+        self.assertTrue(resp["calibrated"])
+        self.assertGreater(resp["frames_analyzed"], 0)
+
+        req_dict = {
+            "NetCmd": "NET_REQUEST_IMMEDIATE",
+            "API": "API_REAR_CONVEYOR",
+            "Camera": "TestOutfeed",
+            "action": 0
+        }
+        resp = ClientLogic.client(TestMethods.ip, TestMethods.port, req_dict)
+        self.assertFalse(resp["outfeed_monitor"])
+
 if __name__ == '__main__':
     unittest.main()
 